@@ -1,2 +1,4 @@
 from .aws_client import *
 from .textract import *
+from .textract_jobs import *
+from .textract_document import *
@@ -1,16 +1,26 @@
 import boto3
 import botocore
+import botocore.config
 import aioboto3
 from botocore.credentials import AssumeRoleCredentialFetcher, DeferredRefreshableCredentials
+import hashlib
 import logging
 import os
+import time
 import asyncio
-from contextlib import asynccontextmanager
+import weakref
+from contextlib import asynccontextmanager, AsyncExitStack
 
 import analytiq_data as ad
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of HTTP connections kept by each pooled AWS service client
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+
+# Cached AWS clients check the AWS configuration for changes at most this often
+AWS_CONFIG_CHECK_SECS = int(os.getenv("AWS_CONFIG_CHECK_SECS", "60"))
+
 async def get_s3_bucket_name(analytiq_client) -> str:
     """
     Get the S3 bucket name from database configuration or environment variable with fallback to default.
@@ -102,6 +112,23 @@ async def get_aws_client_sync(analytiq_client, region_name: str = "us-east-1") -
     await aws_client.init()
     return aws_client
 
+async def get_aws_config_fingerprint(analytiq_client) -> str:
+    """
+    Get a fingerprint of the AWS configuration, without decrypting the keys.
+
+    Args:
+        analytiq_client: The AnalytiqClient.
+
+    Returns:
+        A hash changing whenever the AWS keys or the S3 bucket change.
+    """
+    db = analytiq_client.mongodb_async[analytiq_client.env]
+    aws_config = await db["aws_config"].find_one({}, {"access_key_id": 1, "secret_access_key": 1, "s3_bucket_name": 1})
+    if not aws_config:
+        return ""
+    fields = [str(aws_config.get(field, "")) for field in ("access_key_id", "secret_access_key", "s3_bucket_name")]
+    return hashlib.sha256("\n".join(fields).encode()).hexdigest()
+
 async def get_aws_config(analytiq_client) -> dict:
     """
     Get the AWS keys.
@@ -147,18 +174,43 @@ def get_assume_role_arn(user_arn: str) -> str:
     user_name_base = user_name.split("-")[1]
     return f"arn:aws:iam::{account_id}:role/{account_name}-{user_name_base}-role"
 
+class _PooledServiceClient:
+    """
+    A long-lived aioboto3 client of one service, shared by the callers of
+    AsyncAWSClient.client(). Once retired, it is closed when its last user is done.
+    """
+    def __init__(self, client, exit_stack: AsyncExitStack):
+        self.client = client
+        self.exit_stack = exit_stack
+        self.n_users = 0
+        self.retired = False
+
+    async def close(self):
+        try:
+            await self.exit_stack.aclose()
+        except Exception as e:
+            logger.warning(f"Failed to close AWS client: {e}")
+
 class AsyncAWSClient:
     def __init__(self, analytiq_client, region_name: str = "us-east-1"):
         self.env = analytiq_client.env
         self.region_name = region_name
         self.analytiq_client = analytiq_client
-        
+        self.config_fingerprint = None
+        self.config_checked_at = 0.0
+        self._frozen_credentials = None
+        self._clients = {}
+        self._clients_lock = asyncio.Lock()
+        self._client_config = botocore.config.Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS)
+
     async def init(self):
         # Get the AWS keys
+        self.config_fingerprint = await get_aws_config_fingerprint(self.analytiq_client)
         aws_keys = await get_aws_config(self.analytiq_client)
         self.aws_access_key_id = aws_keys["aws_access_key_id"]
         self.aws_secret_access_key = aws_keys["aws_secret_access_key"]
-        
+        self.s3_bucket_name = aws_keys["s3_bucket_name"]
+
         if not self.aws_access_key_id or not self.aws_secret_access_key:
             raise Exception(f"AWS credentials not configured. Cannot create async AWS client.")
         
@@ -180,11 +232,10 @@ class AsyncAWSClient:
             aws_secret_access_key=self.aws_secret_access_key,
             region_name=self.region_name
         )
-        self.s3_bucket_name = None
 
         try:
             # Get the user's identity
-            user_identity = self.user_session.client("sts").get_caller_identity()
+            user_identity = await asyncio.to_thread(self.user_session.client("sts").get_caller_identity)
 
             # Get the assume role ARN
             self.assume_role_arn = get_assume_role_arn(user_identity["Arn"])
@@ -203,60 +254,99 @@ class AsyncAWSClient:
                 refresh_using=self.credential_fetcher.fetch_credentials
             )
             
-            # Update session with fresh credentials
-            self._refresh_session()
-            
-            # Get S3 bucket name
-            self.s3_bucket_name = await get_s3_bucket_name(self.analytiq_client)
+            # Assume the role
+            await self._refresh_credentials()
 
         except Exception as e:
             logger.error(f"AWS role assumption failed: {e}")
             logger.info("Async AWS client falling back to basic AWS credentials")
             # Fall back to basic credentials if role assumption fails
-            self.s3_bucket_name = await get_s3_bucket_name(self.analytiq_client)
+            self.botocore_session = None
+
+    async def _refresh_credentials(self):
+        """
+        Refresh the assumed role credentials when they are about to expire.
+        New credentials get a new session, and the clients of the previous
+        session are retired.
+        """
+        if not self.botocore_session or not self.botocore_session._credentials:
+            return
+        credentials = self.botocore_session._credentials
+        if self._frozen_credentials is not None and not credentials.refresh_needed():
+            return
+
+        # The refresh calls STS synchronously
+        frozen_credentials = await asyncio.to_thread(credentials.get_frozen_credentials)
+        if frozen_credentials == self._frozen_credentials:
+            return
+        self._frozen_credentials = frozen_credentials
+        self.session = aioboto3.Session(
+            aws_access_key_id=frozen_credentials.access_key,
+            aws_secret_access_key=frozen_credentials.secret_key,
+            aws_session_token=frozen_credentials.token,
+            region_name=self.region_name
+        )
+        await self._retire_clients()
+        logger.debug("Refreshed async AWS session with new credentials")
 
-    def _refresh_session(self):
-        """Refresh the session with current credentials"""
-        if self.botocore_session and self.botocore_session._credentials:
-            # Get fresh credentials
-            credentials = self.botocore_session.get_credentials()
-            
-            # Create new async session with fresh credentials
-            self.session = aioboto3.Session(
-                aws_access_key_id=credentials.access_key,
-                aws_secret_access_key=credentials.secret_key,
-                aws_session_token=credentials.token,
-                region_name=self.region_name
-            )
-            logger.debug("Refreshed async AWS session with new credentials")
+    async def _retire_clients(self):
+        clients, self._clients = self._clients, {}
+        for pooled in clients.values():
+            pooled.retired = True
+            if pooled.n_users == 0:
+                await pooled.close()
 
     @asynccontextmanager
     async def client(self, service_name: str):
-        """Create an async client with automatic credential refresh"""
+        """Get a pooled async client, with automatic credential refresh"""
+        await self._refresh_credentials()
+
+        pooled = self._clients.get(service_name)
+        if pooled is None:
+            async with self._clients_lock:
+                pooled = self._clients.get(service_name)
+                if pooled is None:
+                    exit_stack = AsyncExitStack()
+                    client = await exit_stack.enter_async_context(
+                        self.session.client(service_name, region_name=self.region_name, config=self._client_config)
+                    )
+                    pooled = _PooledServiceClient(client, exit_stack)
+                    self._clients[service_name] = pooled
+
+        pooled.n_users += 1
         try:
-            # Refresh session to ensure we have current credentials
-            if self.botocore_session:
-                self._refresh_session()
-            
-            async with self.session.client(service_name) as client:
-                yield client
+            yield pooled.client
         except Exception as e:
-            # If we get a signature error, try refreshing credentials once
+            # On a signature error, the next call gets a client with fresh credentials
             if "InvalidSignatureException" in str(e) or "Signature expired" in str(e):
-                logger.warning(f"AWS signature expired, refreshing credentials and retrying")
-                if self.botocore_session:
-                    self._refresh_session()
-                    async with self.session.client(service_name) as client:
-                        yield client
-                else:
-                    raise e
-            else:
-                raise e
+                logger.warning(f"AWS signature expired, refreshing credentials")
+                self._frozen_credentials = None
+                if pooled is self._clients.get(service_name):
+                    del self._clients[service_name]
+                    pooled.retired = True
+            raise
+        finally:
+            pooled.n_users -= 1
+            if pooled.retired and pooled.n_users == 0:
+                await pooled.close()
+
+    async def close(self):
+        """Close the pooled clients, once they are no longer used"""
+        await self._retire_clients()
+
+# Async AWS clients, per event loop, then per environment and region. Keyed
+# by the loop itself, as the id of a closed loop can be reused.
+_async_aws_clients = weakref.WeakKeyDictionary()
+_async_aws_client_locks = weakref.WeakKeyDictionary()
 
 async def get_aws_client_async(analytiq_client, region_name: str = "us-east-1") -> AsyncAWSClient:
     """
     Get the AsyncAWSClient.
 
+    The client is cached per process, with its assumed role credentials and
+    pooled connections. It is recreated when the AWS configuration changes,
+    which is checked at most every AWS_CONFIG_CHECK_SECS.
+
     Args:
         analytiq_client: The AnalytiqClient.
         region_name: AWS region name.
@@ -264,6 +354,43 @@ async def get_aws_client_async(analytiq_client, region_name: str = "us-east-1")
     Returns:
         The AsyncAWSClient.
     """
-    aws_client = AsyncAWSClient(analytiq_client, region_name)
-    await aws_client.init()
+    loop = asyncio.get_running_loop()
+    # The clients of closed loops can neither be used nor closed anymore
+    for closed_loop in [other for other in _async_aws_clients if other.is_closed()]:
+        del _async_aws_clients[closed_loop]
+    loop_clients = _async_aws_clients.setdefault(loop, {})
+    key = (analytiq_client.env, region_name)
+    lock = _async_aws_client_locks.setdefault(loop, {}).setdefault(key, asyncio.Lock())
+    async with lock:
+        aws_client = loop_clients.get(key)
+        if aws_client is not None and time.monotonic() - aws_client.config_checked_at >= AWS_CONFIG_CHECK_SECS:
+            if await get_aws_config_fingerprint(analytiq_client) != aws_client.config_fingerprint:
+                logger.info("AWS configuration changed, recreating the async AWS client")
+                del loop_clients[key]
+                await aws_client.close()
+                aws_client = None
+            else:
+                aws_client.config_checked_at = time.monotonic()
+
+        if aws_client is None:
+            aws_client = AsyncAWSClient(analytiq_client, region_name)
+            await aws_client.init()
+            aws_client.config_checked_at = time.monotonic()
+            loop_clients[key] = aws_client
     return aws_client
+
+async def invalidate_aws_clients(analytiq_client=None):
+    """
+    Drop the cached async AWS clients, e.g. after the AWS configuration changed.
+
+    Args:
+        analytiq_client: The AnalytiqClient. If None, drop the clients of all environments.
+    """
+    current_loop = asyncio.get_running_loop()
+    for loop, loop_clients in list(_async_aws_clients.items()):
+        for key in list(loop_clients):
+            if analytiq_client is None or key[0] == analytiq_client.env:
+                aws_client = loop_clients.pop(key)
+                # Clients of other event loops cannot be closed from this one
+                if loop is current_loop:
+                    await aws_client.close()
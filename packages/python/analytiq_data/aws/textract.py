@@ -5,132 +5,227 @@ import json
 import re
 import time
 import asyncio
-from datetime import datetime
 import uuid
 import logging
+import os
+import stamina
 import analytiq_data as ad
-from typing import Optional
+from typing import Optional, Callable, Awaitable, BinaryIO
 
 logger = logging.getLogger(__name__)
 
+# PDFs with more pages are split into shards of this many pages, OCRed
+# concurrently. 0 disables sharding.
+TEXTRACT_SHARD_PAGES = int(os.getenv("TEXTRACT_SHARD_PAGES", "0"))
+
+# Maximum number of shards of a PDF OCRed at a time
+TEXTRACT_SHARD_CONCURRENCY = int(os.getenv("TEXTRACT_SHARD_CONCURRENCY", "4"))
+
+# Attempts per shard before the whole document fails
+TEXTRACT_SHARD_ATTEMPTS = 3
+
+# Errors of Textract and S3 worth retrying a shard for: throttling, service
+# errors and connection problems. Anything else fails the same way again.
+TEXTRACT_TRANSIENT_ERROR_MARKERS = ["throttl", "provisionedthroughputexceeded", "limitexceeded",
+                                    "internalservererror", "internal server error", "serviceunavailable",
+                                    "service unavailable", "slowdown", "timeout", "timed out", "connection"]
+
 async def run_textract(analytiq_client,
-                       blob: bytes,
+                       blob: "ad.aws.TextractInput",
                        feature_types: list = [],
-                       query_list: Optional[list] = None) -> dict:
+                       query_list: Optional[list] = None,
+                       shard_pages: Optional[int] = None,
+                       on_page: Optional[Callable[[int, list], Awaitable]] = None) -> Optional[list]:
     """
     Run textract on a blob and return the blocks formatted as a dict.
 
+    PDFs longer than shard_pages are split into page-range shards, OCRed
+    concurrently as separate Textract jobs, and merged back in page order.
+    A failed shard is retried on its own. Inputs streamed as an async
+    iterator of chunks are uploaded as they are read, and never sharded.
+
+    With on_page, the blocks are not returned but passed to on_page one page
+    at a time, as soon as the page is complete: while the Textract results
+    are fetched, or once its shard is done.
+
     Args:
         analytiq_client: Analytiq client
-        doc_blob: Bytes to be textracted
+        doc_blob: Bytes to be textracted, a seekable binary file, or an async iterator of chunks
         feature_types: List of feature types, e.g. ["TABLES", "FORMS", "QUERIES"]
         query_list: List of queries
+        shard_pages: Maximum number of pages per Textract job. Defaults to TEXTRACT_SHARD_PAGES, 0 disables sharding.
+        on_page: If set, called with (page number, blocks of the page) for each page
 
     Returns:
-        Textract blocks formatted as a dict
+        Textract blocks formatted as a dict, None with on_page
     """
-    # Get the async AWS client
-    aws_client = await ad.aws.get_aws_client_async(analytiq_client)
-    s3_bucket_name = aws_client.s3_bucket_name
+    if shard_pages is None:
+        shard_pages = TEXTRACT_SHARD_PAGES
 
-    # Create a random s3 key
-    s3_key = f"textract/tmp/{datetime.now().strftime('%Y-%m-%d')}/{uuid.uuid4()}"
+    shards = None
+    if shard_pages > 0 and (isinstance(blob, (bytes, bytearray)) or hasattr(blob, "read")):
+        try:
+            shards = await asyncio.to_thread(ad.ocr.split_pdf, blob, shard_pages)
+        except Exception as e:
+            # Not a PDF pypdf can read, or pypdf is not installed
+            logger.warning(f"{analytiq_client.name}: cannot split the PDF into shards, running one job: {e}")
+
+    if shards is None or len(shards) == 1:
+        if on_page is None:
+            return await _run_textract_job(analytiq_client, blob, feature_types, query_list)
+        collector = TextractPageCollector(on_page)
+        await _run_textract_job(analytiq_client, blob, feature_types, query_list, on_blocks=collector.add)
+        await collector.flush()
+        return None
+
+    logger.info(f"{analytiq_client.name}: running textract on {len(shards)} shards of up to {shard_pages} pages")
+    semaphore = asyncio.Semaphore(TEXTRACT_SHARD_CONCURRENCY)
+    seen_ids = set()
+
+    async def run_shard(first_page: int, shard_blob: BinaryIO) -> list:
+        async with semaphore:
+            blocks = await _run_textract_shard(analytiq_client, shard_blob, feature_types, query_list)
+        if on_page is None:
+            return blocks
+        # Pass the pages of the shard on as soon as it is done
+        collector = TextractPageCollector(on_page)
+        await collector.add(_renumber_shard_blocks(first_page, blocks, seen_ids))
+        await collector.flush()
 
     try:
-        # Upload to S3 using async client
-        async with aws_client.client('s3') as s3_client:
-            await s3_client.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=blob)
-
-        # Start Textract job using async client
-        async with aws_client.client('textract') as textract_client:
-            if query_list is not None and len(query_list) > 0:
-                query_list = [{'Text': '{}'.format(q)} for q in query_list]
-                response = await textract_client.start_document_analysis(
-                    DocumentLocation={
-                        'S3Object': {
-                            'Bucket': s3_bucket_name,
-                            'Name': s3_key
-                        }
-                    },
-                    FeatureTypes=feature_types + ["QUERIES"],
-                    QueriesConfig = {'Queries': query_list}
-                )
-                get_completion_func = textract_client.get_document_analysis
-            elif len(feature_types) > 0:
-                response = await textract_client.start_document_analysis(
-                    DocumentLocation={
-                        'S3Object': {
-                            'Bucket': s3_bucket_name,
-                            'Name': s3_key
-                        }
-                    },
-                    FeatureTypes=feature_types,
-                )
-                get_completion_func = textract_client.get_document_analysis
-            else:
-                response = await textract_client.start_document_text_detection(
-                    DocumentLocation={
-                        'S3Object': {
-                            'Bucket': s3_bucket_name,
-                            'Name': s3_key
-                        }
-                    }
-                )
-                get_completion_func = textract_client.get_document_text_detection
-
-            job_id = response['JobId']
-
-            # Check completion status with async polling and exponential backoff
-            idx = 0
-            while True:
-                status_response = await get_completion_func(JobId=job_id)
-                status = status_response['JobStatus']
-                logger.info(f"{analytiq_client.name}: ocr step {idx}: {status}")
-                idx += 1
-
-                if status in ["SUCCEEDED", "FAILED"]:
-                    break
-
-                # Use exponential backoff for polling - start with 1s, max 10s
-                sleep_time = min(2 ** min(idx // 5, 3), 10)
-                await asyncio.sleep(sleep_time)
-
-            idx = 0
-            if status == "SUCCEEDED":
-                blocks = []
-
-                next_token = None
-                while True:
-                    # Get results with pagination
-                    if next_token:
-                        response = await get_completion_func(JobId=job_id, NextToken=next_token)
-                    else:
-                        response = await get_completion_func(JobId=job_id)
-
-                    blocks.extend(response['Blocks'])
-
-                    # Check for more results
-                    next_token = response.get('NextToken', None)
-                    
-                    logger.info(f"{analytiq_client.name}: ocr step {idx}: blocks len: {len(blocks)} next_token: {next_token}")
-                    idx += 1
-                    if not next_token:
-                        break
-
-                return blocks
-            else:
-                raise Exception(f"Textract document analysis failed: {status} for s3://{s3_bucket_name}/{s3_key}")
-                
-    except Exception as e:
-        logger.error(f"Error running textract: {e}")
-        raise e
+        shard_blocks = await asyncio.gather(*[run_shard(first_page, shard_blob) for first_page, shard_blob in shards])
     finally:
-        # Delete the s3 object using async client
-        try:
-            async with aws_client.client('s3') as s3_client:
-                await s3_client.delete_object(Bucket=s3_bucket_name, Key=s3_key)
-        except Exception as cleanup_error:
-            logger.warning(f"Failed to cleanup S3 object {s3_key}: {cleanup_error}")    
+        for _, shard_blob in shards:
+            shard_blob.close()
+    if on_page is not None:
+        return None
+    return merge_textract_shards([(first_page, blocks) for (first_page, _), blocks in zip(shards, shard_blocks)])
+
+def is_transient_textract_error(exception) -> bool:
+    """
+    Check if a Textract job failed for a reason that may not happen again:
+    the job ended FAILED, or Textract or S3 throttled or had an internal error.
+
+    Args:
+        exception: The exception to check
+
+    Returns:
+        bool: True if the job is worth retrying
+    """
+    if not isinstance(exception, Exception):
+        return False
+    if isinstance(exception, ad.aws.TextractJobFailedError):
+        return True
+    error_message = str(exception).lower()
+    return any(marker in error_message for marker in TEXTRACT_TRANSIENT_ERROR_MARKERS)
+
+# Shard jobs run for minutes, so the attempts are not bounded by a total time
+@stamina.retry(on=is_transient_textract_error, attempts=TEXTRACT_SHARD_ATTEMPTS, timeout=None)
+async def _run_textract_shard(analytiq_client, blob: BinaryIO, feature_types: list, query_list: Optional[list]) -> list:
+    """
+    Run textract on one shard, retrying the shard alone on transient failures.
+    """
+    return await _run_textract_job(analytiq_client, blob, feature_types, query_list)
+
+def merge_textract_shards(shards: list) -> list:
+    """
+    Merge the blocks of shards into the blocks of one document: pages are
+    renumbered from the first page of their shard, and block ids colliding
+    with the ids of an earlier shard are replaced.
+
+    Args:
+        shards: (1-based number of the first page, Textract blocks) for each shard, in page order
+
+    Returns:
+        Textract blocks
+    """
+    merged = []
+    seen_ids = set()
+    for first_page, blocks in shards:
+        merged.extend(_renumber_shard_blocks(first_page, blocks, seen_ids))
+    return merged
+
+def _renumber_shard_blocks(first_page: int, blocks: list, seen_ids: set) -> list:
+    """
+    Renumber the pages of a shard from its first page, and replace the block
+    ids already in seen_ids. The ids of the shard are added to seen_ids.
+    """
+    id_map = {}
+    for block in blocks:
+        if block["Id"] in seen_ids:
+            id_map[block["Id"]] = str(uuid.uuid4())
+    for block in blocks:
+        if "Page" in block:
+            block["Page"] += first_page - 1
+        if id_map:
+            block["Id"] = id_map.get(block["Id"], block["Id"])
+            for relationship in block.get("Relationships", []):
+                relationship["Ids"] = [id_map.get(block_id, block_id) for block_id in relationship["Ids"]]
+        seen_ids.add(block["Id"])
+    return blocks
+
+class TextractPageCollector:
+    """
+    Group a stream of Textract blocks, ordered by page, into complete pages.
+    A page is passed on once a block of a later page arrives, and the
+    remaining pages on flush(). Blocks without a page are passed on last,
+    as page 0.
+    """
+    def __init__(self, on_page: Callable[[int, list], Awaitable]):
+        self.on_page = on_page
+        self.pending = {}
+        self.last_page = 0
+        self.done_pages = set()
+
+    async def add(self, blocks: list):
+        """
+        Add the blocks of a Textract result page.
+
+        Args:
+            blocks: Textract blocks
+        """
+        for block in blocks:
+            page = block.get("Page", 0)
+            self.pending.setdefault(page, []).append(block)
+            self.last_page = max(self.last_page, page)
+        for page in sorted(self.pending):
+            if 0 < page < self.last_page:
+                await self._pass_on(page)
+
+    async def flush(self):
+        """
+        Pass on the remaining pages.
+        """
+        for page in sorted(self.pending, key=lambda page: (page == 0, page)):
+            await self._pass_on(page)
+
+    async def _pass_on(self, page: int):
+        if page in self.done_pages:
+            logger.warning(f"Textract blocks of page {page} arrived after the page was complete")
+        self.done_pages.add(page)
+        await self.on_page(page, self.pending.pop(page))
+
+async def _run_textract_job(analytiq_client,
+                            blob: "ad.aws.TextractInput",
+                            feature_types: list = [],
+                            query_list: Optional[list] = None,
+                            on_blocks: Optional[Callable[[list], Awaitable]] = None) -> Optional[list]:
+    """
+    Run one textract job on a blob.
+
+    Args:
+        analytiq_client: Analytiq client
+        blob: Bytes to be textracted, a seekable binary file, or an async iterator of chunks
+        feature_types: List of feature types, e.g. ["TABLES", "FORMS", "QUERIES"]
+        query_list: List of queries
+        on_blocks: If set, called with the blocks of each result page as it is fetched, instead of returning them
+
+    Returns:
+        Textract blocks, None with on_blocks
+    """
+    # One poller tracks all the jobs of the process
+    manager = await ad.aws.get_textract_job_manager(analytiq_client)
+    return await manager.run(blob, feature_types, query_list, on_blocks=on_blocks)
 
 def get_block_map(blocks: list) -> dict:
     """
@@ -274,7 +369,7 @@ def get_tables(block_map: dict) -> list:
             for relationship in block.get('Relationships', []):
                 if relationship['Type'] == 'CHILD':
                     for child_id in relationship['Ids']:
-                        cell = next(b for _, b in block_map.items() if b['Id'] == child_id)
+                        cell = block_map[child_id]
                         row_index = cell['RowIndex']
                         col_index = cell['ColumnIndex']
                         text = ''
@@ -0,0 +1,230 @@
+from collections import defaultdict
+from typing import Optional, List, Dict, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+class TextractDocument:
+    """
+    Textract blocks indexed once, by id, type, page and parent, so that
+    relationships are followed in O(1) and tables, key-value pairs, queries,
+    lines and words are extracted in linear time.
+    """
+    def __init__(self, blocks: List[Dict[str, Any]]):
+        """
+        Index the blocks.
+
+        Args:
+            blocks: Textract blocks
+        """
+        self.blocks = blocks
+        self.block_map = {}
+        self._by_type = defaultdict(list)
+        self._by_page_type = defaultdict(lambda: defaultdict(list))
+        self._parents = {}
+
+        for block in blocks:
+            self.block_map[block["Id"]] = block
+            block_type = block["BlockType"]
+            self._by_type[block_type].append(block)
+            page = block.get("Page")
+            if page is not None:
+                self._by_page_type[page][block_type].append(block)
+            for relationship in block.get("Relationships") or []:
+                if relationship["Type"] == "CHILD":
+                    for child_id in relationship["Ids"]:
+                        self._parents[child_id] = block["Id"]
+
+    @property
+    def pages(self) -> List[int]:
+        """
+        The page numbers holding blocks, sorted
+        """
+        return sorted(self._by_page_type)
+
+    @property
+    def n_pages(self) -> int:
+        """
+        The number of pages, up to the last page holding blocks
+        """
+        return max(self._by_page_type, default=0)
+
+    def get_block(self, block_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get a block by id.
+
+        Args:
+            block_id: The block id
+
+        Returns:
+            dict: The block, None if there is none with this id
+        """
+        return self.block_map.get(block_id)
+
+    def get_blocks(self, block_type: str, page: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Get the blocks of a type, in document order.
+
+        Args:
+            block_type: Block type, e.g. "LINE" or "TABLE"
+            page: Optional page number. If None, get the blocks of all pages.
+
+        Returns:
+            List[Dict]: The blocks
+        """
+        if page is None:
+            return self._by_type.get(block_type, [])
+        if page not in self._by_page_type:
+            return []
+        return self._by_page_type[page].get(block_type, [])
+
+    def get_related(self, block: Dict[str, Any], relationship_type: str = "CHILD") -> List[Dict[str, Any]]:
+        """
+        Get the blocks related to a block. Ids without a block are skipped.
+
+        Args:
+            block: The block
+            relationship_type: Relationship type, e.g. "CHILD", "VALUE" or "ANSWER"
+
+        Returns:
+            List[Dict]: The related blocks, in order
+        """
+        related = []
+        for relationship in block.get("Relationships") or []:
+            if relationship["Type"] == relationship_type:
+                for block_id in relationship["Ids"]:
+                    related_block = self.block_map.get(block_id)
+                    if related_block is not None:
+                        related.append(related_block)
+        return related
+
+    def get_parent(self, block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Get the block holding a block as a child.
+
+        Args:
+            block: The block
+
+        Returns:
+            dict: The parent block, None for top-level blocks
+        """
+        parent_id = self._parents.get(block["Id"])
+        return self.block_map.get(parent_id) if parent_id is not None else None
+
+    def get_lines(self, page: Optional[int] = None) -> List[str]:
+        """
+        Get the text of the lines.
+
+        Args:
+            page: Optional page number. If None, get the lines of all pages.
+
+        Returns:
+            List[str]: The lines
+        """
+        return [block["Text"] for block in self.get_blocks("LINE", page)]
+
+    def get_words(self, page: Optional[int] = None) -> List[str]:
+        """
+        Get the text of the words.
+
+        Args:
+            page: Optional page number. If None, get the words of all pages.
+
+        Returns:
+            List[str]: The words
+        """
+        return [block["Text"] for block in self.get_blocks("WORD", page)]
+
+    def get_page_text(self, page: int) -> str:
+        """
+        Get the text of a page, one line per line block.
+
+        Args:
+            page: The page number
+
+        Returns:
+            str: The page text
+        """
+        return "".join(line + "\n" for line in self.get_lines(page))
+
+    def get_page_text_map(self) -> Dict[int, str]:
+        """
+        Get the text of every page, from page 1 to the last page, including
+        pages without text.
+
+        Returns:
+            dict: Page text keyed by page number
+        """
+        return {page: self.get_page_text(page) for page in range(1, self.n_pages + 1)}
+
+    def get_text(self, block: Dict[str, Any]) -> str:
+        """
+        Get the text of the word and selection element children of a block,
+        selected elements counting as "X".
+
+        Args:
+            block: The block, e.g. a key, a value or a cell
+
+        Returns:
+            str: The text, each word followed by a space
+        """
+        text = ""
+        for child in self.get_related(block, "CHILD"):
+            if child["BlockType"] == "WORD":
+                text += child["Text"] + " "
+            elif child["BlockType"] == "SELECTION_ELEMENT" and child.get("SelectionStatus") == "SELECTED":
+                text += "X "
+        return text
+
+    def get_key_values(self, page: Optional[int] = None) -> Dict[str, List[str]]:
+        """
+        Get the key-value pairs of the forms.
+
+        Args:
+            page: Optional page number. If None, get the pairs of all pages.
+
+        Returns:
+            dict: Values keyed by key text. A key seen several times has several values.
+        """
+        kvs = defaultdict(list)
+        for block in self.get_blocks("KEY_VALUE_SET", page):
+            if "KEY" not in block.get("EntityTypes", []):
+                continue
+            values = self.get_related(block, "VALUE")
+            # Textract links a key to a single value
+            kvs[self.get_text(block)].append(self.get_text(values[-1]) if values else "")
+        return kvs
+
+    def get_query_map(self) -> Dict[str, Optional[str]]:
+        """
+        Get the answers of the queries.
+
+        Returns:
+            dict: Answer text keyed by query text, None for unanswered queries
+        """
+        query_map = {}
+        for block in self.get_blocks("QUERY"):
+            answers = self.get_related(block, "ANSWER")
+            query_map[block["Query"]["Text"]] = answers[-1].get("Text") if answers else None
+        return query_map
+
+    def get_tables(self, page: Optional[int] = None) -> List[Dict[int, Dict[int, str]]]:
+        """
+        Get the tables.
+
+        Args:
+            page: Optional page number. If None, get the tables of all pages.
+
+        Returns:
+            List[Dict]: For each table, cell text keyed by row index, then column index
+        """
+        tables = []
+        for block in self.get_blocks("TABLE", page):
+            table = {}
+            for cell in self.get_related(block, "CHILD"):
+                if "RowIndex" not in cell:
+                    continue
+                text = " ".join(child["Text"] for child in self.get_related(cell, "CHILD") if "Text" in child)
+                table.setdefault(cell["RowIndex"], {})[cell["ColumnIndex"]] = text
+            tables.append(table)
+        return tables
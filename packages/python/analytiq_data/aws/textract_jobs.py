@@ -0,0 +1,511 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+import weakref
+from datetime import datetime
+from typing import Optional, List, Dict, Tuple, Union, BinaryIO, AsyncIterator, Callable, Awaitable, Container
+import logging
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Delay before the first status check of a job, doubled after each check up to the maximum
+TEXTRACT_POLL_INITIAL_SECS = 1
+TEXTRACT_POLL_MAX_SECS = 10
+
+# Maximum number of status checks in flight, shared by all the jobs of a manager
+TEXTRACT_POLL_CONCURRENCY = int(os.getenv("TEXTRACT_POLL_CONCURRENCY", "5"))
+
+# With completion notifications, jobs are still checked this often, in case a notification is lost
+TEXTRACT_NOTIFICATION_FALLBACK_SECS = 60
+
+# SNS topic and role Textract publishes job completions to, and the SQS queue subscribed to the topic
+TEXTRACT_SNS_TOPIC_ARN = os.getenv("TEXTRACT_SNS_TOPIC_ARN")
+TEXTRACT_SNS_ROLE_ARN = os.getenv("TEXTRACT_SNS_ROLE_ARN")
+TEXTRACT_SQS_QUEUE_URL = os.getenv("TEXTRACT_SQS_QUEUE_URL")
+
+# Completions of jobs of other processes are made visible again this long after
+# they were received, for their process to receive them
+TEXTRACT_NOTIFICATION_REDELIVERY_SECS = 2
+
+# Completions received this many times without finding their job are deleted,
+# their process is gone
+TEXTRACT_NOTIFICATION_MAX_RECEIVES = 50
+
+TEXTRACT_FINAL_STATUSES = ("SUCCEEDED", "FAILED", "PARTIAL_SUCCESS")
+
+# Streamed inputs are uploaded to S3 in parts of this size. S3 needs parts of at least 5MB.
+S3_MIN_PART_SIZE = 5 * 1024 * 1024
+TEXTRACT_S3_PART_SIZE = int(os.getenv("TEXTRACT_S3_PART_SIZE", str(8 * 1024 * 1024)))
+
+# Input of a Textract job: bytes, a seekable binary file, or an async iterator of chunks
+TextractInput = Union[bytes, BinaryIO, AsyncIterator[bytes]]
+
+async def _iter_parts(source: TextractInput, part_size: int) -> AsyncIterator[bytes]:
+    """
+    Regroup an input into parts of part_size bytes, the last one possibly shorter.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        for offset in range(0, len(source), part_size):
+            yield bytes(source[offset:offset + part_size])
+        return
+
+    if hasattr(source, "read"):
+        await asyncio.to_thread(source.seek, 0)
+        while True:
+            part = await asyncio.to_thread(source.read, part_size)
+            if not part:
+                return
+            yield part
+
+    buffer = bytearray()
+    async for chunk in source:
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+class TextractJobFailedError(Exception):
+    """
+    A Textract job finished without results, e.g. with the FAILED status.
+    """
+
+class TextractNotifications:
+    """
+    A source of Textract job completion notifications.
+    """
+    def get_notification_channel(self) -> Optional[Dict[str, str]]:
+        """
+        Get the NotificationChannel parameter of the Textract start calls, None for none.
+        """
+        return None
+
+    async def receive(self, timeout_secs: float, job_ids: Container[str]) -> List[Tuple[str, str]]:
+        """
+        Wait for job completions.
+
+        Args:
+            timeout_secs: Maximum time to wait
+            job_ids: The jobs of the receiver. Completions of other jobs are left to their receivers.
+
+        Returns:
+            list: (job id, status) of the completed jobs of the receiver, possibly empty
+        """
+        raise NotImplementedError
+
+class SqsTextractNotifications(TextractNotifications):
+    """
+    Job completions published by Textract to an SNS topic, received from an
+    SQS queue subscribed to the topic.
+
+    The queue is shared by all the worker processes. A process only deletes
+    the completions of its own jobs, and makes the others visible again after
+    TEXTRACT_NOTIFICATION_REDELIVERY_SECS for the process that owns them.
+    """
+    def __init__(self, aws_client, topic_arn: str, role_arn: str, queue_url: str):
+        self.aws_client = aws_client
+        self.topic_arn = topic_arn
+        self.role_arn = role_arn
+        self.queue_url = queue_url
+
+    def get_notification_channel(self) -> Optional[Dict[str, str]]:
+        return {"SNSTopicArn": self.topic_arn, "RoleArn": self.role_arn}
+
+    async def receive(self, timeout_secs: float, job_ids: Container[str]) -> List[Tuple[str, str]]:
+        completions = []
+        async with self.aws_client.client("sqs") as sqs_client:
+            response = await sqs_client.receive_message(QueueUrl=self.queue_url,
+                                                        MaxNumberOfMessages=10,
+                                                        WaitTimeSeconds=max(0, min(int(timeout_secs), 20)),
+                                                        AttributeNames=["ApproximateReceiveCount"])
+            for message in response.get("Messages", []):
+                try:
+                    body = json.loads(message["Body"])
+                    # SNS wraps the Textract notification
+                    notification = json.loads(body["Message"]) if "Message" in body else body
+                    job_id, status = notification["JobId"], notification["Status"]
+                except (KeyError, ValueError) as e:
+                    logger.warning(f"Ignoring malformed Textract notification: {e}")
+                    job_id = status = None
+
+                n_receives = int(message.get("Attributes", {}).get("ApproximateReceiveCount", 1))
+                if job_id is not None and job_id not in job_ids and n_receives < TEXTRACT_NOTIFICATION_MAX_RECEIVES:
+                    # A job of another process
+                    await sqs_client.change_message_visibility(QueueUrl=self.queue_url,
+                                                               ReceiptHandle=message["ReceiptHandle"],
+                                                               VisibilityTimeout=TEXTRACT_NOTIFICATION_REDELIVERY_SECS)
+                    continue
+                if job_id in job_ids:
+                    completions.append((job_id, status))
+                await sqs_client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message["ReceiptHandle"])
+        return completions
+
+class LocalTextractNotifications(TextractNotifications):
+    """
+    In-process stand-in for the SNS/SQS notifications, for tests and local runs.
+    """
+    def __init__(self):
+        self._completions = asyncio.Queue()
+
+    def publish(self, job_id: str, status: str):
+        """
+        Publish the completion of a job.
+
+        Args:
+            job_id: The Textract job id
+            status: The job status, e.g. "SUCCEEDED"
+        """
+        self._completions.put_nowait((job_id, status))
+
+    async def receive(self, timeout_secs: float, job_ids: Container[str]) -> List[Tuple[str, str]]:
+        try:
+            completions = [await asyncio.wait_for(self._completions.get(), timeout_secs)]
+        except asyncio.TimeoutError:
+            return []
+        while not self._completions.empty():
+            completions.append(self._completions.get_nowait())
+        return completions
+
+class TextractJob:
+    """
+    A submitted Textract job.
+    """
+    def __init__(self, job_id: str, get_func_name: str, s3_key: str, future: asyncio.Future):
+        self.job_id = job_id
+        self.get_func_name = get_func_name
+        self.s3_key = s3_key
+        self.future = future
+        self.started_at = time.monotonic()
+        self.poll_interval_secs = TEXTRACT_POLL_INITIAL_SECS
+        self.next_check_at = self.started_at + self.poll_interval_secs
+        self.n_checks = 0
+
+class TextractJobManager:
+    """
+    Submits Textract jobs and tracks all of them with one background poller,
+    so that a worker process keeps many jobs in flight without a coroutine
+    blocked per job.
+
+    The poller checks the status of the jobs that are due, at most
+    TEXTRACT_POLL_CONCURRENCY at a time, backing off per job. With a
+    notification source, completions are taken from the notifications and
+    status checks only run as a slow fallback. The results of finished jobs
+    are fetched by the callers, so that the poller is never held up by a
+    long document.
+    """
+    def __init__(self, analytiq_client, aws_client, notifications: TextractNotifications = None):
+        self.analytiq_client = analytiq_client
+        self.aws_client = aws_client
+        self.notifications = notifications
+        self.jobs = {}
+        self._poller = None
+        self._wakeup = asyncio.Event()
+
+    @property
+    def n_jobs(self) -> int:
+        """
+        The number of jobs in flight
+        """
+        return len(self.jobs)
+
+    async def submit(self, blob: TextractInput, feature_types: list = [], query_list: Optional[list] = None) -> asyncio.Future:
+        """
+        Upload a blob to S3 and start a Textract job on it.
+
+        Args:
+            blob: Bytes to be textracted, a seekable binary file, or an async iterator of chunks
+            feature_types: List of feature types, e.g. ["TABLES", "FORMS", "QUERIES"]
+            query_list: List of queries
+
+        Returns:
+            asyncio.Future: Resolves to the TextractJob once it succeeded, for get_blocks(), or raises if it failed
+        """
+        s3_bucket_name = self.aws_client.s3_bucket_name
+        s3_key = f"textract/tmp/{datetime.now().strftime('%Y-%m-%d')}/{uuid.uuid4()}"
+        await self._upload(s3_key, blob)
+
+        try:
+            params = {"DocumentLocation": {"S3Object": {"Bucket": s3_bucket_name, "Name": s3_key}}}
+            channel = self.notifications.get_notification_channel() if self.notifications else None
+            if channel:
+                params["NotificationChannel"] = channel
+
+            async with self.aws_client.client("textract") as textract_client:
+                if query_list:
+                    params["FeatureTypes"] = feature_types + ["QUERIES"]
+                    params["QueriesConfig"] = {"Queries": [{"Text": f"{q}"} for q in query_list]}
+                    response = await textract_client.start_document_analysis(**params)
+                    get_func_name = "get_document_analysis"
+                elif len(feature_types) > 0:
+                    params["FeatureTypes"] = feature_types
+                    response = await textract_client.start_document_analysis(**params)
+                    get_func_name = "get_document_analysis"
+                else:
+                    response = await textract_client.start_document_text_detection(**params)
+                    get_func_name = "get_document_text_detection"
+        except Exception:
+            await self._delete_s3_object(s3_key)
+            raise
+
+        job = TextractJob(response["JobId"], get_func_name, s3_key, asyncio.get_running_loop().create_future())
+        if self.notifications is not None:
+            job.poll_interval_secs = TEXTRACT_NOTIFICATION_FALLBACK_SECS
+            job.next_check_at = job.started_at + job.poll_interval_secs
+        self.jobs[job.job_id] = job
+        logger.info(f"{self.analytiq_client.name}: started textract job {job.job_id}, {len(self.jobs)} jobs in flight")
+
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll_loop())
+        self._wakeup.set()
+        return job.future
+
+    async def run(self, blob: TextractInput, feature_types: list = [], query_list: Optional[list] = None,
+                  on_blocks: Optional[Callable[[list], Awaitable]] = None) -> Optional[list]:
+        """
+        Run a Textract job and wait for its blocks.
+
+        Args:
+            blob: Bytes to be textracted, a seekable binary file, or an async iterator of chunks
+            feature_types: List of feature types, e.g. ["TABLES", "FORMS", "QUERIES"]
+            query_list: List of queries
+            on_blocks: If set, called with the blocks of each result page as it is fetched, instead of returning them
+
+        Returns:
+            list: Textract blocks, None with on_blocks
+        """
+        job = await (await self.submit(blob, feature_types, query_list))
+        return await self.get_blocks(job, on_blocks)
+
+    async def get_blocks(self, job: TextractJob, on_blocks: Optional[Callable[[list], Awaitable]] = None) -> Optional[list]:
+        """
+        Fetch the blocks of a finished job, with pagination.
+
+        Args:
+            job: The job, from the future of submit()
+            on_blocks: If set, called with the blocks of each result page as it is fetched, instead of returning them
+
+        Returns:
+            list: Textract blocks, None with on_blocks
+        """
+        blocks = []
+        n_blocks = 0
+        n_result_pages = 0
+        next_token = None
+        async with self.aws_client.client("textract") as textract_client:
+            get_func = getattr(textract_client, job.get_func_name)
+            while True:
+                if next_token:
+                    response = await get_func(JobId=job.job_id, NextToken=next_token)
+                else:
+                    response = await get_func(JobId=job.job_id)
+                n_blocks += len(response["Blocks"])
+                n_result_pages += 1
+                if on_blocks is not None:
+                    await on_blocks(response["Blocks"])
+                else:
+                    blocks.extend(response["Blocks"])
+                next_token = response.get("NextToken", None)
+                if not next_token:
+                    break
+        logger.info(f"{self.analytiq_client.name}: textract job {job.job_id} fetched in "
+                    f"{time.monotonic() - job.started_at:.1f}s, blocks len: {n_blocks}, result pages: {n_result_pages}")
+        return blocks if on_blocks is None else None
+
+    async def stop(self):
+        """
+        Stop the poller. Jobs in flight are failed.
+        """
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+        for job in list(self.jobs.values()):
+            await self._finish(job, RuntimeError("Textract job manager stopped"))
+
+    async def _poll_loop(self):
+        semaphore = asyncio.Semaphore(TEXTRACT_POLL_CONCURRENCY)
+
+        async def check(job: TextractJob, textract_client):
+            async with semaphore:
+                await self._check_job(job, textract_client)
+
+        while self.jobs:
+            now = time.monotonic()
+            due = [job for job in self.jobs.values() if job.next_check_at <= now]
+            if due:
+                try:
+                    async with self.aws_client.client("textract") as textract_client:
+                        await asyncio.gather(*[check(job, textract_client) for job in due])
+                except Exception as e:
+                    logger.warning(f"{self.analytiq_client.name}: textract status checks failed: {e}")
+                    for job in due:
+                        job.next_check_at = time.monotonic() + job.poll_interval_secs
+                continue
+
+            wait_secs = min(job.next_check_at for job in self.jobs.values()) - now
+            self._wakeup.clear()
+            if self.notifications is not None:
+                try:
+                    completions = await self.notifications.receive(wait_secs, self.jobs)
+                except Exception as e:
+                    logger.warning(f"{self.analytiq_client.name}: receiving textract notifications failed: {e}")
+                    await asyncio.sleep(min(wait_secs, TEXTRACT_POLL_MAX_SECS))
+                    completions = []
+                for job_id, status in completions:
+                    job = self.jobs.get(job_id)
+                    if job is not None:
+                        await self._complete(job, status)
+            else:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait_secs)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _check_job(self, job: TextractJob, textract_client):
+        if job.job_id not in self.jobs:
+            return
+        try:
+            response = await getattr(textract_client, job.get_func_name)(JobId=job.job_id, MaxResults=1)
+        except Exception as e:
+            logger.warning(f"{self.analytiq_client.name}: status check of textract job {job.job_id} failed: {e}")
+            response = {"JobStatus": "IN_PROGRESS"}
+
+        job.n_checks += 1
+        status = response["JobStatus"]
+        logger.info(f"{self.analytiq_client.name}: textract job {job.job_id} check {job.n_checks}: {status}")
+        if status in TEXTRACT_FINAL_STATUSES:
+            await self._complete(job, status)
+        else:
+            if self.notifications is None:
+                job.poll_interval_secs = min(job.poll_interval_secs * 2, TEXTRACT_POLL_MAX_SECS)
+            job.next_check_at = time.monotonic() + job.poll_interval_secs
+
+    async def _complete(self, job: TextractJob, status: str):
+        """
+        Resolve the future of a finished job.
+        """
+        if status not in ("SUCCEEDED", "PARTIAL_SUCCESS"):
+            s3_path = f"s3://{self.aws_client.s3_bucket_name}/{job.s3_key}"
+            await self._finish(job, TextractJobFailedError(f"Textract document analysis failed: {status} for {s3_path}"))
+            return
+
+        logger.info(f"{self.analytiq_client.name}: textract job {job.job_id} {status} in "
+                    f"{time.monotonic() - job.started_at:.1f}s")
+        await self._finish(job, result=job)
+
+    async def _finish(self, job: TextractJob, error: Exception = None, result: TextractJob = None):
+        if self.jobs.pop(job.job_id, None) is None:
+            return
+        await self._delete_s3_object(job.s3_key)
+        if job.future.done():
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+
+    async def _upload(self, s3_key: str, blob: TextractInput):
+        """
+        Upload the input of a job to S3. Inputs larger than one part are
+        streamed with a multipart upload, holding one part in memory at a time.
+        """
+        s3_bucket_name = self.aws_client.s3_bucket_name
+        if isinstance(blob, (bytes, bytearray)):
+            async with self.aws_client.client("s3") as s3_client:
+                await s3_client.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=blob)
+            return
+
+        parts = _iter_parts(blob, max(TEXTRACT_S3_PART_SIZE, S3_MIN_PART_SIZE))
+        async with self.aws_client.client("s3") as s3_client:
+            part = await anext(parts, b"")
+            next_part = await anext(parts, None)
+            if next_part is None:
+                await s3_client.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=part)
+                return
+
+            upload = await s3_client.create_multipart_upload(Bucket=s3_bucket_name, Key=s3_key)
+            upload_id = upload["UploadId"]
+            completed_parts = []
+
+            async def upload_part(body: bytes):
+                part_number = len(completed_parts) + 1
+                response = await s3_client.upload_part(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id,
+                                                       PartNumber=part_number, Body=body)
+                completed_parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+            try:
+                await upload_part(part)
+                await upload_part(next_part)
+                # Hold one part at a time
+                del part, next_part
+                async for part in parts:
+                    await upload_part(part)
+                await s3_client.complete_multipart_upload(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id,
+                                                          MultipartUpload={"Parts": completed_parts})
+            except BaseException:
+                try:
+                    await s3_client.abort_multipart_upload(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id)
+                except Exception as e:
+                    logger.warning(f"Failed to abort the multipart upload of S3 object {s3_key}: {e}")
+                raise
+        logger.info(f"{self.analytiq_client.name}: uploaded {s3_key} to S3 in {len(completed_parts)} parts")
+
+    async def _delete_s3_object(self, s3_key: str):
+        try:
+            async with self.aws_client.client("s3") as s3_client:
+                await s3_client.delete_object(Bucket=self.aws_client.s3_bucket_name, Key=s3_key)
+        except Exception as cleanup_error:
+            logger.warning(f"Failed to cleanup S3 object {s3_key}: {cleanup_error}")
+
+# Job managers, per event loop, then per environment. Keyed by the loop
+# itself, as the id of a closed loop can be reused.
+_textract_job_managers = weakref.WeakKeyDictionary()
+
+async def get_textract_job_manager(analytiq_client) -> TextractJobManager:
+    """
+    Get the Textract job manager of the environment, creating it on first use.
+    It uses SNS/SQS completion notifications when TEXTRACT_SNS_TOPIC_ARN,
+    TEXTRACT_SNS_ROLE_ARN and TEXTRACT_SQS_QUEUE_URL are set.
+
+    Args:
+        analytiq_client: The AnalytiqClient
+
+    Returns:
+        TextractJobManager: The job manager
+    """
+    loop = asyncio.get_running_loop()
+    # The managers of closed loops can no longer poll their jobs
+    for closed_loop in [other for other in _textract_job_managers if other.is_closed()]:
+        del _textract_job_managers[closed_loop]
+    loop_managers = _textract_job_managers.setdefault(loop, {})
+    key = analytiq_client.env
+    aws_client = await ad.aws.get_aws_client_async(analytiq_client)
+    manager = loop_managers.get(key)
+    if manager is not None:
+        # The AWS client is recreated when the AWS configuration changes
+        manager.aws_client = aws_client
+        if isinstance(manager.notifications, SqsTextractNotifications):
+            manager.notifications.aws_client = aws_client
+    else:
+        notifications = None
+        if TEXTRACT_SNS_TOPIC_ARN and TEXTRACT_SNS_ROLE_ARN and TEXTRACT_SQS_QUEUE_URL:
+            notifications = SqsTextractNotifications(aws_client, TEXTRACT_SNS_TOPIC_ARN,
+                                                     TEXTRACT_SNS_ROLE_ARN, TEXTRACT_SQS_QUEUE_URL)
+        manager = loop_managers.setdefault(key, TextractJobManager(analytiq_client, aws_client, notifications))
+    return manager
+
+async def stop_textract_job_managers():
+    """
+    Stop the Textract job managers started in the current event loop.
+    """
+    loop_managers = _textract_job_managers.pop(asyncio.get_running_loop(), {})
+    for manager in loop_managers.values():
+        await manager.stop()
@@ -4,6 +4,8 @@ from .file import *
 from .forms import *
 from .id import *
 from .ocr import *
+from .ocr_blocks import *
+from .ocr_cache import *
 from .prompts import *
 from .schemas import *
 from .setup import *
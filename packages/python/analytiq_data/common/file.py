@@ -1,4 +1,5 @@
 from datetime import datetime, UTC
+from typing import AsyncIterator, Optional
 import os
 import subprocess
 import tempfile
@@ -37,6 +38,46 @@ async def get_file_async(analytiq_client, file_name: str) -> dict:
     """
     return await ad.mongodb.get_blob_async(analytiq_client, bucket="files", key=file_name)
 
+async def get_file_info_async(analytiq_client, file_name: str) -> Optional[dict]:
+    """
+    Get the size and metadata of a file, without reading it
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        file_name : str
+            file name
+
+    Returns:
+        dict
+            {"file_id", "length", "chunk_size", "metadata", "upload_date"}, None if not found
+    """
+    return await ad.mongodb.get_blob_info_async(analytiq_client, bucket="files", key=file_name)
+
+def iter_file_async(analytiq_client, file_name: str, start: int = 0, end: Optional[int] = None,
+                    file_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    """
+    Read a file chunk by chunk
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        file_name : str
+            file name
+        start : int
+            offset of the first byte to read
+        end : int
+            offset after the last byte to read. If None, read to the end of the file.
+        file_id : str
+            version of the file to read, from get_file_info_async()
+
+    Returns:
+        AsyncIterator[bytes]
+            The chunks of the file
+    """
+    return ad.mongodb.iter_blob_async(analytiq_client, bucket="files", key=file_name,
+                                      start=start, end=end, file_id=file_id)
+
 async def save_file_async(analytiq_client, file_name:str, blob:bytes, metadata:dict):
     """
     Save the file asynchronously
@@ -128,19 +169,12 @@ async def download_all_files_async(analytiq_client, output_dir: str):
         output_dir : str
             Output directory
     """
-    # Get the db
-    mongo = analytiq_client.mongodb_async
-    db_name = analytiq_client.env
-    db = mongo[db_name]
-    collection = db["files.files"]
-
     # Get all the files
-    cursor = collection.find()
-    files = await cursor.to_list(length=None)
+    files = [file async for file in ad.mongodb.list_blobs_async(analytiq_client, "files")]
 
     # Download each file
     for file in files:
-        file_name = file["filename"]
+        file_name = file["key"]
         file_data = await get_file_async(analytiq_client, file_name)
         file_blob = file_data["blob"]
         
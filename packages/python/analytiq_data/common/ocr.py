@@ -1,6 +1,8 @@
 from datetime import datetime, UTC
 import os
 import pickle
+from typing import Optional, List
+from pymongo import ReplaceOne
 import analytiq_data as ad
 import logging
 
@@ -8,8 +10,38 @@ logger = logging.getLogger(__name__)
 
 OCR_BUCKET = "ocr"
 
-async def get_ocr_json(analytiq_client, document_id: str) -> list:
-    """Get OCR blocks supporting both old and new key formats"""
+# OCR text, one document per (document_id, page_idx)
+OCR_PAGES_COLLECTION = "ocr_pages"
+
+# OCR metadata, one document per document_id. Written after the pages.
+# While the pages of a document are persisted as they are OCRed, it is
+# {_id, complete: False, n_pages_ready, ocr_date}: pages can be read one by
+# one, but the OCR of the document is not available yet.
+OCR_METADATA_COLLECTION = "ocr_metadata"
+
+# Filter of the metadata of complete OCR. Metadata without the field predates it.
+_COMPLETE_FILTER = {"complete": {"$ne": False}}
+
+# Envs whose OCR text indexes were already ensured by this process
+_indexed_envs = set()
+
+async def get_ocr_json(analytiq_client, document_id: str, pages: Optional[List[int]] = None) -> list:
+    """
+    Get the OCR blocks, supporting both the compact format and legacy pickles,
+    and both old and new key formats
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+        pages : list
+            1-based page numbers. If None, return the blocks of all pages.
+
+    Returns:
+        list
+            Textract blocks, None if there is no OCR
+    """
     # Try new format first
     key = f"{document_id}_json"
     ocr_blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
@@ -20,21 +52,79 @@ async def get_ocr_json(analytiq_client, document_id: str) -> list:
         ocr_blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
         
     if ocr_blob is None:
-        return None
-        
-    return pickle.loads(ocr_blob["blob"])
-   
+        # The document may use OCR results shared through the OCR cache
+        cache_key = await ad.common.get_ocr_cache_key_of_doc(analytiq_client, document_id)
+        if cache_key is None:
+            return None
+        return await ad.common.get_cached_ocr_json(analytiq_client, cache_key, pages)
 
-async def save_ocr_json(analytiq_client, document_id:str, ocr_json:list, metadata:dict=None):
-    """Save OCR JSON using new format"""
+    if ad.common.is_compact_ocr_blocks(ocr_blob["blob"]):
+        # Only the requested pages are decoded
+        return ad.common.decode_ocr_blocks(ocr_blob["blob"], pages)
+
+    ocr_json = pickle.loads(ocr_blob["blob"])
+    if pages is not None:
+        ocr_json = [block for block in ocr_json if block.get("Page") in pages]
+    return ocr_json
+
+async def save_ocr_json(analytiq_client, document_id:str, ocr_json, metadata:dict=None):
+    """Save OCR JSON in the compact format, from a list of blocks or already encoded bytes"""
     key = f"{document_id}_json"
-    ocr_bytes = pickle.dumps(ocr_json)
+    ocr_bytes = ocr_json if isinstance(ocr_json, bytes) else ad.common.encode_ocr_blocks(ocr_json)
+    metadata = {**(metadata or {}), "format": ad.common.OCR_BLOCKS_FORMAT}
     size_mb = len(ocr_bytes) / 1024 / 1024
     logger.info(f"Saving OCR json for {document_id} with metadata: {metadata} size: {size_mb:.2f}MB")
     await ad.mongodb.save_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key, blob=ocr_bytes, metadata=metadata)
     
     logger.info(f"OCR JSON for {document_id} has been saved.")
 
+async def migrate_ocr_json(analytiq_client, limit: int = 10) -> int:
+    """
+    Rewrite legacy pickled OCR blocks, saved under the _json or _list keys, in
+    the compact format under the _json key
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        limit : int
+            Maximum number of documents to migrate in this call
+
+    Returns:
+        int
+            Number of migrated documents. 0 once all are migrated.
+    """
+    blobs = ad.mongodb.list_blobs_async(
+        analytiq_client, OCR_BUCKET,
+        {"key": {"$regex": "_(json|list)$"}, "metadata.format": {"$ne": ad.common.OCR_BLOCKS_FORMAT}},
+        limit=limit
+    )
+
+    n_migrated = 0
+    async for elem in blobs:
+        key = elem["key"]
+        document_id = key.rsplit("_", 1)[0]
+        if key.endswith("_list") and \
+                await ad.mongodb.get_blob_info_async(analytiq_client, bucket=OCR_BUCKET, key=f"{document_id}_json"):
+            # Shadowed by the _json key
+            await ad.mongodb.delete_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+            continue
+        ocr_blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+        if ocr_blob is None:
+            continue
+        if key.endswith("_json") and (ocr_blob["metadata"] or {}).get("format") == ad.common.OCR_BLOCKS_FORMAT:
+            # An overwritten revision, not yet deleted
+            continue
+        if ad.common.is_compact_ocr_blocks(ocr_blob["blob"]):
+            ocr_json = ad.common.decode_ocr_blocks(ocr_blob["blob"])
+        else:
+            ocr_json = pickle.loads(ocr_blob["blob"])
+        await save_ocr_json(analytiq_client, document_id, ocr_json, metadata=elem.get("metadata"))
+        if key.endswith("_list"):
+            await ad.mongodb.delete_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+        n_migrated += 1
+        logger.info(f"Migrated OCR json {key} to {ad.common.OCR_BLOCKS_FORMAT}")
+    return n_migrated
+
 async def delete_ocr_json(analytiq_client, document_id:str):
     """
     Delete the OCR JSON
@@ -50,6 +140,43 @@ async def delete_ocr_json(analytiq_client, document_id:str):
 
     logger.debug(f"OCR JSON for {document_id} has been deleted.")
 
+async def _ensure_ocr_text_indexes(analytiq_client):
+    """
+    Create the index of the OCR pages collection, once per process
+    """
+    if analytiq_client.env in _indexed_envs:
+        return
+    db = ad.common.get_async_db(analytiq_client)
+    await db[OCR_PAGES_COLLECTION].create_index(
+        [("document_id", 1), ("page_idx", 1)],
+        name="document_id_page_idx_idx",
+        unique=True
+    )
+    _indexed_envs.add(analytiq_client.env)
+
+async def _get_legacy_text_metadata(analytiq_client, document_id:str) -> dict:
+    """
+    Get the info of the legacy full OCR text blob, without its text
+    """
+    return await ad.mongodb.get_blob_info_async(analytiq_client, bucket=OCR_BUCKET, key=f"{document_id}_text")
+
+async def _get_legacy_ocr_text(analytiq_client, document_id:str, page_idx:int=None) -> str:
+    key = f"{document_id}_text"
+    if page_idx is not None:
+        key += f"_page_{page_idx}"
+    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+    if blob is None:
+        return None
+    return blob["blob"].decode("utf-8")
+
+async def _delete_legacy_ocr_text(analytiq_client, document_id:str):
+    """
+    Delete the legacy OCR text blobs, if there are any
+    """
+    blobs = ad.mongodb.list_blobs_async(analytiq_client, OCR_BUCKET, {"key": {"$regex": f"^{document_id}_text"}})
+    for key in sorted({elem["key"] async for elem in blobs}):
+        await ad.mongodb.delete_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+
 async def get_ocr_text(analytiq_client, document_id:str, page_idx:int=None) -> str:
     """
     Get the OCR text
@@ -66,61 +193,107 @@ async def get_ocr_text(analytiq_client, document_id:str, page_idx:int=None) -> s
         str
             OCR text
     """
-    key = f"{document_id}_text"
+    db = ad.common.get_async_db(analytiq_client)
+    elem = await db[OCR_METADATA_COLLECTION].find_one({"_id": document_id}, {"complete": 1})
+    if elem is None:
+        return await _get_legacy_ocr_text(analytiq_client, document_id, page_idx)
+
     if page_idx is not None:
-        key += f"_page_{page_idx}"
-    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
-    if blob is None:
+        # Pages are readable as soon as they are OCRed
+        page = await db[OCR_PAGES_COLLECTION].find_one({"document_id": document_id, "page_idx": page_idx})
+        return page["text"] if page is not None else None
+
+    if elem.get("complete") is False:
         return None
-    return blob["blob"].decode("utf-8")
-   
+    return "\n".join([page_text async for page_text in iter_ocr_text_pages(analytiq_client, document_id)])
 
-async def save_ocr_text(analytiq_client, document_id:str, ocr_text:str, page_idx:int=None, metadata:dict=None):
+async def iter_ocr_text_pages(analytiq_client, document_id:str):
     """
-    Save the OCR text
+    Iterate over the OCR text of the pages, in page order, reading one page at a time.
+    While the document is OCRed, only the pages done so far are returned.
     
     Args:
         analytiq_client: AnalytiqClient
             The analytiq client
         document_id : str
             document id
-        ocr_text : str
-            OCR text
-        page_idx : int
-            page index
+
+    Yields:
+        str
+            OCR text of each page
+    """
+    db = ad.common.get_async_db(analytiq_client)
+    if await db[OCR_METADATA_COLLECTION].find_one({"_id": document_id}, {"_id": 1}) is None:
+        # Legacy per-page blobs
+        legacy = await _get_legacy_text_metadata(analytiq_client, document_id)
+        if legacy is None:
+            return
+        for page_idx in range((legacy.get("metadata") or {}).get("n_pages", 0)):
+            yield await _get_legacy_ocr_text(analytiq_client, document_id, page_idx) or ""
+        return
+
+    cursor = db[OCR_PAGES_COLLECTION].find({"document_id": document_id}, {"text": 1}).sort("page_idx", 1)
+    async for page in cursor:
+        yield page["text"]
+
+async def save_ocr_pages(analytiq_client, document_id:str, pages:list, metadata:dict=None):
+    """
+    Save the OCR text of the pages with one bulk write, replacing any previous OCR text
+    
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+        pages : list
+            OCR text of each page, in page order
         metadata : dict
             OCR metadata
     """
-    key = f"{document_id}_text"
-    if page_idx is not None:
-        key += f"_page_{page_idx}"
-    
-    # Convert the text to bytes 
-    ocr_text_bytes = ocr_text.encode("utf-8")
+    await _ensure_ocr_text_indexes(analytiq_client)
+    db = ad.common.get_async_db(analytiq_client)
 
-    # Save the blob
-    await ad.mongodb.save_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key, blob=ocr_text_bytes, metadata=metadata)
-    
-    logger.debug(f"OCR text for {document_id} page {page_idx} has been saved.")
+    if pages:
+        await db[OCR_PAGES_COLLECTION].bulk_write([
+            ReplaceOne(
+                {"document_id": document_id, "page_idx": page_idx},
+                {"document_id": document_id, "page_idx": page_idx, "text": page_text},
+                upsert=True
+            )
+            for page_idx, page_text in enumerate(pages)
+        ], ordered=False)
+    # Remove the pages of a previous, longer OCR
+    await db[OCR_PAGES_COLLECTION].delete_many({"document_id": document_id, "page_idx": {"$gte": len(pages)}})
+
+    # The metadata is written last: readers only use the pages once it exists
+    await db[OCR_METADATA_COLLECTION].replace_one(
+        {"_id": document_id},
+        {
+            "n_pages": len(pages),
+            "ocr_date": datetime.now(UTC),
+            "metadata": metadata or {}
+        },
+        upsert=True
+    )
+    logger.debug(f"OCR text for {document_id} has been saved: {len(pages)} pages.")
 
-async def delete_ocr_text(analytiq_client, document_id:str, page_idx:int=None):
+async def delete_ocr_text(analytiq_client, document_id:str):
     """
-    Delete the OCR text
+    Delete the OCR text of all pages
 
     Args:
         analytiq_client: AnalytiqClient
             The analytiq client
         document_id : str
             document id
-        page_idx : int
-            page index
     """
-    key = f"{document_id}_text"
-    if page_idx is not None:
-        key += f"_page_{page_idx}"
-    await ad.mongodb.delete_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
+    db = ad.common.get_async_db(analytiq_client)
+    await db[OCR_METADATA_COLLECTION].delete_one({"_id": document_id})
+    await db[OCR_PAGES_COLLECTION].delete_many({"document_id": document_id})
+
+    await _delete_legacy_ocr_text(analytiq_client, document_id)
 
-    logger.debug(f"OCR text for {document_id} page {page_idx} has been deleted.")
+    logger.debug(f"OCR text for {document_id} has been deleted.")
 
 async def delete_ocr_all(analytiq_client, document_id:str):
     """
@@ -132,11 +305,9 @@ async def delete_ocr_all(analytiq_client, document_id:str):
         document_id : str
             document id
     """
-    n_pages = await get_ocr_n_pages(analytiq_client, document_id)
-    for page_idx in range(n_pages):
-        await delete_ocr_text(analytiq_client, document_id, page_idx)
     await delete_ocr_text(analytiq_client, document_id)
     await delete_ocr_json(analytiq_client, document_id)
+    await ad.common.release_ocr_cache(analytiq_client, document_id)
 
 async def save_ocr_text_from_list(analytiq_client, document_id:str, ocr_json:list, metadata:dict=None, force:bool=False):
     """
@@ -154,50 +325,52 @@ async def save_ocr_text_from_list(analytiq_client, document_id:str, ocr_json:lis
         force : bool
             Whether to force the processing
     """
-    block_map = ad.aws.textract.get_block_map(ocr_json)
-    page_text_map = ad.aws.textract.get_page_text_map(block_map)
-
     if not force:
-        ocr_text = await get_ocr_text(analytiq_client, document_id)
-        if ocr_text is not None:
+        if await get_ocr_metadata(analytiq_client, document_id) is not None:
             logger.info(f"OCR text for {document_id} already exists. Returning.")
             return
-    else:
-        # Remove the old OCR text, if any
-        await delete_ocr_text(analytiq_client, document_id)
-        for page_idx in range(len(page_text_map)):
-            await delete_ocr_text(analytiq_client, document_id, page_idx)
-    
-    # Record the number of pages in the metadata
-    if metadata is None:
-        metadata = {}
-    metadata["n_pages"] = len(page_text_map)
-    
-    # Save the new OCR text
-    for page_num, page_text in page_text_map.items():
-        page_idx = int(page_num) - 1
-        await save_ocr_text(analytiq_client, document_id, page_text, page_idx, metadata)
-        logger.info(f"OCR text for {document_id} page {page_idx} has been saved.")
 
-    text = "\n".join(page_text_map.values())
-    logger.info(f"Saving OCR text for {document_id} with metadata: {metadata} length: {len(text)}")
-    await save_ocr_text(analytiq_client, document_id, text, metadata=metadata)
+    page_text_map = ad.aws.TextractDocument(ocr_json).get_page_text_map()
+
+    logger.info(f"Saving OCR text for {document_id} with metadata: {metadata} pages: {len(page_text_map)}")
+    pages = [page_text_map[page] for page in sorted(page_text_map)]
+    await save_ocr_pages(analytiq_client, document_id, pages, metadata)
+
+    # Remove the legacy OCR text, if any
+    await _delete_legacy_ocr_text(analytiq_client, document_id)
 
     logger.info(f"OCR text for {document_id} has been saved.")
 
 async def get_ocr_metadata(analytiq_client, document_id:str) -> dict:
     """
-    Get the OCR metadata
+    Get the OCR metadata, without reading the OCR text
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+
+    Returns:
+        dict
+            {"n_pages": int, "ocr_date": datetime}, None if there is no OCR text
     """
-    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=f"{document_id}_text")
-    if blob is None:
+    db = ad.common.get_async_db(analytiq_client)
+    elem = await db[OCR_METADATA_COLLECTION].find_one({"_id": document_id, **_COMPLETE_FILTER},
+                                                      {"n_pages": 1, "ocr_date": 1})
+    if elem is not None:
+        return {"n_pages": elem["n_pages"], "ocr_date": elem["ocr_date"]}
+    if await db[OCR_METADATA_COLLECTION].find_one({"_id": document_id}, {"_id": 1}) is not None:
+        # Still being OCRed
         return None
 
-    metadata = {
-        "n_pages": blob["metadata"].get("n_pages", 0),
-        "ocr_date": blob.get("upload_date", None)
+    legacy = await _get_legacy_text_metadata(analytiq_client, document_id)
+    if legacy is None:
+        return None
+    return {
+        "n_pages": (legacy.get("metadata") or {}).get("n_pages", 0),
+        "ocr_date": legacy.get("upload_date", None)
     }
-    return metadata
 
 async def get_ocr_n_pages(analytiq_client, document_id:str) -> int:
     """
@@ -213,8 +386,123 @@ async def get_ocr_n_pages(analytiq_client, document_id:str) -> int:
         int
             Number of pages in the OCR text
     """
-    key = f"{document_id}_text"
-    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=OCR_BUCKET, key=key)
-    if blob is None:
+    metadata = await get_ocr_metadata(analytiq_client, document_id)
+    if metadata is None:
         return 0
-    return blob["metadata"]["n_pages"]
+    return metadata["n_pages"]
+
+async def get_ocr_progress(analytiq_client, document_id:str) -> Optional[dict]:
+    """
+    Get the progress of the OCR text of a document, whose pages become
+    readable with get_ocr_text(page_idx=...) as they are OCRed
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+
+    Returns:
+        dict
+            {"complete": bool, "n_pages_ready": int}, None if there is no OCR text
+    """
+    db = ad.common.get_async_db(analytiq_client)
+    elem = await db[OCR_METADATA_COLLECTION].find_one({"_id": document_id}, {"complete": 1, "n_pages": 1, "n_pages_ready": 1})
+    if elem is None:
+        metadata = await get_ocr_metadata(analytiq_client, document_id)
+        if metadata is None:
+            return None
+        return {"complete": True, "n_pages_ready": metadata["n_pages"]}
+    if elem.get("complete") is False:
+        return {"complete": False, "n_pages_ready": elem.get("n_pages_ready", 0)}
+    return {"complete": True, "n_pages_ready": elem["n_pages"]}
+
+class OcrPageWriter:
+    """
+    Persist the OCR of a document page by page, while it is produced, e.g.
+    as the on_page callback of ad.ocr.run_ocr(). The text of each page is
+    saved as soon as the page is added, and the blocks are kept as compressed
+    page segments, so that a long document is never held in memory as blocks.
+
+    finish() completes the OCR text and returns the blocks in the compact
+    format, for save_ocr_json() or the OCR cache.
+    """
+    def __init__(self, analytiq_client, document_id: str, metadata: dict = None):
+        self.analytiq_client = analytiq_client
+        self.document_id = document_id
+        self.metadata = metadata
+        self.n_pages = 0
+        self._segments = {}
+        self._text_pages = set()
+
+    async def add_page(self, page: int, blocks: list):
+        """
+        Add the blocks of a page. Blocks added again for the same page are
+        merged with the previous ones.
+
+        Args:
+            page : int
+                1-based page number, 0 for blocks without a page
+            blocks : list
+                Textract blocks of the page
+        """
+        if page in self._segments:
+            blocks = ad.common.decode_ocr_page(self._segments[page][0], page) + blocks
+        self._segments[page] = (ad.common.encode_ocr_page(blocks), len(blocks))
+        if page == 0:
+            return
+
+        if not self._text_pages:
+            await _ensure_ocr_text_indexes(self.analytiq_client)
+        page_text = ad.aws.TextractDocument(blocks).get_page_text(page)
+        await self._save_page_text(page - 1, page_text)
+        self._text_pages.add(page)
+        self.n_pages = max(self.n_pages, page)
+
+        db = ad.common.get_async_db(self.analytiq_client)
+        await db[OCR_METADATA_COLLECTION].replace_one(
+            {"_id": self.document_id},
+            {"complete": False, "n_pages_ready": len(self._text_pages), "ocr_date": datetime.now(UTC)},
+            upsert=True
+        )
+
+    async def _save_page_text(self, page_idx: int, page_text: str):
+        db = ad.common.get_async_db(self.analytiq_client)
+        await db[OCR_PAGES_COLLECTION].replace_one(
+            {"document_id": self.document_id, "page_idx": page_idx},
+            {"document_id": self.document_id, "page_idx": page_idx, "text": page_text},
+            upsert=True
+        )
+
+    async def finish(self) -> bytes:
+        """
+        Complete the OCR text: pages without blocks get empty text, and the
+        metadata is written last.
+
+        Returns:
+            bytes
+                The blocks of all pages, in the compact format
+        """
+        await _ensure_ocr_text_indexes(self.analytiq_client)
+        db = ad.common.get_async_db(self.analytiq_client)
+        for page in range(1, self.n_pages + 1):
+            if page not in self._text_pages:
+                await self._save_page_text(page - 1, "")
+        # Remove the pages of a previous, longer OCR
+        await db[OCR_PAGES_COLLECTION].delete_many({"document_id": self.document_id, "page_idx": {"$gte": self.n_pages}})
+
+        await db[OCR_METADATA_COLLECTION].replace_one(
+            {"_id": self.document_id},
+            {
+                "n_pages": self.n_pages,
+                "ocr_date": datetime.now(UTC),
+                "metadata": self.metadata or {}
+            },
+            upsert=True
+        )
+        await _delete_legacy_ocr_text(self.analytiq_client, self.document_id)
+        logger.info(f"OCR text for {self.document_id} has been saved: {self.n_pages} pages.")
+
+        # Pages in order, blocks without a page last
+        pages = sorted(self._segments, key=lambda page: (page == 0, page))
+        return ad.common.join_ocr_pages([(page, *self._segments[page]) for page in pages])
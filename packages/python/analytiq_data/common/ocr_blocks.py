@@ -0,0 +1,354 @@
+from array import array
+import json
+import math
+import struct
+import sys
+import uuid
+import zlib
+from typing import Optional, List, Dict, Any
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Compact OCR block format
+#
+#   MAGIC | version (u8) | header length (u32) | zlib(header JSON) | page segments
+#
+# The header lists, for each page, the offset and length of its segment, so a
+# page is decoded without touching the others. Each segment is zlib
+# compressed, and holds the blocks of one page as a struct-of-arrays:
+#
+#   JSON length (u32) | JSON columns | float64 geometry | float64 confidence | ids
+#
+# The JSON columns are:
+#   types: block types, as indexes in type_names
+#   text: per block, None if absent
+#   geo: per block, None without geometry, else [has bounding box, polygon points]
+#   rels: per block [[type index in rel_names, [id indexes]], ...], None if absent
+#   extra: per block dict of the remaining keys, None if empty
+# Geometry holds the [width, height, left, top] bounding boxes and the flat
+# [x0, y0, x1, y1, ...] polygons of the blocks in order. Confidence is NaN
+# when absent. The ids are the block ids followed by the ids only referenced
+# by relationships; they are packed as 16-byte UUIDs when they all are UUIDs.
+# Blocks without a page are stored under page 0.
+OCR_BLOCKS_MAGIC = b"OCRB"
+OCR_BLOCKS_VERSION = 1
+OCR_BLOCKS_FORMAT = f"compact_v{OCR_BLOCKS_VERSION}"
+
+# zlib level of the page segments
+OCR_BLOCKS_COMPRESSION_LEVEL = 6
+
+_HEADER_STRUCT = struct.Struct("<BI")
+_LENGTH_STRUCT = struct.Struct("<I")
+
+# Keys stored in their own columns
+_COLUMN_KEYS = {"Id", "BlockType", "Page", "Text", "Confidence", "Geometry", "Relationships"}
+
+def is_compact_ocr_blocks(data: bytes) -> bool:
+    """
+    Check whether a blob holds OCR blocks in the compact format.
+
+    Args:
+        data: The blob
+
+    Returns:
+        bool: True for the compact format, False for legacy pickles
+    """
+    return data[:len(OCR_BLOCKS_MAGIC)] == OCR_BLOCKS_MAGIC
+
+def _pack_ids(ids: List[str]) -> Optional[bytes]:
+    """
+    Pack canonical UUID strings into 16 bytes each. Returns None if any id is not one.
+    """
+    try:
+        packed = b"".join(uuid.UUID(block_id).bytes for block_id in ids)
+    except (ValueError, AttributeError, TypeError):
+        return None
+    # Only canonical lowercase UUIDs round-trip
+    if _unpack_ids(packed) != ids:
+        return None
+    return packed
+
+def _unpack_ids(packed: bytes) -> List[str]:
+    h = packed.hex()
+    return [f"{h[i:i+8]}-{h[i+8:i+12]}-{h[i+12:i+16]}-{h[i+16:i+20]}-{h[i+20:i+32]}"
+            for i in range(0, len(h), 32)]
+
+def _encode_page(blocks: List[Dict[str, Any]]) -> bytes:
+    ids = [block["Id"] for block in blocks]
+    id_index = {block_id: i for i, block_id in enumerate(ids)}
+    type_names = []
+    type_index = {}
+    rel_names = []
+    rel_index = {}
+
+    columns = {"types": [], "text": [], "geo": [], "rels": [], "extra": []}
+    geometry_values = array("d")
+    confidence_values = array("d")
+
+    for block in blocks:
+        block_type = block.get("BlockType")
+        if block_type not in type_index:
+            type_index[block_type] = len(type_names)
+            type_names.append(block_type)
+        columns["types"].append(type_index[block_type])
+        columns["text"].append(block.get("Text"))
+        confidence = block.get("Confidence")
+        confidence_values.append(math.nan if confidence is None else confidence)
+
+        extra = {key: value for key, value in block.items() if key not in _COLUMN_KEYS}
+
+        geometry = block.get("Geometry")
+        geo = None
+        if geometry is not None:
+            box = geometry.get("BoundingBox")
+            points = geometry.get("Polygon")
+            geo = [0, None]
+            if box is not None:
+                geo[0] = 1
+                geometry_values.extend((box["Width"], box["Height"], box["Left"], box["Top"]))
+            if points is not None:
+                geo[1] = len(points)
+                for point in points:
+                    geometry_values.extend((point["X"], point["Y"]))
+            geometry_extra = {key: value for key, value in geometry.items() if key not in ("BoundingBox", "Polygon")}
+            if geometry_extra:
+                # Keep the geometry the columns cannot express
+                extra["__geometry__"] = geometry_extra
+        columns["geo"].append(geo)
+
+        rels = None
+        if block.get("Relationships") is not None:
+            rels = []
+            for relationship in block["Relationships"]:
+                rel_type = relationship["Type"]
+                if rel_type not in rel_index:
+                    rel_index[rel_type] = len(rel_names)
+                    rel_names.append(rel_type)
+                id_idxs = []
+                for rel_id in relationship.get("Ids", []):
+                    if rel_id not in id_index:
+                        id_index[rel_id] = len(ids)
+                        ids.append(rel_id)
+                    id_idxs.append(id_index[rel_id])
+                rels.append([rel_index[rel_type], id_idxs])
+        columns["rels"].append(rels)
+        columns["extra"].append(extra or None)
+
+    packed_ids = _pack_ids(ids)
+    if packed_ids is None:
+        columns["ids"] = ids
+        packed_ids = b""
+    columns["n"] = len(blocks)
+    columns["n_geometry"] = len(geometry_values)
+    columns["type_names"] = type_names
+    columns["rel_names"] = rel_names
+
+    if sys.byteorder != "little":
+        geometry_values.byteswap()
+        confidence_values.byteswap()
+
+    data = json.dumps(columns, separators=(",", ":")).encode("utf-8")
+    segment = b"".join([_LENGTH_STRUCT.pack(len(data)), data,
+                        geometry_values.tobytes(), confidence_values.tobytes(), packed_ids])
+    return zlib.compress(segment, OCR_BLOCKS_COMPRESSION_LEVEL)
+
+def _decode_page(segment: bytes, page: int) -> List[Dict[str, Any]]:
+    segment = zlib.decompress(segment)
+    (json_len,) = _LENGTH_STRUCT.unpack_from(segment, 0)
+    pos = _LENGTH_STRUCT.size
+    columns = json.loads(segment[pos:pos + json_len])
+    pos += json_len
+
+    n = columns["n"]
+    geometry_values = array("d")
+    geometry_values.frombytes(segment[pos:pos + 8 * columns["n_geometry"]])
+    pos += 8 * columns["n_geometry"]
+    confidence_values = array("d")
+    confidence_values.frombytes(segment[pos:pos + 8 * n])
+    pos += 8 * n
+    ids = columns["ids"] if "ids" in columns else _unpack_ids(segment[pos:])
+    if sys.byteorder != "little":
+        geometry_values.byteswap()
+        confidence_values.byteswap()
+
+    type_names = columns["type_names"]
+    rel_names = columns["rel_names"]
+
+    blocks = []
+    geo_pos = 0
+    for i in range(n):
+        block = {"BlockType": type_names[columns["types"][i]]}
+        confidence = confidence_values[i]
+        if not math.isnan(confidence):
+            block["Confidence"] = confidence
+        if columns["text"][i] is not None:
+            block["Text"] = columns["text"][i]
+
+        extra = columns["extra"][i] or {}
+        geo = columns["geo"][i]
+        if geo is not None:
+            geometry = {}
+            has_box, n_points = geo
+            if has_box:
+                width, height, left, top = geometry_values[geo_pos:geo_pos + 4]
+                geometry["BoundingBox"] = {"Width": width, "Height": height, "Left": left, "Top": top}
+                geo_pos += 4
+            if n_points is not None:
+                geometry["Polygon"] = [{"X": geometry_values[j], "Y": geometry_values[j + 1]}
+                                       for j in range(geo_pos, geo_pos + 2 * n_points, 2)]
+                geo_pos += 2 * n_points
+            geometry.update(extra.pop("__geometry__", None) or {})
+            block["Geometry"] = geometry
+
+        block["Id"] = ids[i]
+        if columns["rels"][i] is not None:
+            block["Relationships"] = [
+                {"Type": rel_names[rel_type], "Ids": [ids[j] for j in id_idxs]}
+                for rel_type, id_idxs in columns["rels"][i]
+            ]
+        if page != 0:
+            block["Page"] = page
+        block.update(extra)
+        blocks.append(block)
+    return blocks
+
+def encode_ocr_page(blocks: List[Dict[str, Any]]) -> bytes:
+    """
+    Encode the blocks of one page as a segment of the compact format.
+
+    Args:
+        blocks: The Textract blocks of the page
+
+    Returns:
+        bytes: The page segment, for join_ocr_pages()
+    """
+    return _encode_page(blocks)
+
+def decode_ocr_page(segment: bytes, page: int) -> List[Dict[str, Any]]:
+    """
+    Decode a page segment from encode_ocr_page().
+
+    Args:
+        segment: The page segment
+        page: The 1-based page number, 0 for blocks without a page
+
+    Returns:
+        List[Dict]: The Textract blocks of the page
+    """
+    return _decode_page(segment, page)
+
+def join_ocr_pages(pages: List[tuple]) -> bytes:
+    """
+    Build compact OCR blocks from encoded pages.
+
+    Args:
+        pages: (page number, segment from encode_ocr_page(), number of blocks) for each page, in storage order
+
+    Returns:
+        bytes: The encoded blocks
+    """
+    page_index = []
+    offset = 0
+    for page, segment, n_blocks in pages:
+        page_index.append([page, offset, len(segment), n_blocks])
+        offset += len(segment)
+
+    n_blocks = sum(n for _, _, n in pages)
+    header = zlib.compress(json.dumps({"n_blocks": n_blocks, "pages": page_index}).encode("utf-8"))
+    return b"".join([OCR_BLOCKS_MAGIC, _HEADER_STRUCT.pack(OCR_BLOCKS_VERSION, len(header)), header] +
+                    [segment for _, segment, _ in pages])
+
+def encode_ocr_blocks(blocks: List[Dict[str, Any]]) -> bytes:
+    """
+    Encode Textract blocks in the compact format.
+
+    Blocks are grouped by page, in order of first appearance of the page, and
+    keep their order within the page.
+
+    Args:
+        blocks: Textract blocks
+
+    Returns:
+        bytes: The encoded blocks
+    """
+    pages = {}
+    for block in blocks:
+        pages.setdefault(block.get("Page", 0), []).append(block)
+
+    return join_ocr_pages([(page, _encode_page(page_blocks), len(page_blocks))
+                           for page, page_blocks in pages.items()])
+
+class CompactOcrBlocks:
+    """
+    OCR blocks in the compact format, decoded one page at a time on demand.
+    """
+    def __init__(self, data: bytes):
+        if not is_compact_ocr_blocks(data):
+            raise ValueError("Not compact OCR blocks")
+        start = len(OCR_BLOCKS_MAGIC)
+        version, header_len = _HEADER_STRUCT.unpack_from(data, start)
+        if version != OCR_BLOCKS_VERSION:
+            raise ValueError(f"Unsupported compact OCR blocks version: {version}")
+        start += _HEADER_STRUCT.size
+        header = json.loads(zlib.decompress(data[start:start + header_len]))
+
+        self._data = data
+        self._body_start = start + header_len
+        self._pages = {page: (offset, length) for page, offset, length, _ in header["pages"]}
+        self._page_order = [page for page, _, _, _ in header["pages"]]
+        self.n_blocks = header["n_blocks"]
+
+    @property
+    def pages(self) -> List[int]:
+        """
+        The 1-based page numbers holding blocks, in storage order. Page 0 holds
+        the blocks without a page.
+        """
+        return list(self._page_order)
+
+    def get_page_blocks(self, page: int) -> List[Dict[str, Any]]:
+        """
+        Decode the blocks of one page.
+
+        Args:
+            page: The 1-based page number
+
+        Returns:
+            List[Dict]: The Textract blocks of the page, empty if it has none
+        """
+        if page not in self._pages:
+            return []
+        offset, length = self._pages[page]
+        start = self._body_start + offset
+        return _decode_page(self._data[start:start + length], page)
+
+    def get_blocks(self, pages: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+        """
+        Decode the blocks of some or all pages.
+
+        Args:
+            pages: The 1-based page numbers. If None, decode all pages.
+
+        Returns:
+            List[Dict]: The Textract blocks
+        """
+        if pages is None:
+            pages = self._page_order
+        blocks = []
+        for page in pages:
+            blocks.extend(self.get_page_blocks(page))
+        return blocks
+
+def decode_ocr_blocks(data: bytes, pages: Optional[List[int]] = None) -> List[Dict[str, Any]]:
+    """
+    Decode Textract blocks from the compact format.
+
+    Args:
+        data: The encoded blocks
+        pages: Optional 1-based page numbers to decode. If None, decode all pages.
+
+    Returns:
+        List[Dict]: The Textract blocks
+    """
+    return CompactOcrBlocks(data).get_blocks(pages)
@@ -0,0 +1,228 @@
+from datetime import datetime, UTC
+import hashlib
+import os
+from typing import Optional, List
+from pymongo import ReturnDocument
+import analytiq_data as ad
+import logging
+
+logger = logging.getLogger(__name__)
+
+# OCR blocks cached by PDF content, one document per cache key:
+#   {_id: key, sha256, organization_id, blob_key, ref_count, created_at, last_used_at}
+# The blocks are stored once, in the OCR bucket under blob_key.
+OCR_CACHE_COLLECTION = "ocr_cache"
+
+# The cache entry used by each document: {_id: document_id, key}
+OCR_CACHE_REFS_COLLECTION = "ocr_cache_refs"
+
+# Sharing of the OCR cache:
+#   "organization": documents share OCR results within their organization
+#   "global": documents share OCR results across organizations
+#   "off": no cache, each document is OCRed
+OCR_CACHE_SCOPE_ORGANIZATION = "organization"
+OCR_CACHE_SCOPE_GLOBAL = "global"
+OCR_CACHE_SCOPE_OFF = "off"
+OCR_CACHE_SCOPE = os.getenv("OCR_CACHE_SCOPE", OCR_CACHE_SCOPE_ORGANIZATION)
+
+def get_pdf_sha256(blob: bytes) -> str:
+    """
+    Get the fingerprint of a PDF
+
+    Args:
+        blob : bytes
+            The PDF
+
+    Returns:
+        str
+            SHA-256 of the PDF, as hex
+    """
+    return hashlib.sha256(blob).hexdigest()
+
+def get_ocr_cache_key(pdf_sha256: str, organization_id: str, scope: str = None) -> Optional[str]:
+    """
+    Get the OCR cache key of a PDF. The key includes the OCR engine, so that
+    the results of different engines are not mixed.
+
+    Args:
+        pdf_sha256 : str
+            SHA-256 of the PDF
+        organization_id : str
+            Organization of the document
+        scope : str
+            Sharing of the cache. Defaults to OCR_CACHE_SCOPE.
+
+    Returns:
+        str
+            The cache key, None if the cache is off or the PDF has no fingerprint
+    """
+    scope = scope or OCR_CACHE_SCOPE
+    if scope == OCR_CACHE_SCOPE_OFF or not pdf_sha256:
+        return None
+    if scope == OCR_CACHE_SCOPE_GLOBAL:
+        return f"{ad.ocr.OCR_ENGINE}:{pdf_sha256}"
+    if scope == OCR_CACHE_SCOPE_ORGANIZATION:
+        return f"{ad.ocr.OCR_ENGINE}:{organization_id}:{pdf_sha256}"
+    raise ValueError(f"Invalid OCR cache scope: {scope}")
+
+async def get_cached_ocr_json(analytiq_client, key: str, pages: Optional[List[int]] = None) -> Optional[list]:
+    """
+    Get cached OCR blocks
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        key : str
+            The cache key
+        pages : list
+            1-based page numbers. If None, return the blocks of all pages.
+
+    Returns:
+        list
+            Textract blocks, None on a cache miss
+    """
+    db = ad.common.get_async_db(analytiq_client)
+    entry = await db[OCR_CACHE_COLLECTION].find_one({"_id": key}, {"blob_key": 1})
+    if entry is None:
+        return None
+    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket=ad.common.OCR_BUCKET, key=entry["blob_key"])
+    if blob is None:
+        # Removed since the lookup
+        return None
+    return ad.common.decode_ocr_blocks(blob["blob"], pages)
+
+async def save_ocr_cache(analytiq_client, key: str, ocr_json, document_id: str,
+                         pdf_sha256: str = None, organization_id: str = None):
+    """
+    Save OCR blocks in the cache, replacing any cached blocks of the key, and
+    make the document they were produced for use the entry
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        key : str
+            The cache key
+        ocr_json : list or bytes
+            Textract blocks, or blocks already encoded in the compact format
+        document_id : str
+            document id
+        pdf_sha256 : str
+            SHA-256 of the PDF
+        organization_id : str
+            Organization of the document, recorded for auditing
+    """
+    db = ad.common.get_async_db(analytiq_client)
+
+    # Each save uses a new blob, so that a concurrent cleanup of the entry
+    # never removes it
+    blob_key = f"cache_{pdf_sha256 or 'none'}_{ad.common.create_id()}"
+    ocr_bytes = ocr_json if isinstance(ocr_json, bytes) else ad.common.encode_ocr_blocks(ocr_json)
+    await ad.mongodb.save_blob_async(analytiq_client, bucket=ad.common.OCR_BUCKET, key=blob_key, blob=ocr_bytes,
+                                     metadata={"format": ad.common.OCR_BLOCKS_FORMAT, "cache_key": key})
+
+    # The entry is created with the reference of the document, so that it is
+    # never left unreferenced if the worker stops before linking it
+    now = datetime.now(UTC)
+    previous = await db[OCR_CACHE_COLLECTION].find_one_and_update(
+        {"_id": key},
+        {
+            "$set": {"blob_key": blob_key, "sha256": pdf_sha256, "organization_id": organization_id,
+                     "created_at": now, "last_used_at": now},
+            "$inc": {"ref_count": 1}
+        },
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is not None and previous.get("blob_key") != blob_key:
+        await ad.mongodb.delete_blob_async(analytiq_client, bucket=ad.common.OCR_BUCKET, key=previous["blob_key"])
+    await _swap_ocr_cache_ref(analytiq_client, document_id, key)
+    logger.info(f"OCR cache entry {key} has been saved: {len(ocr_bytes) / 1024 / 1024:.2f}MB")
+
+async def link_ocr_cache(analytiq_client, document_id: str, key: str) -> bool:
+    """
+    Make a document use a cache entry, counting the reference
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+        key : str
+            The cache key
+
+    Returns:
+        bool
+            False if the entry does not exist, e.g. because it was just cleaned up
+    """
+    db = ad.common.get_async_db(analytiq_client)
+
+    # Count the reference before pointing the document at the entry, so that
+    # the entry cannot be cleaned up in between
+    result = await db[OCR_CACHE_COLLECTION].update_one(
+        {"_id": key},
+        {"$inc": {"ref_count": 1}, "$set": {"last_used_at": datetime.now(UTC)}}
+    )
+    if result.matched_count == 0:
+        return False
+    await _swap_ocr_cache_ref(analytiq_client, document_id, key)
+    return True
+
+async def _swap_ocr_cache_ref(analytiq_client, document_id: str, key: str):
+    """
+    Point a document at a cache entry whose reference was just counted
+    """
+    db = ad.common.get_async_db(analytiq_client)
+
+    # Swap the reference atomically, so that concurrent runs for the same
+    # document count it once
+    previous = await db[OCR_CACHE_REFS_COLLECTION].find_one_and_update(
+        {"_id": document_id},
+        {"$set": {"key": key}},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    if previous is not None:
+        # Already counted if the document used the entry, otherwise drop its old entry
+        await _release_ocr_cache_entry(analytiq_client, previous["key"])
+
+async def release_ocr_cache(analytiq_client, document_id: str):
+    """
+    Drop the reference of a document to its cache entry, removing the entry
+    once no document uses it
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+    """
+    db = ad.common.get_async_db(analytiq_client)
+    ref = await db[OCR_CACHE_REFS_COLLECTION].find_one_and_delete({"_id": document_id})
+    if ref is not None:
+        await _release_ocr_cache_entry(analytiq_client, ref["key"])
+
+async def _release_ocr_cache_entry(analytiq_client, key: str):
+    db = ad.common.get_async_db(analytiq_client)
+    await db[OCR_CACHE_COLLECTION].update_one({"_id": key}, {"$inc": {"ref_count": -1}})
+    entry = await db[OCR_CACHE_COLLECTION].find_one_and_delete({"_id": key, "ref_count": {"$lte": 0}})
+    if entry is not None:
+        await ad.mongodb.delete_blob_async(analytiq_client, bucket=ad.common.OCR_BUCKET, key=entry["blob_key"])
+        logger.info(f"OCR cache entry {key} is no longer used and has been deleted.")
+
+async def get_ocr_cache_key_of_doc(analytiq_client, document_id: str) -> Optional[str]:
+    """
+    Get the cache entry used by a document
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        document_id : str
+            document id
+
+    Returns:
+        str
+            The cache key, None if the document does not use the cache
+    """
+    db = ad.common.get_async_db(analytiq_client)
+    ref = await db[OCR_CACHE_REFS_COLLECTION].find_one({"_id": document_id})
+    return ref["key"] if ref is not None else None
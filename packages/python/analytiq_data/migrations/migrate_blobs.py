@@ -0,0 +1,51 @@
+#! /usr/bin/env python3
+
+import sys
+import asyncio
+import argparse
+
+import analytiq_data as ad
+
+async def migrate_blobs(env: str, buckets: list, source: str, target: str, delete_source: bool, overwrite: bool) -> None:
+    """
+    Copy the blobs of buckets from one blob store to another.
+
+    Args:
+        env: Environment, i.e. MongoDB database name
+        buckets: Buckets to copy
+        source: Source store: "gridfs", "local" or "s3"
+        target: Target store: "gridfs", "local" or "s3"
+        delete_source: If True, delete the blobs from the source store once copied
+        overwrite: If True, copy the blobs that are already in the target store again
+    """
+    analytiq_client = ad.common.get_analytiq_client(env=env)
+    for bucket in buckets:
+        print(f"Copying bucket '{bucket}' from {source} to {target}")
+        n_copied = await ad.mongodb.migrate_blobs_async(analytiq_client, bucket, source, target,
+                                                        delete_source=delete_source, overwrite=overwrite)
+        print(f"✓ Copied {n_copied} blobs")
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Copy blobs between blob stores. Run it before switching BLOB_STORE or BLOB_STORES '
+                    'to the target store, and once more after switching, to pick up the blobs saved meanwhile.'
+    )
+    parser.add_argument('--env', help='Environment (defaults to ENV)')
+    parser.add_argument('--bucket', action='append', help='Bucket to copy, can be repeated (defaults to files and ocr)')
+    parser.add_argument('--source', required=True, choices=list(ad.mongodb.BLOB_STORE_CLASSES), help='Source blob store')
+    parser.add_argument('--target', required=True, choices=list(ad.mongodb.BLOB_STORE_CLASSES), help='Target blob store')
+    parser.add_argument('--delete-source', action='store_true', help='Delete the blobs from the source store once copied')
+    parser.add_argument('--overwrite', action='store_true', help='Copy the blobs already in the target store again')
+
+    args = parser.parse_args()
+
+    if args.source == args.target:
+        print("Error: Source and target stores must be different")
+        sys.exit(1)
+
+    buckets = args.bucket or ["files", ad.common.OCR_BUCKET]
+    asyncio.run(migrate_blobs(args.env, buckets, args.source, args.target, args.delete_source, args.overwrite))
+
+if __name__ == "__main__":
+    ad.common.setup()
+    main()
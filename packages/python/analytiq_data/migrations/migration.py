@@ -1971,6 +1971,37 @@ class AddClaudeLogsUuidIndex(Migration):
             logger.error(f"Failed to drop index org_uuid_compound on claude_logs: {e}")
             return False
 
+class AddQueueFinishedAt(Migration):
+    def __init__(self):
+        super().__init__(description="Set finished_at on completed and failed queue messages, so they expire")
+
+    async def up(self, db) -> bool:
+        """Backfill finished_at from created_at, so the existing backlog expires by TTL."""
+        try:
+            for queue_name in ["ocr", "llm"]:
+                result = await db[f"queues.{queue_name}"].update_many(
+                    {"status": {"$in": ["completed", "failed"]}, "finished_at": {"$exists": False}},
+                    [{"$set": {"finished_at": "$created_at"}}]
+                )
+                logger.info(f"Set finished_at on {result.modified_count} messages in queues.{queue_name}")
+            return True
+        except Exception as e:
+            logger.error(f"Queue finished_at migration failed: {e}")
+            return False
+
+    async def down(self, db) -> bool:
+        """Remove finished_at from the queue messages."""
+        try:
+            for queue_name in ["ocr", "llm"]:
+                await db[f"queues.{queue_name}"].update_many(
+                    {"finished_at": {"$exists": True}},
+                    {"$unset": {"finished_at": ""}}
+                )
+            return True
+        except Exception as e:
+            logger.error(f"Queue finished_at migration revert failed: {e}")
+            return False
+
 # List of all migrations in order
 MIGRATIONS = [
     OcrKeyMigration(),
@@ -1999,6 +2030,7 @@ MIGRATIONS = [
     AddAccessTokenUniquenessIndex(),
     RenameClaudeLogsToClaudeHooks(),
     AddClaudeLogsUuidIndex(),
+    AddQueueFinishedAt(),
     # Add more migrations here
 ]
 
@@ -1,3 +1,9 @@
 from .client import *
+from .blob_store import *
+from .blob_gridfs import *
+from .blob_local import *
+from .blob_s3 import *
+from .blob_cache import *
+from .blob_codec import *
 from .blob import *
-from .index import ensure_index
\ No newline at end of file
+from .index import ensure_index
@@ -1,19 +1,49 @@
-import gridfs
-from datetime import datetime, UTC
-import os
-import time
-import asyncio
-from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from typing import AsyncIterator, Optional
 import logging
 
 import analytiq_data as ad
+from .blob_store import BlobStore, get_blob_store_name, wait_blob_revision_gc
+from .blob_cache import blob_cache, BLOB_CACHE_OFF, BLOB_CACHE_VALIDATE
+from .blob_codec import BLOB_CODEC_KEY, encode_blob, decode_blob, decode_info, decode_length, decode_metadata, iter_decoded
+from .blob_gridfs import GridFSBlobStore
+from .blob_local import LocalBlobStore
+from .blob_s3 import S3BlobStore
 
 logger = logging.getLogger(__name__)
 
+# Blob stores by name
+BLOB_STORE_CLASSES = {
+    GridFSBlobStore.name: GridFSBlobStore,
+    LocalBlobStore.name: LocalBlobStore,
+    S3BlobStore.name: S3BlobStore,
+}
+
+def get_blob_store(analytiq_client, bucket: str, store_name: str = None) -> BlobStore:
+    """
+    Get the store of a bucket
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        bucket : str
+            bucket name
+        store_name : str
+            "gridfs", "local" or "s3". Defaults to the store configured for the bucket
+            with BLOB_STORES or BLOB_STORE.
+
+    Returns:
+        BlobStore
+            The store
+    """
+    store_name = store_name or get_blob_store_name(bucket)
+    if store_name not in BLOB_STORE_CLASSES:
+        raise ValueError(f"Invalid blob store for bucket {bucket}: {store_name}")
+    return BLOB_STORE_CLASSES[store_name](analytiq_client, bucket)
+
 async def get_blob_async(analytiq_client, bucket: str, key: str) -> dict:
     """
     Get the file asynchronously
-    
+
     Args:
         analytiq_client: AnalytiqClient
             The analytiq client
@@ -26,35 +56,99 @@ async def get_blob_async(analytiq_client, bucket: str, key: str) -> dict:
         dict
             {"blob": bytes, "metadata": dict, "upload_date": datetime}
     """
-    # Get the provider db
-    mongo = analytiq_client.mongodb_async
-    db_name = analytiq_client.env
-    db = mongo[db_name]
-    collection = db[f"{bucket}.files"]
-
-    # Get the doc metadata
-    elem = await collection.find_one({"filename": key})
-    if elem is None:
-        return None
-    metadata = elem.get("metadata", None)
-    upload_date = elem.get("uploadDate", None)
-
-    # Get the blob
-    fs_bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket)
-    elem = await fs_bucket.open_download_stream_by_name(key)
-    blob = await elem.read()
-
-    blob_dict = {
-        "blob": blob,
-        "metadata": metadata,
-        "upload_date": upload_date
-    }
-    return blob_dict
+    store = get_blob_store(analytiq_client, bucket)
+
+    async def load():
+        return await decode_blob(await store.get(key))
+
+    policy = blob_cache.get_policy(bucket)
+    if policy == BLOB_CACHE_OFF:
+        return await load()
+
+    file_id = None
+    if policy == BLOB_CACHE_VALIDATE:
+        # The blob may have been saved again by another process
+        info = await store.get_info(key)
+        if info is None:
+            blob_cache.invalidate(analytiq_client.env, bucket, key)
+            return None
+        file_id = info["file_id"]
+    return await blob_cache.get(analytiq_client.env, bucket, key, file_id, load)
+
+async def get_blob_info_async(analytiq_client, bucket: str, key: str) -> Optional[dict]:
+    """
+    Get the size and metadata of a blob, without reading it
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        bucket : str
+            bucket name
+        key : str
+            blob key
+
+    Returns:
+        dict
+            {"file_id": str, "length": int, "chunk_size": int, "metadata": dict, "upload_date": datetime},
+            None if not found. file_id changes whenever the blob is saved again.
+    """
+    return decode_info(await get_blob_store(analytiq_client, bucket).get_info(key))
+
+def iter_blob_async(analytiq_client, bucket: str, key: str,
+                    start: int = 0, end: Optional[int] = None,
+                    file_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    """
+    Read a blob piece by piece, holding one piece in memory at a time
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        bucket : str
+            bucket name
+        key : str
+            blob key
+        start : int
+            offset of the first byte to read
+        end : int
+            offset after the last byte to read. If None, read to the end of the blob.
+        file_id : str
+            file id, from get_blob_info_async(). If set, read that version of the
+            blob, so that the bytes match the info even if the blob is saved again meanwhile.
+
+    Returns:
+        AsyncIterator[bytes]
+            The pieces of the blob, in order
+
+    Raises:
+        FileNotFoundError: If the blob does not exist
+    """
+    return _iter_blob(get_blob_store(analytiq_client, bucket), key, start, end, file_id)
+
+async def _iter_blob(store: BlobStore, key: str, start: int, end: Optional[int],
+                     file_id: Optional[str]) -> AsyncIterator[bytes]:
+    info = await store.get_info(key, file_id=file_id)
+    if info is None:
+        raise FileNotFoundError(f"Blob {store.bucket}/{key} not found")
+    if BLOB_CODEC_KEY not in (info["metadata"] or {}):
+        async for chunk in store.iter(key, start=start, end=end, file_id=info["file_id"]):
+            yield chunk
+        return
+
+    # A compressed blob is decompressed from its start, up to the end of the range
+    async for chunk in iter_decoded(store.iter(key, file_id=info["file_id"]), info["metadata"], start, end):
+        yield chunk
 
 async def save_blob_async(analytiq_client, bucket: str, key: str, blob: bytes, metadata: dict, chunk_size_bytes: int = 8*1024*1024):
     """
-    Save the file asynchronously
-    
+    Save the file asynchronously.
+
+    The blob is saved as a new revision, which replaces the previous one
+    atomically once it is complete: readers see either the previous or the
+    new revision, never a partial one. The previous revisions are deleted
+    in the background.
+
+    The blob is compressed if its bucket has a codec in BLOB_COMPRESSION.
+
     Args:
         analytiq_client: AnalytiqClient
             The analytiq client
@@ -67,29 +161,17 @@ async def save_blob_async(analytiq_client, bucket: str, key: str, blob: bytes, m
         metadata : dict
             blob metadata
         chunk_size_bytes : int
-            chunk size in bytes (default: 1MB)
-    """
-    # Get the db
-    mongo = analytiq_client.mongodb_async
-    db_name = analytiq_client.env
-    db = mongo[db_name]
-    
-    # Delete the old blob
-    await delete_blob_async(analytiq_client, bucket, key)
-
-    # Create a new GridFS bucket with smaller chunk size
-    fs_bucket = AsyncIOMotorGridFSBucket(
-        db, 
-        bucket_name=bucket,
-        chunk_size_bytes=chunk_size_bytes  # Use smaller chunks
-    )
-    
-    logger.debug(f"Uploading blob {bucket}/{key} to mongodb with chunk size {chunk_size_bytes/1024/1024:.2f}MB")
-    await fs_bucket.upload_from_stream(filename=key, source=blob, metadata=metadata)
+            GridFS chunk size in bytes (default: 8MB)
+    """
+    data, stored_metadata = await encode_blob(bucket, blob, metadata)
+    try:
+        await get_blob_store(analytiq_client, bucket).save(key, data, stored_metadata, chunk_size_bytes=chunk_size_bytes)
+    finally:
+        blob_cache.invalidate(analytiq_client.env, bucket, key)
 
 async def delete_blob_async(analytiq_client, bucket:str, key:str):
     """
-    Delete the blob asynchronously
+    Delete the blob asynchronously, with all its revisions
 
     Args:
         analytiq_client: AnalytiqClient
@@ -99,44 +181,84 @@ async def delete_blob_async(analytiq_client, bucket:str, key:str):
         key : str
             blob key
     """
-    # Get the db
-    mongo = analytiq_client.mongodb_async
-    db_name = analytiq_client.env
-    db = mongo[db_name]
-    fs_bucket = AsyncIOMotorGridFSBucket(db, bucket_name=bucket)
-
-    # Remove the old blob with retry logic
-    max_retries = 3
-    retry_delay = 2
-    
-    for attempt in range(max_retries):
-        try:
-            # First, find the file document to get the _id
-            files_collection = db[f"{bucket}.files"]
-            file_docs = await files_collection.find({"filename": key}).to_list(length=None)
-            
-            if file_docs:
-                for file_doc in file_docs:
-                    # Delete using the _id from the file document
-                    logger.debug(f"Deleting blob {bucket}/{key} with _id {file_doc['_id']}")
-                    await fs_bucket.delete(file_doc["_id"])
-                
-                logger.debug(f"Blob {bucket}/{key} has been deleted.")
-                
-                # Verify deletion is complete
-                verification_attempts = 3
-                for _ in range(verification_attempts):
-                    check_docs = await files_collection.find({"filename": key}).to_list(length=None)
-                    if not check_docs:
-                        break
-                    await asyncio.sleep(retry_delay)
-                else:
-                    raise Exception(f"Failed to verify blob deletion for {bucket}/{key}")
-                
-            break  # Exit retry loop if successful
-        except Exception as e:
-            if attempt == max_retries - 1:
-                logger.error(f"Failed to delete blob {bucket}/{key} after {max_retries} attempts: {e}")
-                raise
-            logger.warning(f"Retry {attempt + 1}/{max_retries} for deleting {bucket}/{key}: {e}")
-            await asyncio.sleep(retry_delay)
\ No newline at end of file
+    try:
+        await get_blob_store(analytiq_client, bucket).delete(key)
+    finally:
+        blob_cache.invalidate(analytiq_client.env, bucket, key)
+
+def list_blobs_async(analytiq_client, bucket: str, filter: dict = None, limit: int = 0) -> AsyncIterator[dict]:
+    """
+    List the blobs of a bucket
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        bucket : str
+            bucket name
+        filter : dict
+            MongoDB filter on "key" and "metadata", e.g. {"key": {"$regex": "_json$"}}
+        limit : int
+            Maximum number of blobs to list, 0 for all
+
+    Returns:
+        AsyncIterator[dict]
+            {"key", "length", "metadata", "upload_date"} of each blob
+    """
+    return _list_blobs(get_blob_store(analytiq_client, bucket), filter, limit)
+
+async def _list_blobs(store: BlobStore, filter: Optional[dict], limit: int) -> AsyncIterator[dict]:
+    async for elem in store.list(filter, limit):
+        yield {
+            **elem,
+            "length": decode_length(elem["length"], elem["metadata"]),
+            "metadata": decode_metadata(elem["metadata"])
+        }
+
+async def migrate_blobs_async(analytiq_client, bucket: str, source: str, target: str,
+                              delete_source: bool = False, overwrite: bool = False) -> int:
+    """
+    Copy the blobs of a bucket from one store to another. Blobs already in
+    the target store are skipped, so that the copy can be run again to pick
+    up the blobs saved in the source store meanwhile. Compressed blobs are
+    copied as they are stored.
+
+    Args:
+        analytiq_client: AnalytiqClient
+            The analytiq client
+        bucket : str
+            bucket name
+        source : str
+            Source store: "gridfs", "local" or "s3"
+        target : str
+            Target store: "gridfs", "local" or "s3"
+        delete_source : bool
+            Delete the blobs from the source store once copied
+        overwrite : bool
+            Copy the blobs that are already in the target store again
+
+    Returns:
+        int
+            Number of copied blobs
+    """
+    if source == target:
+        raise ValueError(f"The source and target stores are the same: {source}")
+    source_store = get_blob_store(analytiq_client, bucket, source)
+    target_store = get_blob_store(analytiq_client, bucket, target)
+
+    n_copied = 0
+    async for info in source_store.list():
+        key = info["key"]
+        if overwrite or await target_store.get_info(key) is None:
+            blob = await source_store.get(key)
+            if blob is None:
+                # Deleted meanwhile
+                continue
+            await target_store.save(key, blob["blob"], blob["metadata"])
+            blob_cache.invalidate(analytiq_client.env, bucket, key)
+            n_copied += 1
+            logger.info(f"Copied blob {bucket}/{key} from {source} to {target}: {len(blob['blob']) / 1024 / 1024:.2f}MB")
+        if delete_source:
+            await source_store.delete(key)
+
+    await wait_blob_revision_gc()
+    return n_copied
@@ -0,0 +1,212 @@
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Maximum total size of the blobs cached in memory, per process. 0 disables the cache.
+BLOB_CACHE_MAX_BYTES = int(os.getenv("BLOB_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Larger blobs are not cached
+BLOB_CACHE_MAX_BLOB_BYTES = int(os.getenv("BLOB_CACHE_MAX_BLOB_BYTES", str(32 * 1024 * 1024)))
+
+# Cache policies:
+#   "immutable": cached blobs are served as is. For buckets whose blobs are
+#                never overwritten, e.g. uploaded files.
+#   "validate": cached blobs are served after checking, with a metadata lookup,
+#               that they are still the latest revision. For buckets whose blobs
+#               may be overwritten by other processes, e.g. OCR results.
+#   "off": blobs are not cached
+BLOB_CACHE_IMMUTABLE = "immutable"
+BLOB_CACHE_VALIDATE = "validate"
+BLOB_CACHE_OFF = "off"
+
+# Cache policy per bucket, "off" for the buckets not listed
+BLOB_CACHE_POLICIES = os.getenv("BLOB_CACHE_POLICIES", "files=immutable,ocr=validate")
+
+class _CacheEntry:
+    def __init__(self, file_id: Optional[str], blob: dict, size: int):
+        self.file_id = file_id
+        self.blob = blob
+        self.size = size
+
+def _copy_blob(blob: dict) -> dict:
+    # The bytes are shared, the rest is copied so that callers may modify it
+    metadata = blob.get("metadata")
+    return {**blob, "metadata": dict(metadata) if isinstance(metadata, dict) else metadata}
+
+class BlobCache:
+    """
+    In-process LRU cache of blobs, bounded by their total size
+    """
+    def __init__(self, max_bytes: int = None, max_blob_bytes: int = None, policies: str = None):
+        self.max_bytes = BLOB_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_blob_bytes = BLOB_CACHE_MAX_BLOB_BYTES if max_blob_bytes is None else max_blob_bytes
+        self.policies = {}
+        for item in (BLOB_CACHE_POLICIES if policies is None else policies).split(","):
+            bucket, sep, policy = item.partition("=")
+            if sep:
+                policy = policy.strip()
+                if policy not in (BLOB_CACHE_IMMUTABLE, BLOB_CACHE_VALIDATE, BLOB_CACHE_OFF):
+                    raise ValueError(f"Invalid blob cache policy for bucket {bucket}: {policy}")
+                self.policies[bucket.strip()] = policy
+        self.n_bytes = 0
+        self._entries = OrderedDict()
+        # Loads in flight, shared by concurrent readers of the same blob.
+        # Invalidations remove them, so that their blobs are not cached.
+        self._loading = {}
+        self._stats = {}
+
+    def get_policy(self, bucket: str) -> str:
+        """
+        Get the cache policy of a bucket
+
+        Returns:
+            str
+                "immutable", "validate" or "off"
+        """
+        if self.max_bytes <= 0:
+            return BLOB_CACHE_OFF
+        return self.policies.get(bucket, BLOB_CACHE_OFF)
+
+    def _get_stats(self, bucket: str) -> dict:
+        return self._stats.setdefault(bucket, {"hits": 0, "misses": 0, "bytes_served": 0, "evictions": 0})
+
+    async def get(self, env: str, bucket: str, key: str, file_id: Optional[str],
+                  load: Callable[[], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        """
+        Get a blob from the cache, loading it on a miss
+
+        Args:
+            env : str
+                Environment of the blob
+            bucket : str
+                bucket name
+            key : str
+                blob key
+            file_id : str
+                Latest revision of the blob, for the "validate" policy. None to serve
+                any cached revision.
+            load : Callable
+                Coroutine function loading the blob, {"blob", "metadata", "upload_date"}, or None
+
+        Returns:
+            dict
+                {"blob": bytes, "metadata": dict, "upload_date": datetime}, None if not found
+        """
+        cache_key = (env, bucket, key)
+        stats = self._get_stats(bucket)
+        entry = self._entries.get(cache_key)
+        if entry is not None and (file_id is None or entry.file_id == file_id):
+            self._entries.move_to_end(cache_key)
+            stats["hits"] += 1
+            stats["bytes_served"] += entry.size
+            return _copy_blob(entry.blob)
+        stats["misses"] += 1
+
+        loop = asyncio.get_running_loop()
+        loading_key = (cache_key, file_id, id(loop))
+        future = self._loading.get(loading_key)
+        if future is None:
+            future = loop.create_future()
+            self._loading[loading_key] = future
+            try:
+                blob = await load()
+            except asyncio.CancelledError:
+                self._end_loading(loading_key, future)
+                # The readers waiting for this load load the blob themselves
+                future.cancel()
+                raise
+            except BaseException as e:
+                self._end_loading(loading_key, future)
+                future.set_exception(e)
+                # Retrieved, so that the exception is not reported as unhandled when no one else waits
+                future.exception()
+                raise
+            if self._end_loading(loading_key, future) and blob is not None:
+                self._put(cache_key, file_id, blob)
+            future.set_result(blob)
+            return _copy_blob(blob) if blob is not None else None
+
+        try:
+            blob = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                # This reader is cancelled
+                raise
+            return await self.get(env, bucket, key, file_id, load)
+        return _copy_blob(blob) if blob is not None else None
+
+    def _end_loading(self, loading_key: tuple, future: asyncio.Future) -> bool:
+        """Unregister a load, returning False if it was invalidated meanwhile"""
+        if self._loading.get(loading_key) is not future:
+            return False
+        del self._loading[loading_key]
+        return True
+
+    def _put(self, cache_key: tuple, file_id: Optional[str], blob: dict):
+        size = len(blob["blob"])
+        if size > self.max_blob_bytes or size > self.max_bytes:
+            return
+        previous = self._entries.pop(cache_key, None)
+        if previous is not None:
+            self.n_bytes -= previous.size
+        self._entries[cache_key] = _CacheEntry(file_id, blob, size)
+        self.n_bytes += size
+        while self.n_bytes > self.max_bytes:
+            (_, bucket, _), evicted = self._entries.popitem(last=False)
+            self.n_bytes -= evicted.size
+            self._get_stats(bucket)["evictions"] += 1
+
+    def invalidate(self, env: str, bucket: str, key: str):
+        """
+        Drop a blob from the cache, and ignore the loads of it in flight
+        """
+        cache_key = (env, bucket, key)
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            self.n_bytes -= entry.size
+        for loading_key in [loading_key for loading_key in self._loading if loading_key[0] == cache_key]:
+            del self._loading[loading_key]
+
+    def clear(self):
+        """
+        Drop all the blobs and the stats
+        """
+        self._entries.clear()
+        self._loading.clear()
+        self._stats.clear()
+        self.n_bytes = 0
+
+    def get_stats(self) -> dict:
+        """
+        Get the cache stats
+
+        Returns:
+            dict
+                {"bytes", "max_bytes", "entries",
+                 "buckets": {bucket: {"hits", "misses", "bytes_served", "evictions"}}}
+        """
+        return {
+            "bytes": self.n_bytes,
+            "max_bytes": self.max_bytes,
+            "entries": len(self._entries),
+            "buckets": {bucket: dict(stats) for bucket, stats in self._stats.items()}
+        }
+
+# The blob cache of the process
+blob_cache = BlobCache()
+
+def get_blob_cache_stats() -> dict:
+    """
+    Get the stats of the blob cache of the process: hits, misses, bytes served
+    from the cache and evictions per bucket, and the cache size
+
+    Returns:
+        dict
+            {"bytes", "max_bytes", "entries",
+             "buckets": {bucket: {"hits", "misses", "bytes_served", "evictions"}}}
+    """
+    return blob_cache.get_stats()
@@ -0,0 +1,253 @@
+import asyncio
+import os
+import zlib
+from typing import AsyncIterator, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Compression codec per bucket, e.g. "ocr=zstd,files=zlib". Blobs of the
+# buckets not listed are stored as is. zstd needs the zstandard package.
+BLOB_COMPRESSION = os.getenv("BLOB_COMPRESSION", "")
+
+# Smaller blobs are stored as is
+BLOB_COMPRESSION_MIN_BYTES = int(os.getenv("BLOB_COMPRESSION_MIN_BYTES", "1024"))
+
+# Blobs which do not compress below this ratio, such as PDFs or compact OCR
+# blocks, are stored as is
+BLOB_COMPRESSION_MAX_RATIO = float(os.getenv("BLOB_COMPRESSION_MAX_RATIO", "0.9"))
+
+# Compression levels
+BLOB_ZLIB_LEVEL = int(os.getenv("BLOB_ZLIB_LEVEL", "6"))
+BLOB_ZSTD_LEVEL = int(os.getenv("BLOB_ZSTD_LEVEL", "3"))
+
+# Blob metadata recording the codec and the uncompressed length of the
+# compressed blobs. Blobs without them are not compressed, so that the
+# blobs saved before compression was enabled are read as before.
+BLOB_CODEC_KEY = "blob_codec"
+BLOB_LENGTH_KEY = "blob_length"
+
+# Larger blobs are compressed and decompressed in a thread, not to block the event loop
+_THREAD_MIN_BYTES = 1024 * 1024
+
+def _get_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+class ZlibCodec:
+    name = "zlib"
+
+    def compress(self, blob: bytes) -> bytes:
+        return zlib.compress(blob, BLOB_ZLIB_LEVEL)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+    def decompressobj(self):
+        return zlib.decompressobj()
+
+class ZstdCodec:
+    name = "zstd"
+
+    def __init__(self):
+        self.zstd = _get_zstd()
+        if self.zstd is None:
+            raise ImportError("The zstandard package is needed to use the zstd blob codec")
+
+    def compress(self, blob: bytes) -> bytes:
+        return self.zstd.ZstdCompressor(level=BLOB_ZSTD_LEVEL).compress(blob)
+
+    def decompress(self, data: bytes) -> bytes:
+        # Streaming decompression does not need the content size in the frame header
+        decompressor = self.zstd.ZstdDecompressor().decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    def decompressobj(self):
+        return self.zstd.ZstdDecompressor().decompressobj()
+
+# Blob codecs by name
+BLOB_CODEC_CLASSES = {
+    ZlibCodec.name: ZlibCodec,
+    ZstdCodec.name: ZstdCodec,
+}
+
+_warned_codecs = set()
+
+def get_blob_codec(name: str):
+    """
+    Get a blob codec by name
+
+    Args:
+        name : str
+            "zlib" or "zstd"
+
+    Returns:
+        ZlibCodec or ZstdCodec
+            The codec
+
+    Raises:
+        ValueError: If the codec is unknown
+        ImportError: If the codec is not installed
+    """
+    if name not in BLOB_CODEC_CLASSES:
+        raise ValueError(f"Invalid blob codec: {name}")
+    return BLOB_CODEC_CLASSES[name]()
+
+def get_bucket_codec_name(bucket: str) -> Optional[str]:
+    """
+    Get the name of the codec compressing the blobs of a bucket, from BLOB_COMPRESSION
+
+    Args:
+        bucket : str
+            bucket name
+
+    Returns:
+        str
+            "zlib" or "zstd", None if the blobs of the bucket are not compressed
+    """
+    for item in BLOB_COMPRESSION.split(","):
+        name, sep, codec = item.partition("=")
+        if sep and name.strip() == bucket:
+            return codec.strip() or None
+    return None
+
+async def encode_blob(bucket: str, blob: bytes, metadata: dict) -> tuple:
+    """
+    Compress a blob with the codec of its bucket
+
+    Args:
+        bucket : str
+            bucket name
+        blob : bytes
+            blob
+        metadata : dict
+            blob metadata
+
+    Returns:
+        tuple
+            (bytes, dict): the bytes and metadata to store. The metadata records the
+            codec and the uncompressed length if the blob is compressed.
+    """
+    codec_name = get_bucket_codec_name(bucket)
+    if codec_name is None or len(blob) < BLOB_COMPRESSION_MIN_BYTES:
+        return blob, metadata
+
+    try:
+        codec = get_blob_codec(codec_name)
+    except ImportError as e:
+        if codec_name not in _warned_codecs:
+            _warned_codecs.add(codec_name)
+            logger.warning(f"{e}, falling back to zlib")
+        codec = ZlibCodec()
+
+    if len(blob) >= _THREAD_MIN_BYTES:
+        data = await asyncio.to_thread(codec.compress, blob)
+    else:
+        data = codec.compress(blob)
+    if len(data) > len(blob) * BLOB_COMPRESSION_MAX_RATIO:
+        # Not worth decompressing on every read
+        return blob, metadata
+    return data, {**(metadata or {}), BLOB_CODEC_KEY: codec.name, BLOB_LENGTH_KEY: len(blob)}
+
+def _get_stored_codec(metadata: Optional[dict]):
+    if not metadata or BLOB_CODEC_KEY not in metadata:
+        return None
+    return get_blob_codec(metadata[BLOB_CODEC_KEY])
+
+def decode_metadata(metadata: Optional[dict]) -> Optional[dict]:
+    """
+    Remove the codec from the metadata of a stored blob
+    """
+    if not metadata or BLOB_CODEC_KEY not in metadata:
+        return metadata
+    return {k: v for k, v in metadata.items() if k not in (BLOB_CODEC_KEY, BLOB_LENGTH_KEY)}
+
+def decode_length(length: int, metadata: Optional[dict]) -> int:
+    """
+    Get the uncompressed length of a stored blob
+    """
+    if not metadata or BLOB_CODEC_KEY not in metadata:
+        return length
+    return metadata[BLOB_LENGTH_KEY]
+
+async def decode_blob(blob: Optional[dict]) -> Optional[dict]:
+    """
+    Decompress a blob read from a store
+
+    Args:
+        blob : dict
+            {"blob": bytes, "metadata": dict, "upload_date": datetime} as stored, or None
+
+    Returns:
+        dict
+            {"blob": bytes, "metadata": dict, "upload_date": datetime} as saved, None if blob is None
+    """
+    if blob is None:
+        return None
+    codec = _get_stored_codec(blob["metadata"])
+    if codec is None:
+        return blob
+    data = blob["blob"]
+    if blob["metadata"][BLOB_LENGTH_KEY] >= _THREAD_MIN_BYTES:
+        data = await asyncio.to_thread(codec.decompress, data)
+    else:
+        data = codec.decompress(data)
+    return {**blob, "blob": data, "metadata": decode_metadata(blob["metadata"])}
+
+def decode_info(info: Optional[dict]) -> Optional[dict]:
+    """
+    Get the uncompressed length and the metadata of a blob from its stored info
+    """
+    if info is None or not info.get("metadata") or BLOB_CODEC_KEY not in info["metadata"]:
+        return info
+    return {
+        **info,
+        "length": decode_length(info["length"], info["metadata"]),
+        "metadata": decode_metadata(info["metadata"])
+    }
+
+async def iter_decoded(chunks: AsyncIterator[bytes], metadata: Optional[dict],
+                       start: int = 0, end: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Decompress a stored blob piece by piece, and keep the range from start to end (exclusive)
+
+    Args:
+        chunks : AsyncIterator[bytes]
+            The pieces of the whole stored blob
+        metadata : dict
+            The stored metadata of the blob, recording its codec
+        start : int
+            offset of the first uncompressed byte to return
+        end : int
+            offset after the last uncompressed byte to return. If None, return up to the end.
+
+    Returns:
+        AsyncIterator[bytes]
+            The uncompressed pieces of the range
+    """
+    decompressor = _get_stored_codec(metadata).decompressobj()
+
+    async def decompress():
+        async for chunk in chunks:
+            yield decompressor.decompress(chunk)
+        yield decompressor.flush()
+
+    offset = 0
+    pieces = decompress()
+    try:
+        async for data in pieces:
+            piece_start = max(start - offset, 0)
+            piece_end = len(data) if end is None else min(end - offset, len(data))
+            offset += len(data)
+            if piece_start < piece_end:
+                yield data[piece_start:piece_end]
+            if end is not None and offset >= end:
+                break
+    finally:
+        # Stop reading the store
+        await pieces.aclose()
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
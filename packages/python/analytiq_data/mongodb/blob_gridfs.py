@@ -0,0 +1,181 @@
+import gridfs
+import asyncio
+from typing import AsyncIterator, Optional
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+import logging
+
+from .blob_store import BlobStore, run_revision_gc
+
+logger = logging.getLogger(__name__)
+
+class GridFSBlobStore(BlobStore):
+    """
+    Blobs stored in MongoDB GridFS, in the {bucket}.files and {bucket}.chunks collections.
+    A blob may have several revisions while the older ones are being deleted;
+    readers use the latest one.
+    """
+    name = "gridfs"
+
+    def __init__(self, analytiq_client, bucket: str):
+        super().__init__(analytiq_client, bucket)
+        self.db = analytiq_client.mongodb_async[analytiq_client.env]
+        self.files = self.db[f"{bucket}.files"]
+
+    async def _find_file(self, key: str) -> Optional[dict]:
+        """
+        Get the GridFS file document of the latest revision of a blob
+        """
+        return await self.files.find_one({"filename": key}, sort=[("uploadDate", -1), ("_id", -1)])
+
+    async def get(self, key: str) -> Optional[dict]:
+        # Get the doc metadata
+        elem = await self._find_file(key)
+        if elem is None:
+            return None
+
+        # Get the blob
+        fs_bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=self.bucket)
+        try:
+            grid_out = await fs_bucket.open_download_stream(elem["_id"])
+        except gridfs.errors.NoFile:
+            # Deleted since the lookup
+            return None
+        blob = await grid_out.read()
+
+        return {
+            "blob": blob,
+            "metadata": elem.get("metadata", None),
+            "upload_date": elem.get("uploadDate", None)
+        }
+
+    async def get_info(self, key: str, file_id: Optional[str] = None) -> Optional[dict]:
+        if file_id is None:
+            elem = await self._find_file(key)
+        else:
+            elem = await self.files.find_one({"_id": ObjectId(file_id), "filename": key})
+        if elem is None:
+            return None
+        return {
+            "file_id": str(elem["_id"]),
+            "length": elem.get("length", 0),
+            "chunk_size": elem.get("chunkSize"),
+            "metadata": elem.get("metadata", None),
+            "upload_date": elem.get("uploadDate", None)
+        }
+
+    async def iter(self, key: str, start: int = 0, end: Optional[int] = None,
+                   file_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        fs_bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=self.bucket)
+        if file_id is None:
+            elem = await self._find_file(key)
+            if elem is None:
+                raise FileNotFoundError(f"Blob {self.bucket}/{key} not found")
+            file_id = elem["_id"]
+        try:
+            grid_out = await fs_bucket.open_download_stream(ObjectId(file_id))
+        except gridfs.errors.NoFile:
+            raise FileNotFoundError(f"Blob {self.bucket}/{key} not found")
+
+        # One GridFS chunk is held in memory at a time
+        if start:
+            grid_out.seek(start)
+        remaining = None if end is None else max(end - start, 0)
+        while remaining is None or remaining > 0:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            if remaining is not None:
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+            yield chunk
+
+    async def save(self, key: str, blob: bytes, metadata: dict, chunk_size_bytes: int = 8*1024*1024):
+        fs_bucket = AsyncIOMotorGridFSBucket(
+            self.db,
+            bucket_name=self.bucket,
+            chunk_size_bytes=chunk_size_bytes
+        )
+
+        logger.debug(f"Uploading blob {self.bucket}/{key} to mongodb with chunk size {chunk_size_bytes/1024/1024:.2f}MB")
+        # GridFS writes the file document after the chunks, so the revision becomes visible whole
+        file_id = await fs_bucket.upload_from_stream(filename=key, source=blob, metadata=metadata)
+        run_revision_gc(self._delete_old_revisions(key, file_id))
+
+    async def _delete_old_revisions(self, key: str, file_id):
+        """
+        Delete the revisions of a blob older than the given one. Newer revisions,
+        saved concurrently, are left to their own cleanup.
+        """
+        fs_bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=self.bucket)
+        try:
+            elem = await self.files.find_one({"_id": file_id}, {"uploadDate": 1})
+            if elem is None:
+                # The blob was deleted meanwhile, with all its revisions
+                return
+            upload_date = elem["uploadDate"]
+            cursor = self.files.find({
+                "filename": key,
+                "$or": [
+                    {"uploadDate": {"$lt": upload_date}},
+                    {"uploadDate": upload_date, "_id": {"$lt": file_id}}
+                ]
+            }, {"_id": 1})
+            async for old in cursor:
+                try:
+                    await fs_bucket.delete(old["_id"])
+                except gridfs.errors.NoFile:
+                    pass
+                logger.debug(f"Deleted revision {old['_id']} of blob {self.bucket}/{key}")
+        except Exception as e:
+            # Left over revisions are hidden by the latest one, and deleted by the next save
+            logger.warning(f"Failed to delete old revisions of blob {self.bucket}/{key}: {e}")
+
+    async def delete(self, key: str):
+        fs_bucket = AsyncIOMotorGridFSBucket(self.db, bucket_name=self.bucket)
+
+        # Remove the blob with retry logic
+        max_retries = 3
+        retry_delay = 2
+
+        for attempt in range(max_retries):
+            try:
+                # GridFS deletes the file document first, so a deleted revision is no longer readable
+                async for file_doc in self.files.find({"filename": key}, {"_id": 1}):
+                    logger.debug(f"Deleting blob {self.bucket}/{key} with _id {file_doc['_id']}")
+                    try:
+                        await fs_bucket.delete(file_doc["_id"])
+                    except gridfs.errors.NoFile:
+                        # Deleted concurrently
+                        pass
+                logger.debug(f"Blob {self.bucket}/{key} has been deleted.")
+                break  # Exit retry loop if successful
+            except Exception as e:
+                if attempt == max_retries - 1:
+                    logger.error(f"Failed to delete blob {self.bucket}/{key} after {max_retries} attempts: {e}")
+                    raise
+                logger.warning(f"Retry {attempt + 1}/{max_retries} for deleting {self.bucket}/{key}: {e}")
+                await asyncio.sleep(retry_delay)
+
+    async def list(self, filter: dict = None, limit: int = 0) -> AsyncIterator[dict]:
+        # The key of a blob is the GridFS filename
+        query = {("filename" if field == "key" else field): value for field, value in (filter or {}).items()}
+        # A blob being overwritten has several revisions. Sorted along the GridFS
+        # filename index, the latest revision of each blob comes first.
+        cursor = self.files.find(query, {"filename": 1, "length": 1, "metadata": 1, "uploadDate": 1}) \
+                           .sort([("filename", -1), ("uploadDate", -1)])
+        previous_key = None
+        n_blobs = 0
+        async for elem in cursor:
+            if elem["filename"] == previous_key:
+                continue
+            previous_key = elem["filename"]
+            yield {
+                "key": elem["filename"],
+                "length": elem.get("length", 0),
+                "metadata": elem.get("metadata", None),
+                "upload_date": elem.get("uploadDate", None)
+            }
+            n_blobs += 1
+            if limit and n_blobs >= limit:
+                break
@@ -0,0 +1,82 @@
+import asyncio
+import mmap
+import os
+import uuid
+from typing import AsyncIterator, Optional
+import logging
+
+from .blob_store import CatalogBlobStore, BLOB_READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Directory of the local blob store. The API and the workers must share it.
+BLOB_LOCAL_PATH = os.getenv("BLOB_LOCAL_PATH", "data/blobs")
+
+def _open_new_file(path: str):
+    for attempt in range(2):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            return open(path, "wb")
+        except FileNotFoundError:
+            # The directory was removed by the deletion of the last revision of the key
+            if attempt == 1:
+                raise
+
+def _write_file(path: str, blob: bytes):
+    # Written under a temporary name, so that a crash never leaves a partial revision
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with _open_new_file(tmp_path) as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return
+    # Remove the directory of the key once its last revision is gone
+    try:
+        os.rmdir(os.path.dirname(path))
+    except OSError:
+        pass
+
+class LocalBlobStore(CatalogBlobStore):
+    """
+    Blobs stored as files under BLOB_LOCAL_PATH, read through mmap
+    """
+    name = "local"
+
+    def __init__(self, analytiq_client, bucket: str, root: str = None):
+        super().__init__(analytiq_client, bucket)
+        self.root = root or BLOB_LOCAL_PATH
+
+    def _get_path(self, location: str) -> str:
+        return os.path.join(self.root, *location.split("/"))
+
+    async def _write(self, location: str, blob: bytes):
+        await asyncio.to_thread(_write_file, self._get_path(location), blob)
+
+    async def _read(self, location: str, start: int, end: Optional[int]) -> AsyncIterator[bytes]:
+        # Raises FileNotFoundError if the revision does not exist
+        f = await asyncio.to_thread(open, self._get_path(location), "rb")
+        try:
+            length = os.fstat(f.fileno()).st_size
+            end = length if end is None else min(end, length)
+            if start >= end:
+                return
+            # The pages of the file are mapped, and copied out one piece at a time
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(start, end, BLOB_READ_CHUNK_SIZE):
+                    yield await asyncio.to_thread(mm.__getitem__, slice(offset, min(offset + BLOB_READ_CHUNK_SIZE, end)))
+        finally:
+            f.close()
+
+    async def _remove(self, location: str):
+        await asyncio.to_thread(_remove_file, self._get_path(location))
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import weakref
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Optional
+import aioboto3
+import botocore.config
+import botocore.exceptions
+import logging
+
+import analytiq_data as ad
+from .blob_store import CatalogBlobStore, BLOB_READ_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+# S3 bucket of the S3 blob store
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET")
+
+# Endpoint of an S3-compatible service, such as MinIO. Defaults to AWS S3.
+BLOB_S3_ENDPOINT_URL = os.getenv("BLOB_S3_ENDPOINT_URL")
+
+BLOB_S3_REGION = os.getenv("BLOB_S3_REGION", "us-east-1")
+
+# Prefix of the object keys in the S3 bucket
+BLOB_S3_PREFIX = os.getenv("BLOB_S3_PREFIX", "")
+
+# Credentials of the S3 blob store. Default to the AWS credential chain.
+BLOB_S3_ACCESS_KEY_ID = os.getenv("BLOB_S3_ACCESS_KEY_ID")
+BLOB_S3_SECRET_ACCESS_KEY = os.getenv("BLOB_S3_SECRET_ACCESS_KEY")
+
+# Open S3 clients of the blob store, with their exit stacks, keyed by event
+# loop. Keyed by the loop itself, as the id of a closed loop can be reused.
+_s3_clients = weakref.WeakKeyDictionary()
+_s3_client_locks = weakref.WeakKeyDictionary()
+
+async def _get_s3_client():
+    """
+    Get the S3 client of the blob store, kept open with its connection pool
+    for the life of the event loop
+    """
+    key = asyncio.get_running_loop()
+    # The clients of closed loops can neither be used nor closed anymore
+    for closed_loop in [loop for loop in _s3_clients if loop.is_closed()]:
+        del _s3_clients[closed_loop]
+    lock = _s3_client_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        if key not in _s3_clients:
+            session = aioboto3.Session(
+                aws_access_key_id=BLOB_S3_ACCESS_KEY_ID,
+                aws_secret_access_key=BLOB_S3_SECRET_ACCESS_KEY,
+                region_name=BLOB_S3_REGION
+            )
+            exit_stack = AsyncExitStack()
+            client = await exit_stack.enter_async_context(session.client(
+                "s3",
+                endpoint_url=BLOB_S3_ENDPOINT_URL,
+                config=botocore.config.Config(max_pool_connections=ad.aws.AWS_MAX_POOL_CONNECTIONS)
+            ))
+            _s3_clients[key] = (client, exit_stack)
+        return _s3_clients[key][0]
+
+async def close_s3_clients():
+    """
+    Close the S3 client of the blob store opened in the current event loop
+    """
+    entry = _s3_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, exit_stack = entry
+        await exit_stack.aclose()
+
+def _is_not_found(e: botocore.exceptions.ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound")
+
+class S3BlobStore(CatalogBlobStore):
+    """
+    Blobs stored as objects of BLOB_S3_BUCKET, on AWS S3 or an S3-compatible service
+    """
+    name = "s3"
+
+    def __init__(self, analytiq_client, bucket: str, s3_bucket: str = None):
+        super().__init__(analytiq_client, bucket)
+        self.s3_bucket = s3_bucket or BLOB_S3_BUCKET
+        if not self.s3_bucket:
+            raise ValueError("BLOB_S3_BUCKET is not set, cannot use the S3 blob store")
+
+    def _get_object_key(self, location: str) -> str:
+        return f"{BLOB_S3_PREFIX}{location}"
+
+    async def _write(self, location: str, blob: bytes):
+        s3_client = await _get_s3_client()
+        await s3_client.put_object(Bucket=self.s3_bucket, Key=self._get_object_key(location), Body=blob)
+
+    async def _read(self, location: str, start: int, end: Optional[int]) -> AsyncIterator[bytes]:
+        if end is not None and end <= start:
+            return
+        s3_client = await _get_s3_client()
+        kwargs = {}
+        if start or end is not None:
+            kwargs["Range"] = f"bytes={start}-{'' if end is None else end - 1}"
+        try:
+            response = await s3_client.get_object(Bucket=self.s3_bucket, Key=self._get_object_key(location), **kwargs)
+        except botocore.exceptions.ClientError as e:
+            if _is_not_found(e):
+                raise FileNotFoundError(location)
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                # The range starts after the end of the object
+                return
+            raise
+
+        body = response["Body"]
+        try:
+            while True:
+                chunk = await body.read(BLOB_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def _remove(self, location: str):
+        s3_client = await _get_s3_client()
+        # Deleting a missing object succeeds
+        await s3_client.delete_object(Bucket=self.s3_bucket, Key=self._get_object_key(location))
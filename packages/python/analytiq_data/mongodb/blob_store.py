@@ -0,0 +1,257 @@
+import asyncio
+import os
+from datetime import datetime, UTC
+from typing import AsyncIterator, Optional
+from urllib.parse import quote
+from bson import ObjectId
+from pymongo import ReturnDocument
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Blob store of the buckets without their own setting: "gridfs", "local" or "s3"
+BLOB_STORE = os.getenv("BLOB_STORE", "gridfs")
+
+# Blob store per bucket, overriding BLOB_STORE, e.g. "files=local,ocr=s3"
+BLOB_STORES = os.getenv("BLOB_STORES", "")
+
+# Size of the pieces in which blobs of the local and S3 stores are read
+BLOB_READ_CHUNK_SIZE = int(os.getenv("BLOB_READ_CHUNK_SIZE", str(1024 * 1024)))
+
+# Blobs of the local and S3 stores, one document per blob and store:
+#   {_id: "store:bucket:key", store, bucket, key, revision, location, length, metadata, upload_date}
+# Each save writes a new revision at a new location, and then points the
+# document to it, so that readers never see a partial blob.
+BLOB_CATALOG_COLLECTION = "blob_catalog"
+
+# Deletions of overwritten blob revisions, running in the background
+_revision_gc_tasks = set()
+
+def get_blob_store_name(bucket: str) -> str:
+    """
+    Get the name of the store of a bucket, from BLOB_STORES or BLOB_STORE
+
+    Args:
+        bucket : str
+            bucket name
+
+    Returns:
+        str
+            "gridfs", "local" or "s3"
+    """
+    for item in BLOB_STORES.split(","):
+        name, sep, store = item.partition("=")
+        if sep and name.strip() == bucket:
+            return store.strip()
+    return BLOB_STORE
+
+def run_revision_gc(coro):
+    """
+    Run the deletion of overwritten revisions in the background
+    """
+    task = asyncio.create_task(coro)
+    _revision_gc_tasks.add(task)
+    task.add_done_callback(_revision_gc_tasks.discard)
+
+async def wait_blob_revision_gc():
+    """
+    Wait for the background deletions of overwritten blob revisions started
+    in the current event loop
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [task for task in _revision_gc_tasks if task.get_loop() is loop]
+    if tasks:
+        await asyncio.gather(*tasks)
+
+class BlobStore:
+    """
+    Storage of the blobs of one bucket. Blobs are identified by their key,
+    and saving a blob replaces it atomically.
+    """
+    name = None
+
+    def __init__(self, analytiq_client, bucket: str):
+        self.analytiq_client = analytiq_client
+        self.bucket = bucket
+
+    async def get(self, key: str) -> Optional[dict]:
+        """
+        Get a blob
+
+        Returns:
+            dict
+                {"blob": bytes, "metadata": dict, "upload_date": datetime}, None if not found
+        """
+        raise NotImplementedError
+
+    async def get_info(self, key: str, file_id: Optional[str] = None) -> Optional[dict]:
+        """
+        Get the size and metadata of a blob, without reading it. If file_id is set,
+        get those of that revision of the blob.
+
+        Returns:
+            dict
+                {"file_id": str, "length": int, "chunk_size": int, "metadata": dict, "upload_date": datetime},
+                None if not found. file_id changes whenever the blob is saved again.
+        """
+        raise NotImplementedError
+
+    def iter(self, key: str, start: int = 0, end: Optional[int] = None,
+             file_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """
+        Read a blob piece by piece, from start to end (exclusive). If file_id is set,
+        read that revision of the blob. Raises FileNotFoundError if the blob does not exist.
+        """
+        raise NotImplementedError
+
+    async def save(self, key: str, blob: bytes, metadata: dict, chunk_size_bytes: int = None):
+        """
+        Save a blob, replacing any previous revision
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        """
+        Delete a blob, with all its revisions
+        """
+        raise NotImplementedError
+
+    def list(self, filter: dict = None, limit: int = 0) -> AsyncIterator[dict]:
+        """
+        List the blobs matching a MongoDB filter on "key" and "metadata"
+
+        Returns:
+            AsyncIterator[dict]
+                {"key", "length", "metadata", "upload_date"} of each blob
+        """
+        raise NotImplementedError
+
+class CatalogBlobStore(BlobStore):
+    """
+    Base of the stores which keep blob contents outside of MongoDB. The
+    catalog of the blobs is kept in BLOB_CATALOG_COLLECTION, and the
+    subclasses store the contents at the locations it gives.
+    """
+    _indexed_envs = set()
+
+    def __init__(self, analytiq_client, bucket: str):
+        super().__init__(analytiq_client, bucket)
+        self.db = analytiq_client.mongodb_async[analytiq_client.env]
+        self.catalog = self.db[BLOB_CATALOG_COLLECTION]
+
+    def _get_location(self, key: str, revision: str) -> str:
+        return f"{self.analytiq_client.env}/{self.bucket}/{quote(key, safe='')}/{revision}"
+
+    async def _write(self, location: str, blob: bytes):
+        raise NotImplementedError
+
+    def _read(self, location: str, start: int, end: Optional[int]) -> AsyncIterator[bytes]:
+        """Read the bytes of a location, raising FileNotFoundError if it does not exist"""
+        raise NotImplementedError
+
+    async def _remove(self, location: str):
+        """Remove a location, ignoring missing ones"""
+        raise NotImplementedError
+
+    def _get_id(self, key: str) -> str:
+        return f"{self.name}:{self.bucket}:{key}"
+
+    async def _ensure_indexes(self):
+        if self.analytiq_client.env in CatalogBlobStore._indexed_envs:
+            return
+        await self.catalog.create_index([("store", 1), ("bucket", 1), ("key", 1)], name="store_bucket_key_idx")
+        CatalogBlobStore._indexed_envs.add(self.analytiq_client.env)
+
+    async def get(self, key: str) -> Optional[dict]:
+        # A concurrent save may delete the revision between the lookup and the read
+        for _ in range(3):
+            entry = await self.catalog.find_one({"_id": self._get_id(key)})
+            if entry is None:
+                return None
+            try:
+                blob = b"".join([chunk async for chunk in self._read(entry["location"], 0, None)])
+            except FileNotFoundError:
+                continue
+            return {"blob": blob, "metadata": entry.get("metadata"), "upload_date": entry.get("upload_date")}
+        return None
+
+    async def get_info(self, key: str, file_id: Optional[str] = None) -> Optional[dict]:
+        entry = await self.catalog.find_one({"_id": self._get_id(key)})
+        if entry is None or (file_id is not None and entry["revision"] != file_id):
+            # The catalog only keeps the latest revision
+            return None
+        return {
+            "file_id": entry["revision"],
+            "length": entry["length"],
+            "chunk_size": BLOB_READ_CHUNK_SIZE,
+            "metadata": entry.get("metadata"),
+            "upload_date": entry.get("upload_date")
+        }
+
+    async def iter(self, key: str, start: int = 0, end: Optional[int] = None,
+                   file_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        if file_id is None:
+            entry = await self.catalog.find_one({"_id": self._get_id(key)}, {"revision": 1})
+            if entry is None:
+                raise FileNotFoundError(f"Blob {self.bucket}/{key} not found")
+            file_id = entry["revision"]
+        try:
+            async for chunk in self._read(self._get_location(key, file_id), start, end):
+                yield chunk
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Blob {self.bucket}/{key} not found")
+
+    async def save(self, key: str, blob: bytes, metadata: dict, chunk_size_bytes: int = None):
+        await self._ensure_indexes()
+        revision = str(ObjectId())
+        location = self._get_location(key, revision)
+        await self._write(location, blob)
+
+        try:
+            previous = await self.catalog.find_one_and_replace(
+                {"_id": self._get_id(key)},
+                {
+                    "store": self.name,
+                    "bucket": self.bucket,
+                    "key": key,
+                    "revision": revision,
+                    "location": location,
+                    "length": len(blob),
+                    "metadata": metadata,
+                    "upload_date": datetime.now(UTC)
+                },
+                upsert=True,
+                return_document=ReturnDocument.BEFORE
+            )
+        except BaseException:
+            # The revision was never visible
+            await self._remove(location)
+            raise
+        if previous is not None:
+            run_revision_gc(self._remove_revision(key, previous["location"]))
+
+    async def _remove_revision(self, key: str, location: str):
+        try:
+            await self._remove(location)
+            logger.debug(f"Deleted revision {location} of blob {self.bucket}/{key}")
+        except Exception as e:
+            logger.warning(f"Failed to delete revision {location} of blob {self.bucket}/{key}: {e}")
+
+    async def delete(self, key: str):
+        entry = await self.catalog.find_one_and_delete({"_id": self._get_id(key)})
+        if entry is not None:
+            await self._remove(entry["location"])
+            logger.debug(f"Blob {self.bucket}/{key} has been deleted.")
+
+    async def list(self, filter: dict = None, limit: int = 0) -> AsyncIterator[dict]:
+        cursor = self.catalog.find({**(filter or {}), "store": self.name, "bucket": self.bucket},
+                                   {"key": 1, "length": 1, "metadata": 1, "upload_date": 1})
+        if limit:
+            cursor = cursor.limit(limit)
+        async for entry in cursor:
+            yield {
+                "key": entry["key"],
+                "length": entry["length"],
+                "metadata": entry.get("metadata"),
+                "upload_date": entry.get("upload_date")
+            }
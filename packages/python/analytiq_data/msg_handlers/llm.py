@@ -6,6 +6,19 @@ import analytiq_data as ad
 logger = logging.getLogger(__name__)
 
 async def process_llm_msg(analytiq_client, msg):
+    """
+    Process an LLM message
+
+    Failures are retried with backoff according to the retry policy of the
+    llm queue. The document is marked LLM failed only once the message is
+    moved to the dead-letter queue.
+
+    Args:
+        analytiq_client : AnalytiqClient
+            The analytiq client
+        msg : dict
+            The LLM message
+    """
     logger.info(f"Processing LLM msg: {msg}")
 
     document_id = msg["msg"]["document_id"]
@@ -35,9 +48,9 @@ async def process_llm_msg(analytiq_client, msg):
     except Exception as e:
         logger.error(f"Error processing LLM msg: {e}")
         
-        # Update state to LLM failed
-        await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_LLM_FAILED)
+        if not await ad.queue.retry_msg(analytiq_client, "llm", msg, error=str(e)):
+            # Out of retries, update state to LLM failed
+            await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_LLM_FAILED)
+        return
         
-        # Could add LLM error queue handling here if needed
-        
-    await ad.queue.delete_msg(analytiq_client, "llm", msg["_id"])
\ No newline at end of file
+    await ad.queue.delete_msg(analytiq_client, "llm", msg["_id"], claim_id=msg.get("claim_id"))
\ No newline at end of file
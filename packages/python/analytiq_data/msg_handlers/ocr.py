@@ -1,7 +1,9 @@
 import asyncio
+import hashlib
 import json
 import logging
 import os
+from bson import ObjectId
 import analytiq_data as ad
 import stamina
 
@@ -9,20 +11,24 @@ logger = logging.getLogger(__name__)
 
 
 @stamina.retry(on=FileNotFoundError)
-async def _ocr_get_file(analytiq_client, file_name: str):
+async def _ocr_get_file_info(analytiq_client, file_name: str):
     """
-    Get file with retry mechanism for file not found errors.
+    Get file info with retry mechanism for file not found errors.
     This handles race conditions where large files may not be fully committed to GridFS yet.
     """
-    file = await ad.common.get_file_async(analytiq_client, file_name)
-    if file is None:
+    file_info = await ad.common.get_file_info_async(analytiq_client, file_name)
+    if file_info is None:
         raise FileNotFoundError(f"File {file_name} not found")
-    return file
+    return file_info
 
 async def process_ocr_msg(analytiq_client, msg, force:bool=False):
     """
     Process an OCR message
 
+    Failures are retried with backoff according to the retry policy of the
+    ocr queue. The document is marked OCR failed only once the message is
+    moved to the dead-letter queue.
+
     Args:
         analytiq_client : AnalytiqClient
             The analytiq client
@@ -36,83 +42,153 @@ async def process_ocr_msg(analytiq_client, msg, force:bool=False):
     logger.info(f"Force: {force}")
 
     msg_id = msg["_id"]
+    document_id = msg["msg"]["document_id"]
 
     try:
-        document_id = msg["msg"]["document_id"]
+        await _run_ocr(analytiq_client, document_id, force)
+    except Exception as e:
+        logger.error(f"Error processing OCR msg: {e}")
+
+        if not await ad.queue.retry_msg(analytiq_client, "ocr", msg, error=str(e)):
+            # Out of retries, update state to OCR failed
+            await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
+        return
+
+    # Delete the message from the ocr queue
+    await ad.queue.delete_msg(analytiq_client, "ocr", msg_id, claim_id=msg.get("claim_id"))
+
+async def _use_ocr_cache(analytiq_client, document_id: str, cache_key: str) -> bool:
+    """
+    Make a document use the OCR of the cache, instead of its own OCR
+
+    Returns:
+        bool: False if the cache entry was removed meanwhile
+    """
+    if not await ad.common.link_ocr_cache(analytiq_client, document_id, cache_key):
+        return False
+    await ad.common.delete_ocr_json(analytiq_client, document_id)
+    return True
+
+async def _run_ocr(analytiq_client, document_id: str, force: bool):
+    """
+    Run OCR for a document and post it to the llm queue
 
-        # Get document info to check if we should skip OCR
+    Args:
+        analytiq_client : AnalytiqClient
+            The analytiq client
+        document_id : str
+            The document id
+        force : bool
+            Whether to force the processing
+    """
+    # Get document info to check if we should skip OCR
+    doc = await ad.common.doc.get_doc(analytiq_client, document_id)
+    if not doc:
+        logger.error(f"Document {document_id} not found. Skipping OCR.")
+        return
+
+    # Check if OCR is supported for this file
+    if not ad.common.doc.ocr_supported(doc.get("user_file_name", "")):
+        logger.info(f"Skipping OCR processing for structured data file: {document_id} ({doc.get('user_file_name')})")
+        # Update state to OCR completed without doing OCR
+        await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_COMPLETED)
+        # Post a message to the llm job queue
+        await ad.queue.send_msg(analytiq_client, "llm", msg={"document_id": document_id},
+                            organization_id=doc.get("organization_id"),
+                            idempotency_key=document_id)
+        return
+
+    # Update state to OCR processing
+    await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_PROCESSING)
+
+    ocr_json = None
+    if not force:
+        # Check if the OCR text already exists
+        ocr_json = await ad.common.get_ocr_json(analytiq_client, document_id)
+        if ocr_json is not None:
+            logger.info(f"OCR list for {document_id} already exists. Skipping OCR.")        
+    
+    if ocr_json is None:            
+        # Get the file
         doc = await ad.common.doc.get_doc(analytiq_client, document_id)
-        if not doc:
-            logger.error(f"Document {document_id} not found. Skipping OCR.")
+        if not doc or "mongo_file_name" not in doc:
+            logger.error(f"Document metadata for {document_id} not found or missing mongo_file_name. Skipping OCR.")
+            await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
             return
 
-        # Check if OCR is supported for this file
-        if not ad.common.doc.ocr_supported(doc.get("user_file_name", "")):
-            logger.info(f"Skipping OCR processing for structured data file: {document_id} ({doc.get('user_file_name')})")
-            # Update state to OCR completed without doing OCR
-            await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_COMPLETED)
-            # Post a message to the llm job queue
-            msg = {"document_id": document_id}
-            await ad.queue.send_msg(analytiq_client, "llm", msg=msg)
+        # Use the PDF file if available, otherwise fallback to original
+        pdf_file_name = doc.get("pdf_file_name")
+        if pdf_file_name is None:
+            logger.error(f"Document metadata for {document_id} not found or missing pdf_file_name. Skipping OCR.")
+            await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
             return
 
-        # Update state to OCR processing
-        await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_PROCESSING)
-
-        ocr_json = None
-        if not force:
-            # Check if the OCR text already exists
-            ocr_json = await ad.common.get_ocr_json(analytiq_client, document_id)
-            if ocr_json is not None:
-                logger.info(f"OCR list for {document_id} already exists. Skipping OCR.")        
-        
-        if ocr_json is None:            
-            # Get the file
-            doc = await ad.common.doc.get_doc(analytiq_client, document_id)
-            if not doc or "mongo_file_name" not in doc:
-                logger.error(f"Document metadata for {document_id} not found or missing mongo_file_name. Skipping OCR.")
-                await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
-                return
-
-            # Use the PDF file if available, otherwise fallback to original
-            pdf_file_name = doc.get("pdf_file_name")
-            if pdf_file_name is None:
-                logger.error(f"Document metadata for {document_id} not found or missing pdf_file_name. Skipping OCR.")
-                await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
-                return
-
-            file = await _ocr_get_file(analytiq_client, pdf_file_name)
-            if file is None:
+        # Reuse the OCR of an identical PDF
+        pdf_sha256 = doc.get("pdf_sha256")
+        cache_key = ad.common.get_ocr_cache_key(pdf_sha256, doc.get("organization_id"))
+        if cache_key is not None and not force:
+            ocr_json = await ad.common.get_cached_ocr_json(analytiq_client, cache_key)
+            if ocr_json is not None and await _use_ocr_cache(analytiq_client, document_id, cache_key):
+                logger.info(f"OCR list for {document_id} found in the OCR cache. Skipping OCR.")
+            else:
+                ocr_json = None
+
+        if ocr_json is None:
+            file_info = await _ocr_get_file_info(analytiq_client, pdf_file_name)
+            if file_info is None:
                 logger.error(f"File for {document_id} not found. Skipping OCR.")
                 await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
                 return
 
-            # Run OCR
-            ocr_json = await ad.aws.textract.run_textract(analytiq_client, file["blob"])
+            # Stream the PDF from GridFS rather than loading it in memory.
+            # Documents uploaded before fingerprinting are fingerprinted on the way.
+            sha256 = hashlib.sha256() if pdf_sha256 is None else None
+            sha256_complete = False
+            async def iter_pdf():
+                nonlocal sha256_complete
+                async for chunk in ad.common.iter_file_async(analytiq_client, pdf_file_name):
+                    if sha256 is not None:
+                        sha256.update(chunk)
+                    yield chunk
+                sha256_complete = True
+
+            # Run OCR, reading the text layer of born-digital pages instead when possible.
+            # The text of each page is saved as soon as the page is OCRed.
+            logger.info(f"OCR of {document_id}: {file_info['length'] / 1024 / 1024:.2f}MB PDF")
+            writer = ad.common.OcrPageWriter(analytiq_client, document_id)
+            await ad.ocr.run_ocr_stream(analytiq_client, iter_pdf(), on_page=writer.add_page)
+            ocr_bytes = await writer.finish()
             logger.info(f"OCR completed for {document_id}")
 
-            # Save the OCR dictionary
-            await ad.common.save_ocr_json(analytiq_client, document_id, ocr_json)
+            if sha256 is not None and sha256_complete:
+                pdf_sha256 = sha256.hexdigest()
+                cache_key = ad.common.get_ocr_cache_key(pdf_sha256, doc.get("organization_id"))
+                # Save the fingerprint, so that the next runs do not hash the PDF again.
+                # Unless the PDF was replaced in the meantime.
+                db = ad.common.get_async_db(analytiq_client)
+                await db["docs"].update_one(
+                    {"_id": ObjectId(document_id), "pdf_file_name": pdf_file_name},
+                    {"$set": {"pdf_sha256": pdf_sha256}}
+                )
+
+            # Save the OCR dictionary, once per PDF content when the cache is on
+            if cache_key is not None:
+                await ad.common.save_ocr_cache(analytiq_client, cache_key, ocr_bytes, document_id,
+                                               pdf_sha256=pdf_sha256, organization_id=doc.get("organization_id"))
+                await ad.common.delete_ocr_json(analytiq_client, document_id)
+            else:
+                await ad.common.save_ocr_json(analytiq_client, document_id, ocr_bytes)
+                await ad.common.release_ocr_cache(analytiq_client, document_id)
             logger.info(f"OCR list for {document_id} has been saved.")
-        
-        # Extract the text
+
+    if ocr_json is not None:
+        # Extract the text of OCR done earlier
         await ad.common.save_ocr_text_from_list(analytiq_client, document_id, ocr_json, force=force)
         logger.info(f"OCR text for {document_id} has been saved.")
-        # Update state to OCR completed
-        await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_COMPLETED)
+    # Update state to OCR completed
+    await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_COMPLETED)
 
-        # Post a message to the llm job queue
-        msg = {"document_id": document_id}
-        await ad.queue.send_msg(analytiq_client, "llm", msg=msg)
-    
-    except Exception as e:
-        logger.error(f"Error processing OCR msg: {e}")
-        
-        # Update state to OCR failed
-        await ad.common.doc.update_doc_state(analytiq_client, document_id, ad.common.doc.DOCUMENT_STATE_OCR_FAILED)
-
-        # Save the message to the ocr_err queue
-        await ad.queue.send_msg(analytiq_client, "ocr_err", msg=msg)
-
-    # Delete the message from the ocr queue
-    await ad.queue.delete_msg(analytiq_client, "ocr", msg_id)
\ No newline at end of file
+    # Post a message to the llm job queue
+    await ad.queue.send_msg(analytiq_client, "llm", msg={"document_id": document_id},
+                            organization_id=doc.get("organization_id"),
+                            idempotency_key=document_id)
@@ -0,0 +1,3 @@
+from .engine import *
+from .pdf import *
+from .text_layer import *
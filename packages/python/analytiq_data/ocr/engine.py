@@ -0,0 +1,240 @@
+import asyncio
+import os
+import tempfile
+from typing import Dict, List, Any, Optional, Union, BinaryIO, AsyncIterator, Callable, Awaitable
+import logging
+
+import analytiq_data as ad
+from .pdf import extract_pdf_pages
+from .text_layer import extract_text_layer, needs_ocr, get_text_layer_blocks
+
+logger = logging.getLogger(__name__)
+
+# OCR engine used by the OCR worker: "textract", "text_layer" or "auto"
+OCR_ENGINE = os.getenv("OCR_ENGINE", "auto")
+
+# Called with (page number, blocks of the page) as the pages of a document are OCRed
+OnPage = Callable[[int, List[Dict[str, Any]]], Awaitable]
+
+async def pass_on_pages(blocks: List[Dict[str, Any]], on_page: OnPage):
+    """
+    Pass the blocks of a document to an on_page callback, one page at a time,
+    in page order. Blocks without a page are passed on last, as page 0.
+
+    Args:
+        blocks: Textract blocks
+        on_page: The callback
+    """
+    pages = {}
+    for block in blocks:
+        pages.setdefault(block.get("Page", 0), []).append(block)
+    for page in sorted(pages, key=lambda page: (page == 0, page)):
+        await on_page(page, pages[page])
+
+class OcrEngine:
+    """
+    An OCR engine, turning a PDF into Textract-like blocks. Engines are
+    registered with register_ocr_engine() and selected by name.
+    """
+    name = None
+
+    async def run(self, analytiq_client, blob: Union[bytes, BinaryIO],
+                  on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        OCR a PDF.
+
+        Args:
+            analytiq_client: The AnalytiqClient instance
+            blob: The PDF, as bytes or a seekable binary file
+            on_page: If set, the blocks are not returned but passed to
+                     on_page(page, blocks) one page at a time, as soon as
+                     each page is done, in no particular page order
+
+        Returns:
+            List[Dict]: Textract blocks, with 1-based Page numbers. None with on_page.
+        """
+        raise NotImplementedError
+
+    async def run_stream(self, analytiq_client, chunks: AsyncIterator[bytes],
+                         on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        """
+        OCR a PDF read chunk by chunk. By default, the chunks are spooled to
+        a temporary file, so that the PDF is not held in memory.
+
+        Args:
+            analytiq_client: The AnalytiqClient instance
+            chunks: The chunks of the PDF
+            on_page: See run()
+
+        Returns:
+            List[Dict]: Textract blocks, with 1-based Page numbers. None with on_page.
+        """
+        with tempfile.TemporaryFile() as file:
+            async for chunk in chunks:
+                await asyncio.to_thread(file.write, chunk)
+            await asyncio.to_thread(file.seek, 0)
+            return await self.run(analytiq_client, file, on_page)
+
+class TextractOcrEngine(OcrEngine):
+    """
+    OCR all pages with AWS Textract.
+    """
+    name = "textract"
+
+    async def run(self, analytiq_client, blob: Union[bytes, BinaryIO],
+                  on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        return await ad.aws.textract.run_textract(analytiq_client, blob, on_page=on_page)
+
+    async def run_stream(self, analytiq_client, chunks: AsyncIterator[bytes],
+                         on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        if ad.aws.textract.TEXTRACT_SHARD_PAGES > 0:
+            # Sharding needs the whole PDF. It is spooled to disk, and the
+            # shards are streamed to S3 from temporary files.
+            return await super().run_stream(analytiq_client, chunks, on_page)
+        # Pipe the chunks into the S3 upload
+        return await ad.aws.textract.run_textract(analytiq_client, chunks, on_page=on_page)
+
+class TextLayerOcrEngine(OcrEngine):
+    """
+    Read the embedded text layer of born-digital PDFs, without OCR. Pages
+    without a text layer come out empty.
+    """
+    name = "text_layer"
+
+    async def run(self, analytiq_client, blob: Union[bytes, BinaryIO],
+                  on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        pages = await asyncio.to_thread(extract_text_layer, blob)
+        if pages is None:
+            raise ValueError("Cannot extract the text layer of the PDF")
+        blocks = []
+        for page_idx, lines in enumerate(pages):
+            if on_page is not None:
+                await on_page(page_idx + 1, get_text_layer_blocks(lines, page_idx + 1))
+            else:
+                blocks.extend(get_text_layer_blocks(lines, page_idx + 1))
+        return blocks if on_page is None else None
+
+class AutoOcrEngine(OcrEngine):
+    """
+    Read the text layer of the pages that have one, and OCR only the pages
+    that look scanned with the fallback engine. Documents whose text layer
+    cannot be read are OCRed entirely.
+    """
+    name = "auto"
+
+    def __init__(self, fallback: OcrEngine = None):
+        self.fallback = fallback or TextractOcrEngine()
+
+    async def run(self, analytiq_client, blob: Union[bytes, BinaryIO],
+                  on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+        pages = await asyncio.to_thread(extract_text_layer, blob)
+        if not pages:
+            return await self.fallback.run(analytiq_client, blob, on_page)
+
+        scanned_pages = [page_idx + 1 for page_idx, lines in enumerate(pages) if needs_ocr(lines)]
+        logger.info(f"{len(pages) - len(scanned_pages)} of {len(pages)} pages have a text layer, "
+                    f"OCRing {len(scanned_pages)} pages with {self.fallback.name}")
+
+        if len(scanned_pages) == len(pages):
+            return await self.fallback.run(analytiq_client, blob, on_page)
+
+        blocks_by_page = {}
+        async def add_page(page: int, blocks: List[Dict[str, Any]]):
+            if on_page is not None:
+                await on_page(page, blocks)
+            else:
+                blocks_by_page.setdefault(page, []).extend(blocks)
+
+        scanned = set(scanned_pages)
+        for page_idx, lines in enumerate(pages):
+            if page_idx + 1 not in scanned:
+                await add_page(page_idx + 1, get_text_layer_blocks(lines, page_idx + 1))
+        # The text layer is no longer needed
+        del pages
+
+        if scanned_pages:
+            # OCR a PDF holding only the scanned pages, then renumber its pages
+            async def add_scanned_page(page: int, blocks: List[Dict[str, Any]]):
+                if page > 0:
+                    page = scanned_pages[page - 1]
+                    for block in blocks:
+                        if "Page" in block:
+                            block["Page"] = page
+                await add_page(page, blocks)
+
+            # Written to a temporary file, so that it is streamed to the fallback engine
+            scanned_file = await asyncio.to_thread(extract_pdf_pages, blob, scanned_pages)
+            with scanned_file:
+                if on_page is not None:
+                    await self.fallback.run(analytiq_client, scanned_file, add_scanned_page)
+                else:
+                    await pass_on_pages(await self.fallback.run(analytiq_client, scanned_file), add_scanned_page)
+
+        if on_page is not None:
+            return None
+        blocks = []
+        for page in sorted(blocks_by_page):
+            blocks.extend(blocks_by_page[page])
+        return blocks
+
+_ocr_engines = {}
+
+def register_ocr_engine(engine: OcrEngine):
+    """
+    Register an OCR engine under its name, replacing any engine of the same name.
+
+    Args:
+        engine: The OCR engine
+    """
+    _ocr_engines[engine.name] = engine
+
+def get_ocr_engine(name: str = None) -> OcrEngine:
+    """
+    Get a registered OCR engine.
+
+    Args:
+        name: Name of the engine. Defaults to OCR_ENGINE.
+
+    Returns:
+        OcrEngine: The engine
+    """
+    name = name or OCR_ENGINE
+    if name not in _ocr_engines:
+        raise ValueError(f"Unknown OCR engine: {name}, expected one of {sorted(_ocr_engines)}")
+    return _ocr_engines[name]
+
+async def run_ocr(analytiq_client, blob: Union[bytes, BinaryIO], engine: str = None,
+                  on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    OCR a PDF with an OCR engine.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        blob: The PDF, as bytes or a seekable binary file
+        engine: Name of the engine. Defaults to OCR_ENGINE.
+        on_page: If set, called with (page number, blocks of the page) as each page is done, instead of returning the blocks
+
+    Returns:
+        List[Dict]: Textract blocks, None with on_page
+    """
+    return await get_ocr_engine(engine).run(analytiq_client, blob, on_page)
+
+async def run_ocr_stream(analytiq_client, chunks: AsyncIterator[bytes], engine: str = None,
+                         on_page: Optional[OnPage] = None) -> Optional[List[Dict[str, Any]]]:
+    """
+    OCR a PDF read chunk by chunk, without holding it in memory.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        chunks: The chunks of the PDF, e.g. from ad.common.iter_file_async()
+        engine: Name of the engine. Defaults to OCR_ENGINE.
+        on_page: If set, called with (page number, blocks of the page) as each page is done, instead of returning the blocks
+
+    Returns:
+        List[Dict]: Textract blocks, None with on_page
+    """
+    return await get_ocr_engine(engine).run_stream(analytiq_client, chunks, on_page)
+
+register_ocr_engine(TextractOcrEngine())
+register_ocr_engine(TextLayerOcrEngine())
+register_ocr_engine(AutoOcrEngine())
@@ -0,0 +1,88 @@
+import io
+import tempfile
+from typing import List, Tuple, Union, BinaryIO
+import logging
+
+logger = logging.getLogger(__name__)
+
+# PDF manipulation with the optional pypdf dependency, imported lazily
+
+def open_pdf(blob: Union[bytes, BinaryIO]):
+    """
+    Open a PDF with pypdf. A file is read on demand rather than loaded in memory.
+
+    Args:
+        blob: The PDF, as bytes or a seekable binary file
+
+    Returns:
+        pypdf.PdfReader: The reader
+    """
+    import pypdf
+
+    if isinstance(blob, (bytes, bytearray)):
+        blob = io.BytesIO(blob)
+    return pypdf.PdfReader(blob)
+
+def _write_pdf(writer) -> BinaryIO:
+    """
+    Write a PDF to a temporary file, so that it is not held in memory and can
+    be streamed to S3.
+    """
+    output = tempfile.TemporaryFile()
+    try:
+        writer.write(output)
+        output.seek(0)
+    except BaseException:
+        output.close()
+        raise
+    return output
+
+def extract_pdf_pages(blob: Union[bytes, BinaryIO], pages: List[int]) -> BinaryIO:
+    """
+    Build a PDF holding some pages of another one.
+
+    Args:
+        blob: The PDF, as bytes or a seekable binary file
+        pages: The 1-based page numbers to keep, in order
+
+    Returns:
+        BinaryIO: The new PDF, in a temporary file to be closed by the caller
+    """
+    import pypdf
+
+    reader = open_pdf(blob)
+    writer = pypdf.PdfWriter()
+    for page in pages:
+        writer.add_page(reader.pages[page - 1])
+    return _write_pdf(writer)
+
+def split_pdf(blob: Union[bytes, BinaryIO], shard_pages: int) -> List[Tuple[int, Union[bytes, BinaryIO]]]:
+    """
+    Split a PDF into shards of consecutive pages.
+
+    Args:
+        blob: The PDF, as bytes or a seekable binary file
+        shard_pages: Maximum number of pages per shard
+
+    Returns:
+        list: (1-based number of the first page, shard PDF) for each shard, in
+              page order. The shards are temporary files to be closed by the
+              caller. A PDF that fits in one shard is returned as is.
+    """
+    import pypdf
+
+    reader = open_pdf(blob)
+    if len(reader.pages) <= shard_pages:
+        return [(1, blob)]
+    shards = []
+    try:
+        for first_page_idx in range(0, len(reader.pages), shard_pages):
+            writer = pypdf.PdfWriter()
+            for page in reader.pages[first_page_idx:first_page_idx + shard_pages]:
+                writer.add_page(page)
+            shards.append((first_page_idx + 1, _write_pdf(writer)))
+    except BaseException:
+        for _, shard in shards:
+            shard.close()
+        raise
+    return shards
@@ -0,0 +1,198 @@
+import io
+import math
+import os
+import re
+import unicodedata
+import uuid
+from typing import Optional, List, Dict, Any, Union, BinaryIO
+import logging
+
+logger = logging.getLogger(__name__)
+
+# A page with fewer non-space characters in its text layer is treated as scanned
+OCR_TEXT_LAYER_MIN_CHARS = int(os.getenv("OCR_TEXT_LAYER_MIN_CHARS", "20"))
+
+# A page whose text layer has a larger share of unmapped or control characters
+# is treated as scanned: its fonts do not map glyphs to text
+OCR_TEXT_LAYER_MAX_BAD_RATIO = 0.1
+
+# Approximate glyph width, relative to the font size, used to place words within a text run
+CHAR_WIDTH_RATIO = 0.5
+
+_WORD_RE = re.compile(r"\S+")
+
+def is_text_layer_available() -> bool:
+    """
+    Check whether the optional pypdf dependency of the text layer extractor is installed.
+
+    Returns:
+        bool: True if pypdf can be imported
+    """
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def _get_run_geometry(cm: list, tm: list, font_size: float) -> tuple:
+    """
+    Get the origin and the effective font size of a text run, in user space.
+    """
+    a = tm[0] * cm[0] + tm[1] * cm[2]
+    b = tm[0] * cm[1] + tm[1] * cm[3]
+    c = tm[2] * cm[0] + tm[3] * cm[2]
+    d = tm[2] * cm[1] + tm[3] * cm[3]
+    x = tm[4] * cm[0] + tm[5] * cm[2] + cm[4]
+    y = tm[4] * cm[1] + tm[5] * cm[3] + cm[5]
+    scale = math.sqrt(c * c + d * d) or math.sqrt(a * a + b * b) or 1.0
+    return x, y, abs(font_size * scale) or 1.0
+
+def _get_box(left: float, top: float, width: float, height: float) -> Dict[str, float]:
+    left = min(max(left, 0.0), 1.0)
+    top = min(max(top, 0.0), 1.0)
+    return {
+        "Width": min(max(width, 0.0), 1.0 - left),
+        "Height": min(max(height, 0.0), 1.0 - top),
+        "Left": left,
+        "Top": top
+    }
+
+def _get_page_lines(page) -> List[Dict[str, Any]]:
+    """
+    Get the lines of the text layer of a pypdf page, top to bottom and left
+    to right, with their words and normalized bounding boxes.
+    """
+    box = page.mediabox
+    page_left, page_bottom = float(box.left), float(box.bottom)
+    page_width, page_height = float(box.width) or 1.0, float(box.height) or 1.0
+
+    runs = []
+    def visitor(text, cm, tm, font_dict, font_size):
+        if text and not text.isspace():
+            x, y, size = _get_run_geometry(cm, tm, font_size)
+            runs.append((x - page_left, y - page_bottom, size, text))
+
+    page.extract_text(visitor_text=visitor)
+
+    # Group the words into lines by baseline
+    words = []
+    for x, y, size, text in runs:
+        char_width = size * CHAR_WIDTH_RATIO
+        for match in _WORD_RE.finditer(text):
+            words.append((y, x + match.start() * char_width, len(match.group()) * char_width, size, match.group()))
+    words.sort(key=lambda word: (-word[0], word[1]))
+
+    lines = []
+    for y, x, width, size, text in words:
+        if lines and abs(lines[-1]["y"] - y) <= lines[-1]["size"] / 2:
+            line = lines[-1]
+        else:
+            line = {"y": y, "size": size, "words": []}
+            lines.append(line)
+        line["words"].append({
+            "text": text,
+            "box": _get_box(x / page_width, 1.0 - (y + size) / page_height, width / page_width, size / page_height)
+        })
+
+    for line in lines:
+        line["words"].sort(key=lambda word: word["box"]["Left"])
+        boxes = [word["box"] for word in line["words"]]
+        left = min(b["Left"] for b in boxes)
+        top = min(b["Top"] for b in boxes)
+        line["text"] = " ".join(word["text"] for word in line["words"])
+        line["box"] = _get_box(left, top,
+                               max(b["Left"] + b["Width"] for b in boxes) - left,
+                               max(b["Top"] + b["Height"] for b in boxes) - top)
+        del line["y"], line["size"]
+    return lines
+
+def extract_text_layer(blob: Union[bytes, BinaryIO]) -> Optional[List[List[Dict[str, Any]]]]:
+    """
+    Extract the text layer of a PDF. This is CPU bound, run it in a thread.
+
+    Args:
+        blob: The PDF, as bytes or a seekable binary file
+
+    Returns:
+        list: For each page, its lines as {"text", "box", "words": [{"text", "box"}]}.
+              None if pypdf is not installed or the PDF cannot be parsed.
+    """
+    try:
+        import pypdf
+    except ImportError:
+        logger.warning("pypdf is not installed, the text layer of PDFs is not used")
+        return None
+
+    try:
+        reader = pypdf.PdfReader(io.BytesIO(blob) if isinstance(blob, (bytes, bytearray)) else blob)
+        return [_get_page_lines(page) for page in reader.pages]
+    except Exception as e:
+        logger.info(f"Cannot extract the text layer of the PDF: {e}")
+        return None
+
+def needs_ocr(lines: List[Dict[str, Any]]) -> bool:
+    """
+    Check whether a page has to be OCRed, because its text layer is missing,
+    too short, or does not map to text.
+
+    Args:
+        lines: The lines of the page, from extract_text_layer()
+
+    Returns:
+        bool: True if the page looks scanned
+    """
+    text = "".join(line["text"] for line in lines)
+    n_chars = sum(1 for char in text if not char.isspace())
+    if n_chars < OCR_TEXT_LAYER_MIN_CHARS:
+        return True
+    n_bad = sum(1 for char in text if char == "\ufffd" or unicodedata.category(char) in ("Cc", "Co", "Cn"))
+    return n_bad > OCR_TEXT_LAYER_MAX_BAD_RATIO * n_chars
+
+def _get_polygon(box: Dict[str, float]) -> List[Dict[str, float]]:
+    left, top = box["Left"], box["Top"]
+    right, bottom = left + box["Width"], top + box["Height"]
+    return [{"X": left, "Y": top}, {"X": right, "Y": top}, {"X": right, "Y": bottom}, {"X": left, "Y": bottom}]
+
+def get_text_layer_blocks(lines: List[Dict[str, Any]], page: int) -> List[Dict[str, Any]]:
+    """
+    Build Textract-like PAGE, LINE and WORD blocks from the text layer of a page.
+
+    Args:
+        lines: The lines of the page, from extract_text_layer()
+        page: The 1-based page number
+
+    Returns:
+        List[Dict]: The blocks
+    """
+    page_box = _get_box(0.0, 0.0, 1.0, 1.0)
+    page_block = {
+        "BlockType": "PAGE",
+        "Geometry": {"BoundingBox": page_box, "Polygon": _get_polygon(page_box)},
+        "Id": str(uuid.uuid4()),
+        "Relationships": [{"Type": "CHILD", "Ids": []}],
+        "Page": page
+    }
+    blocks = [page_block]
+    for line in lines:
+        word_blocks = [{
+            "BlockType": "WORD",
+            "Confidence": 100.0,
+            "Text": word["text"],
+            "TextType": "PRINTED",
+            "Geometry": {"BoundingBox": word["box"], "Polygon": _get_polygon(word["box"])},
+            "Id": str(uuid.uuid4()),
+            "Page": page
+        } for word in line["words"]]
+        line_block = {
+            "BlockType": "LINE",
+            "Confidence": 100.0,
+            "Text": line["text"],
+            "Geometry": {"BoundingBox": line["box"], "Polygon": _get_polygon(line["box"])},
+            "Id": str(uuid.uuid4()),
+            "Relationships": [{"Type": "CHILD", "Ids": [word_block["Id"] for word_block in word_blocks]}],
+            "Page": page
+        }
+        page_block["Relationships"][0]["Ids"].append(line_block["Id"])
+        blocks.append(line_block)
+        blocks.extend(word_blocks)
+    return blocks
@@ -1 +1,7 @@
-from .queue import *
\ No newline at end of file
+from .queue import *
+from .concurrency import *
+from .fair import *
+from .lease import *
+from .retry import *
+from .stats import *
+from .watch import *
\ No newline at end of file
@@ -0,0 +1,194 @@
+from collections import deque
+from datetime import datetime, UTC
+from typing import Optional, Dict, Any
+import statistics
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Reasons for a concurrency change
+CONCURRENCY_REASON_BACKLOG = "backlog"      # Backlog growing and latency holding: additive increase
+CONCURRENCY_REASON_THROTTLED = "throttled"  # Provider throttled us: multiplicative decrease
+CONCURRENCY_REASON_LATENCY = "latency"      # Latency rising over its baseline: multiplicative decrease
+CONCURRENCY_REASON_IDLE = "idle"            # Queue empty: additive decrease towards the minimum
+
+# Substrings identifying throttling errors of Textract, Bedrock and the LLM providers
+THROTTLING_ERROR_MARKERS = ["429", "throttl", "rate limit", "ratelimit", "too many requests",
+                            "slowdown", "provisionedthroughputexceeded"]
+
+# Throttling errors seen by this process since the last adjustment, per queue
+_throttle_counts = {}
+
+def is_throttling_error(error: Optional[str]) -> bool:
+    """
+    Check whether an error message denotes provider throttling.
+
+    Args:
+        error: The error message
+
+    Returns:
+        bool: True if the error is a throttling error
+    """
+    if not error:
+        return False
+    error = error.lower()
+    return any(marker in error for marker in THROTTLING_ERROR_MARKERS)
+
+def record_throttle(queue_name: str):
+    """
+    Record a throttling error of a queue, for the concurrency controller of the process.
+
+    Args:
+        queue_name: Name of the queue
+    """
+    _throttle_counts[queue_name] = _throttle_counts.get(queue_name, 0) + 1
+
+def pop_throttle_count(queue_name: str) -> int:
+    """
+    Get and reset the number of throttling errors of a queue since the last call.
+
+    Args:
+        queue_name: Name of the queue
+
+    Returns:
+        int: The number of throttling errors
+    """
+    return _throttle_counts.pop(queue_name, 0)
+
+class ConcurrencyController:
+    """
+    AIMD controller of the number of messages of a queue processed at a time.
+
+    Every adjust_interval_secs, the controller compares the median latency of
+    the messages completed since the last adjustment to a baseline:
+    - on throttling, or when latency exceeds the baseline by latency_tolerance,
+      concurrency is multiplied by decrease_factor
+    - otherwise, while the backlog is not shrinking, concurrency grows by increase_step
+    - when the queue is empty, concurrency shrinks by increase_step
+
+    The baseline follows the latency slowly while it is healthy, so that
+    latency growing with load is detected, but it never follows degraded
+    latency.
+    """
+    def __init__(self,
+                 queue_name: str,
+                 initial_concurrency: int,
+                 min_concurrency: int = 1,
+                 max_concurrency: Optional[int] = None,
+                 increase_step: int = 1,
+                 decrease_factor: float = 0.5,
+                 latency_tolerance: float = 1.5,
+                 adjust_interval_secs: float = 10,
+                 baseline_weight: float = 0.1,
+                 max_history: int = 20):
+        self.queue_name = queue_name
+        self.min_concurrency = max(min_concurrency, 1)
+        self.max_concurrency = max(max_concurrency or initial_concurrency * 4, self.min_concurrency)
+        self.concurrency = min(max(initial_concurrency, self.min_concurrency), self.max_concurrency)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.adjust_interval_secs = adjust_interval_secs
+        self.baseline_weight = baseline_weight
+
+        self.baseline_latency_secs = None
+        self.last_latency_secs = None
+        self.last_pending = None
+        self.last_reason = None
+        self.last_adjust_at = time.monotonic()
+        self.latencies = []
+        self.history = deque(maxlen=max_history)
+
+    def record_latency(self, latency_secs: float):
+        """
+        Record the processing time of a completed message.
+
+        Args:
+            latency_secs: Processing time in seconds
+        """
+        self.latencies.append(latency_secs)
+
+    def is_due(self) -> bool:
+        """
+        Check whether the next adjustment is due.
+        """
+        return time.monotonic() - self.last_adjust_at >= self.adjust_interval_secs
+
+    def adjust(self, pending: int, n_throttled: int = 0) -> int:
+        """
+        Adjust the concurrency.
+
+        Args:
+            pending: Number of pending messages in the queue
+            n_throttled: Number of throttling errors since the last adjustment
+
+        Returns:
+            int: The new concurrency
+        """
+        latency = statistics.median(self.latencies) if self.latencies else None
+        self.latencies = []
+        self.last_adjust_at = time.monotonic()
+        self.last_latency_secs = latency
+
+        degraded = (latency is not None and self.baseline_latency_secs is not None
+                    and latency > self.baseline_latency_secs * self.latency_tolerance)
+
+        if n_throttled > 0:
+            new_concurrency = int(self.concurrency * self.decrease_factor)
+            reason = CONCURRENCY_REASON_THROTTLED
+        elif degraded:
+            new_concurrency = int(self.concurrency * self.decrease_factor)
+            reason = CONCURRENCY_REASON_LATENCY
+        elif pending == 0:
+            new_concurrency = self.concurrency - self.increase_step
+            reason = CONCURRENCY_REASON_IDLE
+        elif self.last_pending is None or pending >= self.last_pending:
+            new_concurrency = self.concurrency + self.increase_step
+            reason = CONCURRENCY_REASON_BACKLOG
+        else:
+            # Backlog shrinking at the current concurrency
+            new_concurrency = self.concurrency
+            reason = None
+
+        # Track healthy latency only
+        if latency is not None and not degraded and n_throttled == 0:
+            if self.baseline_latency_secs is None:
+                self.baseline_latency_secs = latency
+            else:
+                self.baseline_latency_secs += self.baseline_weight * (latency - self.baseline_latency_secs)
+
+        self.last_pending = pending
+        new_concurrency = min(max(new_concurrency, self.min_concurrency), self.max_concurrency)
+        if new_concurrency != self.concurrency:
+            logger.info(f"Concurrency of {self.queue_name} {self.concurrency} -> {new_concurrency}: {reason} "
+                        f"(pending {pending}, latency {latency}, baseline {self.baseline_latency_secs}, "
+                        f"throttled {n_throttled})")
+            self.history.append({
+                "at": datetime.now(UTC),
+                "from_concurrency": self.concurrency,
+                "to_concurrency": new_concurrency,
+                "reason": reason,
+                "pending": pending,
+                "latency_secs": latency
+            })
+            self.concurrency = new_concurrency
+            self.last_reason = reason
+        return self.concurrency
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """
+        Get the state of the controller.
+
+        Returns:
+            dict: The current concurrency, its bounds, the latencies and the recent changes
+        """
+        return {
+            "concurrency": self.concurrency,
+            "min_concurrency": self.min_concurrency,
+            "max_concurrency": self.max_concurrency,
+            "latency_secs": self.last_latency_secs,
+            "baseline_latency_secs": self.baseline_latency_secs,
+            "last_reason": self.last_reason,
+            "history": list(self.history)
+        }
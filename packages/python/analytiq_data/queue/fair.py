@@ -0,0 +1,298 @@
+from typing import Optional, Dict, Any, List
+import heapq
+import os
+import logging
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Scheduling modes
+SCHEDULING_FIFO = "fifo"  # Oldest message first, across all organizations
+SCHEDULING_FAIR = "fair"  # Weighted fair share across organizations
+
+# Per-queue scheduling modes. Queues not listed use the QUEUE_SCHEDULING
+# environment variable, which defaults to fifo.
+SCHEDULING_MODES = {}
+
+DEFAULT_ORG_WEIGHT = 1.0
+DEFAULT_ORG_MAX_PROCESSING = None  # No per-organization concurrency cap
+
+# Schedule document holding the virtual clock of a queue
+VIRTUAL_CLOCK_ID = "__virtual_clock__"
+
+# Set on the messages claimed with fair scheduling, whose organization
+# processing counter must be decremented when they stop processing
+ORG_SLOT_FIELD = "org_slot"
+
+def get_scheduling_mode(queue_name: str) -> str:
+    """
+    Get the scheduling mode of a queue.
+
+    Args:
+        queue_name: Name of the queue
+
+    Returns:
+        str: SCHEDULING_FIFO or SCHEDULING_FAIR
+    """
+    return SCHEDULING_MODES.get(queue_name, os.getenv("QUEUE_SCHEDULING", SCHEDULING_FIFO))
+
+def set_scheduling_mode(queue_name: str, mode: str):
+    """
+    Set the scheduling mode of a queue.
+
+    Args:
+        queue_name: Name of the queue
+        mode: SCHEDULING_FIFO or SCHEDULING_FAIR
+    """
+    if mode not in (SCHEDULING_FIFO, SCHEDULING_FAIR):
+        raise ValueError(f"Unknown scheduling mode: {mode}")
+    SCHEDULING_MODES[queue_name] = mode
+
+def get_schedule_collection_name(queue_name: str) -> str:
+    """
+    Get the name of the collection holding the per-organization schedule of a queue.
+
+    Args:
+        queue_name: Name of the queue
+
+    Returns:
+        str: The name of the schedule collection
+    """
+    return ad.queue.get_queue_collection_name(f"{queue_name}_orgs")
+
+async def set_org_schedule(analytiq_client,
+                           queue_name: str,
+                           organization_id: str,
+                           weight: Optional[float] = None,
+                           max_processing: Optional[int] = None):
+    """
+    Set the fair scheduling parameters of an organization.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        organization_id: The organization ID
+        weight: Share of the queue relative to other organizations (default: 1)
+        max_processing: Maximum number of messages of the organization processed at once
+    """
+    db = analytiq_client.mongodb_async[analytiq_client.env]
+    schedule_collection = db[get_schedule_collection_name(queue_name)]
+
+    await schedule_collection.update_one(
+        {"_id": organization_id},
+        {"$set": {"weight": weight, "max_processing": max_processing}},
+        upsert=True
+    )
+
+async def _reserve_org_slots(schedule_collection, org_id, k: int, max_processing: int) -> int:
+    """
+    Atomically reserve up to k processing slots of an organization without
+    going over its max_processing cap.
+
+    Returns:
+        int: The number of slots reserved
+    """
+    while k > 0:
+        result = await schedule_collection.update_one(
+            {"_id": org_id, "processing": {"$not": {"$gt": max_processing - k}}},
+            {"$inc": {"processing": k}}
+        )
+        if result.modified_count > 0:
+            return k
+        # Other workers took slots meanwhile, try with the slots that are left
+        state = await schedule_collection.find_one({"_id": org_id}, {"processing": 1})
+        k = min(k - 1, max_processing - (state or {}).get("processing", 0))
+    return 0
+
+async def release_org_slots(analytiq_client, queue_name: str, msgs: List[Dict[str, Any]]):
+    """
+    Release the processing slots held by messages claimed with fair scheduling
+    once they leave the processing status. Failures are logged and ignored,
+    as the counters are corrected by sync_org_slots().
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        msgs: The messages as they were while processing, with their organization_id and org_slot
+    """
+    counts = {}
+    for msg in msgs:
+        if msg.get("status") != "processing" or not msg.get(ORG_SLOT_FIELD):
+            continue
+        org_id = msg.get("organization_id")
+        if org_id is not None:
+            counts[org_id] = counts.get(org_id, 0) + 1
+    if not counts:
+        return
+
+    db = analytiq_client.mongodb_async[analytiq_client.env]
+    schedule_collection = db[get_schedule_collection_name(queue_name)]
+    try:
+        for org_id, n in counts.items():
+            await schedule_collection.update_one({"_id": org_id}, {"$inc": {"processing": -n}})
+    except Exception as e:
+        logger.warning(f"Failed to release organization slots of queue {queue_name}: {e}")
+
+async def sync_org_slots(analytiq_client, queue_name: str):
+    """
+    Reset the per-organization processing counters of a queue to the actual
+    counts. Counters can drift when a process dies between a claim and the
+    counter update, so this is run periodically by the workers.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+    """
+    db = analytiq_client.mongodb_async[analytiq_client.env]
+    queue_collection = db[ad.queue.get_queue_collection_name(queue_name)]
+    schedule_collection = db[get_schedule_collection_name(queue_name)]
+
+    counts = {}
+    async for elem in queue_collection.aggregate([
+        {"$match": {"status": "processing", ORG_SLOT_FIELD: True, "organization_id": {"$ne": None}}},
+        {"$group": {"_id": "$organization_id", "processing": {"$sum": 1}}}
+    ]):
+        counts[elem["_id"]] = elem["processing"]
+
+    async for state in schedule_collection.find({"processing": {"$exists": True}}, {"processing": 1}):
+        if counts.get(state["_id"], 0) != state["processing"]:
+            await schedule_collection.update_one({"_id": state["_id"]},
+                                                 {"$set": {"processing": counts.get(state["_id"], 0)}})
+        counts.pop(state["_id"], None)
+    for org_id, n in counts.items():
+        await schedule_collection.update_one({"_id": org_id}, {"$set": {"processing": n}}, upsert=True)
+
+async def claim_fair(queue_collection,
+                     schedule_collection,
+                     n: int,
+                     claim_msgs) -> List[Dict[str, Any]]:
+    """
+    Claim up to n messages, sharing them between organizations with weighted
+    fair queuing.
+
+    Each organization has a virtual time that advances by 1/weight for every
+    message it is served. Claims go to the organizations with messages ready
+    to be delivered and the lowest virtual time. An organization that was idle
+    restarts at the virtual clock of the queue, so it cannot bank credit while
+    idle. If an organization has fewer messages than it was allotted, the
+    claims it leaves unused go to the next organizations.
+
+    The organizations with pending messages come from a distinct() on the
+    (status, organization_id, ready_at) index, which is a DISTINCT_SCAN over
+    the index keys, and each organization is claimed from with an indexed
+    query on its ready messages, so the pending set is never scanned. An
+    organization whose messages are all delayed comes back short from its
+    claim, and leaves its claims to the others. The processing slots of an
+    organization with a max_processing cap are reserved on its schedule
+    document before claiming, so concurrent workers cannot go over the cap.
+
+    Args:
+        queue_collection: The queue collection
+        schedule_collection: The collection holding the per-organization schedule
+        n: Maximum number of messages to claim
+        claim_msgs: Coroutine function claim_msgs(k, query) claiming up to k
+            ready messages matching query, earliest first, and marking them with ORG_SLOT_FIELD
+
+    Returns:
+        List[Dict]: The claimed messages
+    """
+    # Only the status is filtered on, so that distinct() reads the index keys
+    # alone. Messages sent without an organization are returned as None.
+    org_ids = await queue_collection.distinct("organization_id", {"status": "pending"})
+    if not org_ids:
+        return []
+
+    states = {}
+    async for state in schedule_collection.find({"_id": {"$in": org_ids + [VIRTUAL_CLOCK_ID]}}):
+        states[state["_id"]] = state
+    clock = states.pop(VIRTUAL_CLOCK_ID, {}).get("vtime", 0.0)
+
+    # Each organization starts at its own virtual time, or at the clock if it fell behind
+    vtimes = {}
+    weights = {}
+    slots = {}
+    caps = {}
+    for org_id in org_ids:
+        state = states.get(org_id, {})
+        vtimes[org_id] = max(state.get("vtime", clock), clock)
+        weights[org_id] = state.get("weight") or DEFAULT_ORG_WEIGHT
+        slots[org_id] = n
+
+        max_processing = state.get("max_processing", DEFAULT_ORG_MAX_PROCESSING)
+        if max_processing is not None:
+            caps[org_id] = max_processing
+            slots[org_id] = min(n, max_processing - state.get("processing", 0))
+    active = {org_id for org_id in org_ids if slots[org_id] > 0}
+
+    msgs = []
+    allotted = {}
+    while len(msgs) < n and active:
+        # Share the claims left, lowest virtual time first
+        heap = [(vtimes[org_id], str(org_id), org_id) for org_id in active]
+        heapq.heapify(heap)
+        allotment = {}
+        for _ in range(n - len(msgs)):
+            if not heap:
+                break
+            vtime, key, org_id = heapq.heappop(heap)
+            allotment[org_id] = allotment.get(org_id, 0) + 1
+            if allotment[org_id] < slots[org_id]:
+                heapq.heappush(heap, (vtime + 1 / weights[org_id], key, org_id))
+
+        for org_id, k in allotment.items():
+            claimed = await _claim_org(schedule_collection, org_id, k, caps.get(org_id), claim_msgs)
+            allotted[org_id] = allotted.get(org_id, 0) + len(claimed)
+
+            # An organization that came back short has nothing left to claim
+            slots[org_id] -= len(claimed)
+            if len(claimed) < k or slots[org_id] <= 0:
+                active.discard(org_id)
+            if not claimed:
+                continue
+            msgs.extend(claimed)
+
+            # Advance the virtual time of the organization by the messages it was served
+            start_vtime = vtimes[org_id]
+            vtimes[org_id] += len(claimed) / weights[org_id]
+            update = {"vtime": {"$add": [
+                {"$max": [{"$ifNull": ["$vtime", start_vtime]}, start_vtime]},
+                len(claimed) / weights[org_id]
+            ]}}
+            if org_id not in caps and org_id is not None:
+                # Capped organizations counted their slots when reserving them
+                update["processing"] = {"$add": [{"$ifNull": ["$processing", 0]}, len(claimed)]}
+            await schedule_collection.update_one({"_id": org_id}, [{"$set": update}], upsert=True)
+            await schedule_collection.update_one(
+                {"_id": VIRTUAL_CLOCK_ID},
+                {"$max": {"vtime": start_vtime}},
+                upsert=True
+            )
+
+    if msgs:
+        logger.debug(f"Fair claim on {queue_collection.name}: {allotted}")
+    return msgs
+
+async def _claim_org(schedule_collection,
+                     org_id,
+                     k: int,
+                     max_processing: Optional[int],
+                     claim_msgs) -> List[Dict[str, Any]]:
+    """
+    Claim up to k messages of an organization, within its max_processing cap.
+    """
+    if max_processing is None:
+        return await claim_msgs(k, {"organization_id": org_id})
+
+    reserved = await _reserve_org_slots(schedule_collection, org_id, k, max_processing)
+    if reserved == 0:
+        return []
+    claimed = []
+    try:
+        claimed = await claim_msgs(reserved, {"organization_id": org_id})
+    finally:
+        # Give back the slots of the messages that were not there to claim
+        if len(claimed) < reserved:
+            await schedule_collection.update_one({"_id": org_id},
+                                                 {"$inc": {"processing": len(claimed) - reserved}})
+    return claimed
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, UTC
+from contextlib import asynccontextmanager
+from typing import Dict, Any
+from pymongo.errors import DuplicateKeyError
+import asyncio
+import logging
+
+from .queue import LEASE_SECS, _get_queue_collection, _claimed_filter, ensure_queue_indexes, delete_msg
+from .retry import SUPERSEDED_STATUS, get_retry_policy, dead_letter_msg
+from .stats import update_queue_stats
+from .fair import ORG_SLOT_FIELD, release_org_slots
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of expired messages returned to the queue by one reaper pass
+RECLAIM_BATCH_SIZE = 100
+
+async def extend_lease(analytiq_client,
+                       queue_name: str,
+                       msg: Dict[str, Any],
+                       lease_secs: float = LEASE_SECS) -> bool:
+    """
+    Extend the lease of a claimed message, if it is still held by the claim
+    it was received with.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msg: The claimed message, with its worker_id and claim_id
+        lease_secs: New lease duration in seconds, counted from now
+
+    Returns:
+        bool: True if the lease was extended, False if the claim was lost
+    """
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    result = await queue_collection.update_one(
+        _claimed_filter(msg),
+        {"$set": {"lease_expires_at": datetime.now(UTC) + timedelta(seconds=lease_secs)}}
+    )
+    if result.matched_count == 0:
+        logger.warning(f"Lease on message {msg['_id']} in {queue_name} is no longer held by {msg.get('worker_id')}")
+        return False
+    return True
+
+@asynccontextmanager
+async def lease_heartbeat(analytiq_client,
+                          queue_name: str,
+                          msg: Dict[str, Any],
+                          lease_secs: float = LEASE_SECS):
+    """
+    Keep extending the lease of a claimed message while the body of the
+    `async with` block runs, so that long jobs are not reclaimed.
+
+    The lease is extended every third of its duration.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msg: The claimed message
+        lease_secs: Lease duration in seconds
+    """
+    msg_id = str(msg["_id"])
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(lease_secs / 3)
+            try:
+                if not await extend_lease(analytiq_client, queue_name, msg, lease_secs):
+                    return
+            except Exception as e:
+                logger.warning(f"Failed to extend lease on message {msg_id} in {queue_name}: {e}")
+
+    task = asyncio.create_task(heartbeat())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+async def reclaim_expired_msgs(analytiq_client, queue_name: str, limit: int = RECLAIM_BATCH_SIZE) -> int:
+    """
+    Return messages whose lease has expired to the queue.
+
+    Each message keeps its attempt counter, which was incremented when it was
+    claimed, and is dead-lettered once it has used up the attempts allowed by
+    the retry policy of the queue. The queries are served by the
+    (status, lease_expires_at) index.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        limit: Maximum number of messages to reclaim in this pass
+
+    Returns:
+        int: The number of reclaimed messages
+    """
+    await ensure_queue_indexes(analytiq_client, queue_name)
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+    policy = get_retry_policy(queue_name)
+
+    n_reclaimed = 0
+    while n_reclaimed < limit:
+        now = datetime.now(UTC)
+        expired_filter = {"status": "processing", "lease_expires_at": {"$lt": now}}
+
+        # Messages with attempts left go back to the queue. The expired lease
+        # already delayed them, so they are ready right away.
+        msg_data = await queue_collection.find_one({**expired_filter, "attempts": {"$lt": policy.max_attempts}})
+        if msg_data is not None:
+            try:
+                result = await queue_collection.update_one(
+                    {"_id": msg_data["_id"], **expired_filter},
+                    {
+                        "$set": {"status": "pending", "last_error": "Lease expired"},
+                        "$unset": {"worker_id": "", "claim_id": "", "lease_expires_at": "", ORG_SLOT_FIELD: ""}
+                    }
+                )
+            except DuplicateKeyError:
+                # A pending message with the same idempotency key will run the job
+                n_reclaimed += 1
+                await delete_msg(analytiq_client, queue_name, str(msg_data["_id"]),
+                                 status=SUPERSEDED_STATUS, claim_id=msg_data.get("claim_id"))
+                logger.warning(f"Message {msg_data['_id']} in {queue_name} with an expired lease "
+                               f"superseded by a pending message with the same idempotency key")
+                continue
+            if result.modified_count > 0:
+                n_reclaimed += 1
+                await update_queue_stats(analytiq_client, queue_name, {"processing": -1, "pending": 1, "reclaimed": 1})
+                await release_org_slots(analytiq_client, queue_name, [msg_data])
+                logger.warning(f"Reclaimed message {msg_data['_id']} in {queue_name} from worker "
+                               f"{msg_data.get('worker_id')} after {msg_data.get('attempts', 0)} attempts")
+            continue
+
+        # Messages out of attempts are dead-lettered
+        msg_data = await queue_collection.find_one(expired_filter)
+        if msg_data is None:
+            break
+        n_reclaimed += 1
+        await dead_letter_msg(analytiq_client, queue_name, msg_data,
+                              f"Lease of worker {msg_data.get('worker_id')} expired")
+
+    return n_reclaimed
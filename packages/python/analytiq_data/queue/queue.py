@@ -1,12 +1,42 @@
-from datetime import datetime, UTC
-from typing import Optional, Dict, Any
+from datetime import datetime, timedelta, UTC
+from typing import Optional, Dict, Any, List, Tuple
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import asyncio
+import os
 import logging
 
 import analytiq_data as ad
+from analytiq_data.mongodb import ensure_index
+from .watch import get_queue_watcher
+from .fair import (SCHEDULING_FAIR, ORG_SLOT_FIELD, get_scheduling_mode, get_schedule_collection_name,
+                   claim_fair, release_org_slots)
+from .stats import update_queue_stats, record_completed_msgs
 
 logger = logging.getLogger(__name__)
 
+# Polling interval used by recv_msg() when change streams are not available
+RECV_POLL_INTERVAL_SECS = 0.2
+
+# Even with change streams, re-check the queue at least this often so that a
+# message inserted while the stream was being (re)opened is never stranded
+RECV_MAX_WAIT_SECS = 5.0
+
+# Default visibility timeout of a claimed message. A message whose lease
+# expires before it is deleted is returned to the queue by reclaim_expired_msgs()
+LEASE_SECS = 300
+
+# Completed and failed messages are removed by a TTL index this long after
+# they finish. Failed messages are kept in the dead-letter queue regardless.
+QUEUE_RETENTION_SECS = int(os.getenv("QUEUE_RETENTION_SECS", str(7 * 24 * 3600)))
+
+# Error code of a unique index violation
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# Queues whose indexes were already ensured by this process, keyed by (env, queue_name)
+_indexed_queues = set()
+
 def get_queue_collection_name(queue_name: str) -> str:
     """
     Get the name of the queue collection.
@@ -19,10 +49,127 @@ def get_queue_collection_name(queue_name: str) -> str:
     """
     return f"queues.{queue_name}"
 
+def _get_queue_collection(analytiq_client, queue_name: str):
+    db_name = analytiq_client.env
+    db = analytiq_client.mongodb_async[db_name]
+    return db[get_queue_collection_name(queue_name)]
+
+async def ensure_queue_indexes(analytiq_client, queue_name: str):
+    """
+    Create the indexes used by the queue, once per process.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+    """
+    key = (analytiq_client.env, queue_name)
+    if key in _indexed_queues:
+        return
+
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    # Used by reclaim_expired_msgs() to find expired leases without a scan
+    await ensure_index(
+        collection=queue_collection,
+        index_spec=[("status", 1), ("lease_expires_at", 1)],
+        index_name="status_lease_expires_at_idx",
+        drop_other_indexes=False
+    )
+
+    # Used by fair scheduling to list the organizations with pending messages
+    # and to claim the earliest ready messages of an organization
+    await ensure_index(
+        collection=queue_collection,
+        index_spec=[("status", 1), ("organization_id", 1), ("ready_at", 1)],
+        index_name="status_organization_id_ready_at_idx",
+        drop_other_indexes=False
+    )
+
+    # Used by the claim queries, which take the earliest ready messages. Messages
+    # delayed by a retry are past the end of the range, so they are never fetched.
+    await ensure_index(
+        collection=queue_collection,
+        index_spec=[("status", 1), ("ready_at", 1)],
+        index_name="status_ready_at_idx",
+        drop_other_indexes=False
+    )
+
+    # Used by get_queue_stats() to find the oldest pending message
+    await ensure_index(
+        collection=queue_collection,
+        index_spec=[("status", 1), ("created_at", 1)],
+        index_name="status_created_at_idx",
+        drop_other_indexes=False
+    )
+
+    # Collapses duplicate pending jobs: at most one pending message per idempotency key
+    await queue_collection.create_index(
+        "idempotency_key",
+        name="idempotency_key_pending_idx",
+        unique=True,
+        partialFilterExpression={"status": "pending", "idempotency_key": {"$exists": True}}
+    )
+
+    # Expires finished messages, so the collection does not grow without bound
+    await _ensure_ttl_index(queue_collection, "finished_at", "finished_at_ttl_idx", QUEUE_RETENTION_SECS)
+
+    # Messages sent before ready times were recorded are ready at their not_before time
+    await queue_collection.update_many(
+        {"status": "pending", "ready_at": {"$exists": False}},
+        [{"$set": {"ready_at": {"$max": ["$created_at", {"$ifNull": ["$not_before", "$created_at"]}]}}}]
+    )
+    # Messages sent before organizations were recorded have none, so that
+    # fair scheduling finds them with distinct()
+    await queue_collection.update_many(
+        {"status": "pending", "organization_id": {"$exists": False}},
+        {"$set": {"organization_id": None}}
+    )
+    _indexed_queues.add(key)
+
+async def _ensure_ttl_index(collection, field: str, index_name: str, expire_after_secs: int):
+    """
+    Create a TTL index, or update its expiry if it already exists with another one.
+    """
+    existing_indexes = await collection.list_indexes().to_list(length=None)
+    for index in existing_indexes:
+        if index["name"] != index_name:
+            continue
+        if index.get("expireAfterSeconds") != expire_after_secs:
+            await collection.database.command({
+                "collMod": collection.name,
+                "index": {"name": index_name, "expireAfterSeconds": expire_after_secs}
+            })
+            logger.info(f"Set expiry of index {index_name} on {collection.name} to {expire_after_secs}s")
+        return
+
+    await collection.create_index([(field, 1)], name=index_name, expireAfterSeconds=expire_after_secs)
+    logger.info(f"Created TTL index {index_name} on {collection.name} with expiry {expire_after_secs}s")
+
+def _claim_update(worker_id: Optional[str], lease_secs: float) -> dict:
+    """
+    Get the update that claims a message for a worker until its lease expires.
+    Each claim gets a unique claim id, so that a worker whose lease was lost
+    cannot complete or retry the message once another worker claimed it.
+    """
+    now = datetime.now(UTC)
+    return {
+        "$set": {
+            "status": "processing",
+            "worker_id": worker_id,
+            "claim_id": ObjectId(),
+            "claimed_at": now,
+            "lease_expires_at": now + timedelta(seconds=lease_secs)
+        },
+        "$inc": {"attempts": 1}
+    }
+
 async def send_msg(
     analytiq_client,
     queue_name: str,
-    msg: Optional[Dict[str, Any]] = None
+    msg: Optional[Dict[str, Any]] = None,
+    not_before: Optional[datetime] = None,
+    organization_id: Optional[str] = None,
+    idempotency_key: Optional[str] = None
 ) -> str:
     """
     Send a message to the queue.
@@ -30,69 +177,400 @@ async def send_msg(
     Args:
         analytiq_client: The AnalytiqClient instance
         queue_name: Name of the queue collection
-        msg_type: Type of message to send
         msg: Optional message data
+        not_before: Optional time before which the message is not delivered
+        organization_id: Optional organization the message belongs to, used by fair scheduling
+        idempotency_key: Optional key of the job. If a pending message with the
+            same key is already in the queue, no message is sent.
 
     Returns:
-        str: The ID of the created message
+        str: The ID of the created message, or of the pending message with the same idempotency key
     """
-    db_name = analytiq_client.env
-    db = analytiq_client.mongodb_async[db_name]
-    queue_collection_name = get_queue_collection_name(queue_name)
-    queue_collection = db[queue_collection_name]
+    msg_ids = await send_msgs(analytiq_client, queue_name, [msg],
+                              not_before=not_before,
+                              organization_id=organization_id,
+                              idempotency_keys=[idempotency_key])
+    return msg_ids[0]
+
+async def send_msgs(
+    analytiq_client,
+    queue_name: str,
+    msgs: List[Optional[Dict[str, Any]]],
+    not_before: Optional[datetime] = None,
+    organization_id: Optional[str] = None,
+    idempotency_keys: Optional[List[Optional[str]]] = None
+) -> List[str]:
+    """
+    Send a batch of messages to the queue with a single insert.
+
+    Messages with an idempotency key are deduplicated against the pending
+    messages of the queue by a unique partial index: a message whose key is
+    already pending is not sent, and the ID of the pending message is
+    returned instead.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msgs: The message data
+        not_before: Optional time before which the messages are not delivered
+        organization_id: Optional organization the messages belong to, used by fair scheduling
+        idempotency_keys: Optional keys of the jobs, one per message. None entries are not deduplicated.
+
+    Returns:
+        List[str]: The IDs of the messages, in the order of msgs
+    """
+    if not msgs:
+        return []
+    if idempotency_keys is None:
+        idempotency_keys = [None] * len(msgs)
+    if len(idempotency_keys) != len(msgs):
+        raise ValueError("idempotency_keys must have one entry per message")
+
+    # The unique index on idempotency keys must exist before the insert
+    await ensure_queue_indexes(analytiq_client, queue_name)
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    now = datetime.now(UTC)
+    docs = []
+    for msg, idempotency_key in zip(msgs, idempotency_keys):
+        msg_data = {
+            "status": "pending",
+            "created_at": now,
+            "ready_at": not_before if not_before is not None else now,
+            "organization_id": organization_id,
+            "msg": msg
+        }
+        if not_before is not None:
+            msg_data["not_before"] = not_before
+        if idempotency_key is not None:
+            msg_data["idempotency_key"] = idempotency_key
+        docs.append(msg_data)
+
+    duplicates = set()
+    try:
+        await queue_collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") != DUPLICATE_KEY_ERROR_CODE:
+                raise
+            duplicates.add(error["index"])
+
+    msg_ids = []
+    n_deduplicated = 0
+    for i, msg_data in enumerate(docs):
+        if i in duplicates:
+            msg_id, inserted = await _insert_or_get_pending(queue_collection, msg_data)
+            msg_ids.append(msg_id)
+            n_deduplicated += 0 if inserted else 1
+        else:
+            msg_ids.append(str(msg_data["_id"]))
 
-    msg_data = {
-        "status": "pending",
-        "created_at": datetime.now(UTC),
-        "msg": msg
+    n_sent = len(docs) - n_deduplicated
+    await update_queue_stats(analytiq_client, queue_name,
+                             {"pending": n_sent, "sent": n_sent, "deduplicated": n_deduplicated})
+    if n_deduplicated:
+        logger.info(f"Sent {n_sent} messages to {queue_name}, {n_deduplicated} already pending")
+    else:
+        logger.info(f"Sent messages: {msg_ids} to {queue_name}")
+    return msg_ids
+
+async def _insert_or_get_pending(queue_collection, msg_data: Dict[str, Any]) -> Tuple[str, bool]:
+    """
+    Get the ID of the pending message holding the idempotency key of a
+    message. If that message was claimed in the meantime, insert the message
+    after all. Returns the message ID, and whether the message was inserted.
+    """
+    msg_data.pop("_id", None)
+    while True:
+        existing = await queue_collection.find_one(
+            {"idempotency_key": msg_data["idempotency_key"], "status": "pending"},
+            {"_id": 1}
+        )
+        if existing is not None:
+            return str(existing["_id"]), False
+        try:
+            result = await queue_collection.insert_one(msg_data)
+            return str(result.inserted_id), True
+        except DuplicateKeyError:
+            msg_data.pop("_id", None)
+
+def _claimed_filter(msg: Dict[str, Any]) -> dict:
+    """
+    Get the filter matching a message only while it is still held by the
+    claim it was received with.
+    """
+    return {
+        "_id": ObjectId(msg["_id"]),
+        "status": "processing",
+        "worker_id": msg.get("worker_id"),
+        "claim_id": msg.get("claim_id")
     }
 
-    result = await queue_collection.insert_one(msg_data)
-    msg_id = str(result.inserted_id)
-    logger.info(f"Sent message: {msg_id} to {queue_name}")
-    return msg_id
+def _pending_filter(query: Optional[dict] = None) -> dict:
+    """
+    Get the filter matching the messages that are ready to be delivered,
+    restricted by an optional query. A message is ready at its ready_at time:
+    when it is sent, or at its not_before time if it is delayed.
+    """
+    return {**(query or {}), "status": "pending", "ready_at": {"$lte": datetime.now(UTC)}}
 
-async def recv_msg(analytiq_client, queue_name: str) -> Optional[Dict[str, Any]]:
+async def _claim_msg(queue_collection, worker_id: Optional[str], lease_secs: float) -> Optional[Dict[str, Any]]:
+    """
+    Atomically claim the earliest ready message in a queue collection.
+    """
+    return await queue_collection.find_one_and_update(
+        _pending_filter(),
+        _claim_update(worker_id, lease_secs),
+        sort=[("ready_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+async def _claim_msgs(queue_collection,
+                      n: int,
+                      worker_id: Optional[str],
+                      lease_secs: float,
+                      query: Optional[dict] = None,
+                      fields: Optional[dict] = None) -> List[Dict[str, Any]]:
+    """
+    Atomically claim up to n of the earliest ready messages in a queue
+    collection, restricted by an optional query, and set optional fields on them.
+
+    The candidates are tagged with a unique claim id by a single update_many()
+    that only matches messages that are still pending, so messages raced away
+    by another consumer are simply not returned.
+    """
+    cursor = queue_collection.find(_pending_filter(query), {"_id": 1}).sort("ready_at", 1).limit(n)
+    candidates = await cursor.to_list(length=n)
+    if not candidates:
+        return []
+
+    candidate_ids = [elem["_id"] for elem in candidates]
+    update = _claim_update(worker_id, lease_secs)
+    update["$set"].update(fields or {})
+    claim_id = update["$set"]["claim_id"]
+    await queue_collection.update_many(
+        {"_id": {"$in": candidate_ids}, "status": "pending"},
+        update
+    )
+    # Restricted to the candidates, so that the _id index serves the query
+    cursor = queue_collection.find({"_id": {"$in": candidate_ids}, "claim_id": claim_id}).sort("ready_at", 1)
+    return await cursor.to_list(length=n)
+
+async def _claim_msgs_scheduled(analytiq_client,
+                                queue_name: str,
+                                queue_collection,
+                                n: int,
+                                worker_id: Optional[str],
+                                lease_secs: float) -> List[Dict[str, Any]]:
+    """
+    Claim up to n messages following the scheduling mode of the queue.
+    """
+    if get_scheduling_mode(queue_name) != SCHEDULING_FAIR:
+        if n == 1:
+            msg_data = await _claim_msg(queue_collection, worker_id, lease_secs)
+            msgs = [msg_data] if msg_data is not None else []
+        else:
+            msgs = await _claim_msgs(queue_collection, n, worker_id, lease_secs)
+    else:
+        db = analytiq_client.mongodb_async[analytiq_client.env]
+        schedule_collection = db[get_schedule_collection_name(queue_name)]
+
+        async def claim_msgs(k: int, query: dict) -> List[Dict[str, Any]]:
+            return await _claim_msgs(queue_collection, k, worker_id, lease_secs, query,
+                                     fields={ORG_SLOT_FIELD: True})
+
+        msgs = await claim_fair(queue_collection, schedule_collection, n, claim_msgs)
+
+    if msgs:
+        await update_queue_stats(analytiq_client, queue_name,
+                                 {"pending": -len(msgs), "processing": len(msgs), "claimed": len(msgs)})
+    return msgs
+
+async def _wait_and_claim(analytiq_client, queue_collection, claim, timeout: Optional[float]):
+    """
+    Run claim() until it returns a message, or until the timeout expires.
+
+    Waiting uses a MongoDB change stream on the queue collection, shared by all
+    consumers in the process, and falls back to polling every
+    RECV_POLL_INTERVAL_SECS on a standalone mongod.
+    """
+    if timeout is None:
+        return await claim()
+
+    # Start watching before the first claim so that no insert is missed
+    watcher = get_queue_watcher(analytiq_client, queue_collection)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        result = await claim()
+        if result:
+            return result
+
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return result
+
+        if watcher.supported is False:
+            await asyncio.sleep(min(RECV_POLL_INTERVAL_SECS, remaining))
+        elif watcher.supported is None:
+            # Change stream is still being opened
+            await watcher.wait(min(RECV_POLL_INTERVAL_SECS, remaining))
+        else:
+            await watcher.wait(min(RECV_MAX_WAIT_SECS, remaining))
+
+async def recv_msg(analytiq_client,
+                   queue_name: str,
+                   timeout: Optional[float] = None,
+                   worker_id: Optional[str] = None,
+                   lease_secs: float = LEASE_SECS) -> Optional[Dict[str, Any]]:
     """
     Receive and claim the next available message from the queue.
+
+    If timeout is given and the queue is empty, wait up to timeout seconds
+    for a message to arrive. The claim is a lease: unless the message is
+    deleted or its lease is extended with extend_lease() within lease_secs,
+    reclaim_expired_msgs() returns it to the queue.
     
     Args:
         analytiq_client: The AnalytiqClient instance
         queue_name: Name of the queue collection
+        timeout: Maximum time to wait for a message in seconds. If None, return immediately.
+        worker_id: Optional ID of the worker claiming the message
+        lease_secs: Lease duration in seconds
     
     Returns:
         Optional[Dict]: The message document if found, None otherwise
     """
-    db_name = analytiq_client.env
-    db = analytiq_client.mongodb_async[db_name]
-    queue_collection_name = get_queue_collection_name(queue_name)
-    queue_collection = db[queue_collection_name]
+    await ensure_queue_indexes(analytiq_client, queue_name)
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
 
-    msg_data = await queue_collection.find_one_and_update(
-        {"status": "pending"},
-        {"$set": {"status": "processing"}},
-        sort=[("created_at", 1)]
-    )
-    
-    return msg_data
+    async def claim():
+        msgs = await _claim_msgs_scheduled(analytiq_client, queue_name, queue_collection, 1, worker_id, lease_secs)
+        return msgs[0] if msgs else None
+
+    return await _wait_and_claim(analytiq_client, queue_collection, claim, timeout)
+
+async def recv_msgs(analytiq_client,
+                    queue_name: str,
+                    n: int,
+                    worker_id: Optional[str] = None,
+                    timeout: Optional[float] = None,
+                    lease_secs: float = LEASE_SECS) -> List[Dict[str, Any]]:
+    """
+    Receive and claim up to n available messages from the queue in one batch.
+
+    Claiming a batch costs three queries no matter how many messages are
+    claimed. Fewer than n messages may be returned if the queue holds fewer,
+    or if other consumers claim some of the candidates first. If the queue
+    uses fair scheduling, the batch is shared between organizations as
+    described in claim_fair().
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        n: Maximum number of messages to claim
+        worker_id: Optional ID of the worker claiming the messages
+        timeout: Maximum time to wait for messages in seconds. If None, return immediately.
+        lease_secs: Lease duration in seconds
+
+    Returns:
+        List[Dict]: The claimed message documents
+    """
+    if n <= 0:
+        return []
+
+    await ensure_queue_indexes(analytiq_client, queue_name)
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    async def claim():
+        return await _claim_msgs_scheduled(analytiq_client, queue_name, queue_collection, n, worker_id, lease_secs)
+
+    return await _wait_and_claim(analytiq_client, queue_collection, claim, timeout)
 
-async def delete_msg(analytiq_client, queue_name: str, msg_id: str, status: str = "completed"):
+async def delete_msg(analytiq_client,
+                     queue_name: str,
+                     msg_id: str,
+                     status: str = "completed",
+                     claim_id: Optional[ObjectId] = None) -> bool:
     """
-    Delete/complete a message by updating its status.
+    Delete/complete a message by updating its status. The message is removed
+    QUEUE_RETENTION_SECS later by the TTL index of the queue.
+
+    If claim_id is given, the message is only completed while it is still held
+    by that claim. A worker whose lease expired and was reclaimed by another
+    worker then leaves the message alone.
     
     Args:
         analytiq_client: The AnalytiqClient instance
         queue_name: Name of the queue collection
         msg_id: The ID of the message to delete
         status: The final status to set (default: "completed")
+        claim_id: Optional claim id of the message, as received
+
+    Returns:
+        bool: False if the message was not found, or is no longer held by the claim
     """
-    db_name = analytiq_client.env
-    db = analytiq_client.mongodb_async[db_name]
-    queue_collection_name = get_queue_collection_name(queue_name)
-    queue_collection = db[queue_collection_name]
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    query = {"_id": ObjectId(msg_id)}
+    if claim_id is not None:
+        query.update({"status": "processing", "claim_id": claim_id})
+
+    # Return the message as it was, for the stats
+    msg_data = await queue_collection.find_one_and_update(
+        query,
+        {"$set": {"status": status, "finished_at": datetime.now(UTC)}},
+        projection={"status": 1, "worker_id": 1, "claimed_at": 1, "organization_id": 1, ORG_SLOT_FIELD: 1}
+    )
+    if msg_data is None:
+        logger.warning(f"Message {msg_id} in {queue_name} not deleted, its claim was lost")
+        return False
+    await record_completed_msgs(analytiq_client, queue_name, [msg_data], status)
+    await release_org_slots(analytiq_client, queue_name, [msg_data])
+    logger.info(f"Deleted message {msg_id} from {queue_name} with status: {status}")
+    return True
+
+async def delete_msgs(analytiq_client,
+                      queue_name: str,
+                      msg_ids: List[str],
+                      status: str = "completed",
+                      claim_ids: Optional[List[ObjectId]] = None):
+    """
+    Delete/complete a batch of messages with a single update.
+
+    If claim_ids is given, only the messages still held by one of those claims
+    are completed, as in delete_msg().
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msg_ids: The IDs of the messages to delete
+        status: The final status to set (default: "completed")
+        claim_ids: Optional claim ids the messages were received with
+    """
+    if not msg_ids:
+        return
+
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+    query = {"_id": {"$in": [ObjectId(msg_id) for msg_id in msg_ids]}}
+    if claim_ids is not None:
+        query.update({"status": "processing", "claim_id": {"$in": list(set(claim_ids))}})
+
+    # Read the messages as they were, for the stats
+    cursor = queue_collection.find(query, {"status": 1, "worker_id": 1, "claimed_at": 1,
+                                           "organization_id": 1, ORG_SLOT_FIELD: 1})
+    msgs = await cursor.to_list(length=None)
+    if not msgs:
+        return
 
-    await queue_collection.update_one(
-        {"_id": ObjectId(msg_id)},
-        {"$set": {"status": status}}
+    # Only the messages read above, so that the stats match the update
+    await queue_collection.update_many(
+        {**query, "_id": {"$in": [msg["_id"] for msg in msgs]}},
+        {"$set": {"status": status, "finished_at": datetime.now(UTC)}}
     )
-    logger.info(f"Deleted message {msg_id} from {queue_name} with status: {status}") 
\ No newline at end of file
+    await record_completed_msgs(analytiq_client, queue_name, msgs, status)
+    await release_org_slots(analytiq_client, queue_name, msgs)
+    if len(msgs) < len(msg_ids):
+        logger.warning(f"{len(msg_ids) - len(msgs)} messages in {queue_name} not deleted, their claims were lost")
+    logger.info(f"Deleted {len(msgs)} messages from {queue_name} with status: {status}")
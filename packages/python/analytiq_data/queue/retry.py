@@ -0,0 +1,244 @@
+from datetime import datetime, timedelta, UTC
+from typing import Optional, Dict, Any, List
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
+import random
+import logging
+
+from .queue import _get_queue_collection, _claimed_filter, send_msg, delete_msg
+from .stats import update_queue_stats
+from .fair import ORG_SLOT_FIELD, release_org_slots
+from .concurrency import is_throttling_error, record_throttle
+
+logger = logging.getLogger(__name__)
+
+class RetryPolicy:
+    """
+    Retry policy of a queue: how many times a message is attempted, and how
+    long to wait between attempts.
+
+    The delay before attempt n+1 grows exponentially from base_delay_secs,
+    is capped at max_delay_secs, and is randomized between half and all of
+    that value so that messages failing together do not retry together.
+    """
+    def __init__(self, max_attempts: int = 3, base_delay_secs: float = 10, max_delay_secs: float = 300):
+        self.max_attempts = max_attempts
+        self.base_delay_secs = base_delay_secs
+        self.max_delay_secs = max_delay_secs
+
+    def get_delay_secs(self, attempts: int) -> float:
+        """
+        Get the delay before the next attempt.
+
+        Args:
+            attempts: Number of attempts made so far
+
+        Returns:
+            float: Delay in seconds
+        """
+        delay = min(self.max_delay_secs, self.base_delay_secs * 2 ** max(attempts - 1, 0))
+        return random.uniform(delay / 2, delay)
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+# Final status of a message that was not retried because a pending message
+# with the same idempotency key will run the job
+SUPERSEDED_STATUS = "superseded"
+
+# Per-queue retry policies. Textract throttling and LLM rate limits can last
+# minutes, so those queues back off further.
+RETRY_POLICIES = {
+    "ocr": RetryPolicy(max_attempts=5, base_delay_secs=30, max_delay_secs=900),
+    "llm": RetryPolicy(max_attempts=5, base_delay_secs=10, max_delay_secs=600),
+}
+
+def get_retry_policy(queue_name: str) -> RetryPolicy:
+    """
+    Get the retry policy of a queue.
+
+    Args:
+        queue_name: Name of the queue
+
+    Returns:
+        RetryPolicy: The retry policy
+    """
+    return RETRY_POLICIES.get(queue_name, DEFAULT_RETRY_POLICY)
+
+def set_retry_policy(queue_name: str, policy: RetryPolicy):
+    """
+    Set the retry policy of a queue.
+
+    Args:
+        queue_name: Name of the queue
+        policy: The retry policy
+    """
+    RETRY_POLICIES[queue_name] = policy
+
+def get_dead_letter_queue_name(queue_name: str) -> str:
+    """
+    Get the name of the dead-letter queue of a queue.
+
+    Args:
+        queue_name: Name of the queue
+
+    Returns:
+        str: Name of the dead-letter queue
+    """
+    return f"{queue_name}_err"
+
+async def retry_msg(analytiq_client, queue_name: str, msg: Dict[str, Any], error: Optional[str] = None) -> bool:
+    """
+    Return a failed message to the queue for a later attempt, or move it to
+    the dead-letter queue once the retry policy of the queue is exhausted.
+
+    Only the claim the message was received with can retry it. If the lease
+    expired and the message was reclaimed since, it is left to its new owner.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msg: The claimed message
+        error: Optional description of the failure
+
+    Returns:
+        bool: True if the message will be retried, or its claim was lost, False if it was dead-lettered
+    """
+    policy = get_retry_policy(queue_name)
+    attempts = msg.get("attempts", 0)
+
+    # Throttling makes the worker back off its concurrency
+    if is_throttling_error(error):
+        record_throttle(queue_name)
+
+    if attempts < policy.max_attempts:
+        delay_secs = policy.get_delay_secs(attempts)
+        ready_at = datetime.now(UTC) + timedelta(seconds=delay_secs)
+        queue_collection = _get_queue_collection(analytiq_client, queue_name)
+        try:
+            result = await queue_collection.update_one(
+                _claimed_filter(msg),
+                {
+                    "$set": {
+                        "status": "pending",
+                        "not_before": ready_at,
+                        "ready_at": ready_at,
+                        "last_error": error
+                    },
+                    "$unset": {"worker_id": "", "claim_id": "", "lease_expires_at": "", ORG_SLOT_FIELD: ""}
+                }
+            )
+        except DuplicateKeyError:
+            # The same job was sent again while this message was processed,
+            # and the pending message will run it
+            await delete_msg(analytiq_client, queue_name, str(msg["_id"]),
+                             status=SUPERSEDED_STATUS, claim_id=msg.get("claim_id"))
+            logger.info(f"Message {msg['_id']} in {queue_name} not retried, "
+                        f"superseded by a pending message with the same idempotency key")
+            return True
+        if result.matched_count > 0:
+            await update_queue_stats(analytiq_client, queue_name, {"processing": -1, "pending": 1, "retried": 1})
+            await release_org_slots(analytiq_client, queue_name, [msg])
+            logger.info(f"Message {msg['_id']} in {queue_name} will be retried in {delay_secs:.1f}s "
+                        f"after {attempts} attempts: {error}")
+            return True
+        logger.warning(f"Message {msg['_id']} in {queue_name} not retried, its claim was lost")
+        return True
+
+    if not await dead_letter_msg(analytiq_client, queue_name, msg, error):
+        logger.warning(f"Message {msg['_id']} in {queue_name} not dead-lettered, its claim was lost")
+        return True
+    return False
+
+async def dead_letter_msg(analytiq_client, queue_name: str, msg: Dict[str, Any], error: Optional[str] = None) -> bool:
+    """
+    Move a claimed message to the dead-letter queue and mark it failed, if it
+    is still held by the claim it was received with.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue collection
+        msg: The claimed message
+        error: Optional description of the failure
+
+    Returns:
+        bool: False if the message is no longer held by its claim
+    """
+    dlq_collection = _get_queue_collection(analytiq_client, get_dead_letter_queue_name(queue_name))
+    queue_collection = _get_queue_collection(analytiq_client, queue_name)
+
+    msg_id = ObjectId(msg["_id"])
+    prev_msg = await queue_collection.find_one_and_update(
+        _claimed_filter(msg),
+        {"$set": {"status": "failed", "last_error": error, "finished_at": datetime.now(UTC)}},
+        projection={"status": 1, "organization_id": 1, ORG_SLOT_FIELD: 1}
+    )
+    if prev_msg is None:
+        return False
+    await update_queue_stats(analytiq_client, queue_name, {"processing": -1, "failed": 1, "dead_lettered": 1})
+    await release_org_slots(analytiq_client, queue_name, [prev_msg])
+
+    try:
+        await dlq_collection.insert_one({
+            "_id": msg_id,
+            "status": "failed",
+            "created_at": msg.get("created_at"),
+            "failed_at": datetime.now(UTC),
+            "attempts": msg.get("attempts", 0),
+            "error": error,
+            "organization_id": msg.get("organization_id"),
+            "idempotency_key": msg.get("idempotency_key"),
+            "msg": msg.get("msg")
+        })
+    except DuplicateKeyError:
+        # Already dead-lettered
+        pass
+
+    logger.error(f"Message {msg_id} in {queue_name} moved to {get_dead_letter_queue_name(queue_name)} "
+                 f"after {msg.get('attempts', 0)} attempts: {error}")
+    return True
+
+async def list_dead_msgs(analytiq_client, queue_name: str, limit: int = 100) -> List[Dict[str, Any]]:
+    """
+    List the messages in the dead-letter queue of a queue, oldest failure first.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        limit: Maximum number of messages to return
+
+    Returns:
+        List[Dict]: The dead-lettered messages
+    """
+    dlq_collection = _get_queue_collection(analytiq_client, get_dead_letter_queue_name(queue_name))
+    cursor = dlq_collection.find().sort("failed_at", 1).limit(limit)
+    return await cursor.to_list(length=limit)
+
+async def requeue_dead_msgs(analytiq_client, queue_name: str, msg_ids: Optional[List[str]] = None) -> int:
+    """
+    Send dead-lettered messages back to their queue as new messages, with a
+    fresh attempt counter.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        msg_ids: IDs of the messages to requeue. If None, requeue all of them.
+
+    Returns:
+        int: The number of requeued messages
+    """
+    dlq_collection = _get_queue_collection(analytiq_client, get_dead_letter_queue_name(queue_name))
+
+    query = {}
+    if msg_ids is not None:
+        query["_id"] = {"$in": [ObjectId(msg_id) for msg_id in msg_ids]}
+
+    n_requeued = 0
+    async for dead_msg in dlq_collection.find(query):
+        await send_msg(analytiq_client, queue_name, msg=dead_msg.get("msg"),
+                       organization_id=dead_msg.get("organization_id"),
+                       idempotency_key=dead_msg.get("idempotency_key"))
+        await dlq_collection.delete_one({"_id": dead_msg["_id"]})
+        n_requeued += 1
+
+    logger.info(f"Requeued {n_requeued} messages from {get_dead_letter_queue_name(queue_name)} to {queue_name}")
+    return n_requeued
@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta, UTC
+from typing import Optional, Dict, Any, List
+import logging
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Collection holding one counters document per queue
+QUEUE_STATS_COLLECTION = "queue_stats"
+
+# Collection holding per-worker completion counts, one document per worker and minute
+QUEUE_WORKER_STATS_COLLECTION = "queue_worker_stats"
+
+# Per-worker completion counts are kept this long
+WORKER_STATS_RETENTION_SECS = 24 * 3600
+
+# Upper bounds of the claim-to-complete latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000,
+                      120000, 300000, 600000, 1800000, 3600000]
+
+# Envs whose stats indexes were already ensured by this process
+_indexed_envs = set()
+
+def _get_db(analytiq_client):
+    return analytiq_client.mongodb_async[analytiq_client.env]
+
+def _get_latency_bucket(latency_ms: float) -> str:
+    for bound in LATENCY_BUCKETS_MS:
+        if latency_ms <= bound:
+            return str(bound)
+    return "inf"
+
+async def _ensure_stats_indexes(analytiq_client):
+    if analytiq_client.env in _indexed_envs:
+        return
+    worker_stats = _get_db(analytiq_client)[QUEUE_WORKER_STATS_COLLECTION]
+    await worker_stats.create_index([("queue", 1), ("minute", 1)], name="queue_minute_idx")
+    await worker_stats.create_index("minute", name="minute_ttl_idx", expireAfterSeconds=WORKER_STATS_RETENTION_SECS)
+    _indexed_envs.add(analytiq_client.env)
+
+async def update_queue_stats(analytiq_client, queue_name: str, counts: Dict[str, int]):
+    """
+    Increment the counters of a queue. Failures are logged and ignored, so
+    that stats never break queue operations.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        counts: Increments keyed by counter name, e.g. {"pending": -1, "processing": 1}
+    """
+    counts = {key: value for key, value in counts.items() if value}
+    if not counts:
+        return
+    try:
+        await _get_db(analytiq_client)[QUEUE_STATS_COLLECTION].update_one(
+            {"_id": queue_name},
+            {"$inc": counts},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Failed to update stats of queue {queue_name}: {e}")
+
+async def record_completed_msgs(analytiq_client, queue_name: str, msgs: List[Dict[str, Any]], status: str):
+    """
+    Record processing messages reaching a final status. Completed messages
+    also update the claim-to-complete latency histogram and the per-worker
+    throughput.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        msgs: The messages as they were before completion, with their claimed_at and worker_id
+        status: The final status
+    """
+    msgs = [msg for msg in msgs if msg.get("status") == "processing"]
+    if not msgs:
+        return
+
+    now = datetime.now(UTC)
+    counts = {"processing": -len(msgs), status: len(msgs)}
+    if status != "completed":
+        await update_queue_stats(analytiq_client, queue_name, counts)
+        return
+
+    worker_counts = {}
+    for msg in msgs:
+        claimed_at = msg.get("claimed_at")
+        if claimed_at is not None:
+            latency_ms = (now - claimed_at.replace(tzinfo=UTC)).total_seconds() * 1000
+            bucket = f"latency_buckets.{_get_latency_bucket(latency_ms)}"
+            counts[bucket] = counts.get(bucket, 0) + 1
+            counts["latency_sum_ms"] = counts.get("latency_sum_ms", 0) + int(latency_ms)
+        worker_id = msg.get("worker_id")
+        if worker_id is not None:
+            worker_counts[worker_id] = worker_counts.get(worker_id, 0) + 1
+
+    await update_queue_stats(analytiq_client, queue_name, counts)
+
+    if not worker_counts:
+        return
+    try:
+        await _ensure_stats_indexes(analytiq_client)
+        minute = now.replace(second=0, microsecond=0)
+        worker_stats = _get_db(analytiq_client)[QUEUE_WORKER_STATS_COLLECTION]
+        for worker_id, n in worker_counts.items():
+            await worker_stats.update_one(
+                {"queue": queue_name, "worker_id": worker_id, "minute": minute},
+                {"$inc": {"completed": n}},
+                upsert=True
+            )
+    except Exception as e:
+        logger.warning(f"Failed to update worker stats of queue {queue_name}: {e}")
+
+async def set_concurrency_metrics(analytiq_client, queue_name: str, worker_id: str, metrics: Dict[str, Any]):
+    """
+    Publish the state of the concurrency controller of a worker. Failures are
+    logged and ignored.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        worker_id: The worker ID
+        metrics: The state of the controller, from ConcurrencyController.get_metrics()
+    """
+    try:
+        await _get_db(analytiq_client)[QUEUE_STATS_COLLECTION].update_one(
+            {"_id": queue_name},
+            {"$set": {f"concurrency.{worker_id}": {**metrics, "updated_at": datetime.now(UTC)}}},
+            upsert=True
+        )
+    except Exception as e:
+        logger.warning(f"Failed to update concurrency metrics of queue {queue_name}: {e}")
+
+async def get_queue_depth(analytiq_client, queue_name: str) -> int:
+    """
+    Get the number of pending messages of a queue from its counters.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+
+    Returns:
+        int: The number of pending messages
+    """
+    counters = await _get_db(analytiq_client)[QUEUE_STATS_COLLECTION].find_one({"_id": queue_name}, {"pending": 1})
+    return max((counters or {}).get("pending", 0), 0)
+
+def _get_latency_percentile(buckets: Dict[str, int], percentile: float) -> Optional[float]:
+    """
+    Estimate a latency percentile from the histogram, as the upper bound of
+    the bucket holding it.
+    """
+    total = sum(buckets.values())
+    if total == 0:
+        return None
+    rank = percentile / 100 * total
+    seen = 0
+    for bound in [str(bound) for bound in LATENCY_BUCKETS_MS] + ["inf"]:
+        seen += buckets.get(bound, 0)
+        if seen >= rank:
+            return float(bound)
+    return float("inf")
+
+async def get_queue_stats(analytiq_client, queue_name: str, window_mins: int = 5) -> Dict[str, Any]:
+    """
+    Get the stats of a queue.
+
+    Counts come from the counters kept by the queue operations, and the age
+    of the oldest pending message from one indexed query, so that this is
+    cheap enough to scrape frequently.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+        window_mins: Window in minutes over which the worker throughput is computed
+
+    Returns:
+        dict: The queue stats
+    """
+    db = _get_db(analytiq_client)
+    counters = await db[QUEUE_STATS_COLLECTION].find_one({"_id": queue_name}) or {}
+
+    now = datetime.now(UTC)
+    oldest = await db[ad.queue.get_queue_collection_name(queue_name)].find_one(
+        {"status": "pending"},
+        {"created_at": 1},
+        sort=[("created_at", 1)]
+    )
+    oldest_pending_age_secs = None
+    if oldest is not None:
+        oldest_pending_age_secs = (now - oldest["created_at"].replace(tzinfo=UTC)).total_seconds()
+
+    buckets = counters.get("latency_buckets", {})
+    latency_count = sum(buckets.values())
+
+    # Per-worker throughput over the window
+    since = (now - timedelta(minutes=window_mins)).replace(second=0, microsecond=0)
+    workers = {}
+    async for elem in db[QUEUE_WORKER_STATS_COLLECTION].find({"queue": queue_name, "minute": {"$gte": since}}):
+        workers[elem["worker_id"]] = workers.get(elem["worker_id"], 0) + elem.get("completed", 0)
+
+    # Concurrency of the workers that reported during the window
+    concurrency = [
+        {"worker_id": worker_id, **metrics}
+        for worker_id, metrics in sorted(counters.get("concurrency", {}).items())
+        if metrics.get("updated_at") is not None and metrics["updated_at"].replace(tzinfo=UTC) >= since
+    ]
+
+    return {
+        "queue": queue_name,
+        "pending": max(counters.get("pending", 0), 0),
+        "processing": max(counters.get("processing", 0), 0),
+        "oldest_pending_age_secs": oldest_pending_age_secs,
+        "sent": counters.get("sent", 0),
+        "deduplicated": counters.get("deduplicated", 0),
+        "claimed": counters.get("claimed", 0),
+        "completed": counters.get("completed", 0),
+        "failed": counters.get("failed", 0),
+        "retried": counters.get("retried", 0),
+        "reclaimed": counters.get("reclaimed", 0),
+        "dead_lettered": counters.get("dead_lettered", 0),
+        "latency_ms": {
+            "count": latency_count,
+            "mean": counters.get("latency_sum_ms", 0) / latency_count if latency_count else None,
+            "p50": _get_latency_percentile(buckets, 50),
+            "p90": _get_latency_percentile(buckets, 90),
+            "p99": _get_latency_percentile(buckets, 99),
+            "buckets": buckets
+        },
+        "workers": [
+            {"worker_id": worker_id, "completed": completed, "per_min": completed / window_mins}
+            for worker_id, completed in sorted(workers.items())
+        ],
+        "concurrency": concurrency
+    }
+
+async def sync_queue_stats(analytiq_client, queue_name: str):
+    """
+    Reset the pending and processing counters of a queue to the actual counts.
+    Counters can drift when a process dies between a queue operation and the
+    counter update, so this is run periodically by the workers.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_name: Name of the queue
+    """
+    db = _get_db(analytiq_client)
+    queue_collection = db[ad.queue.get_queue_collection_name(queue_name)]
+    pending = await queue_collection.count_documents({"status": "pending"})
+    processing = await queue_collection.count_documents({"status": "processing"})
+    await db[QUEUE_STATS_COLLECTION].update_one(
+        {"_id": queue_name},
+        {"$set": {"pending": pending, "processing": processing}},
+        upsert=True
+    )
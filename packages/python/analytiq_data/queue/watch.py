@@ -0,0 +1,125 @@
+import asyncio
+import logging
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before reopening a change stream after a transient error
+WATCH_RETRY_SECS = 1.0
+
+# Upper bound on the number of queued wakeups. Wakeups that nobody consumes
+# only cost a spurious claim attempt, so there is no need to keep many.
+MAX_PENDING_WAKEUPS = 1000
+
+# Watchers keyed by (event loop, env, queue collection name)
+_watchers = {}
+
+class QueueWatcher:
+    """
+    Watch a queue collection with a MongoDB change stream and wake up
+    consumers waiting for new messages.
+
+    One watcher is shared by all consumers of a queue in a process, so idle
+    workers cost a single long-polling cursor per queue. Each new message
+    wakes up one waiter. When change streams are not available (standalone
+    mongod), `supported` becomes False and callers fall back to polling.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+        self.supported = None  # Unknown until the change stream is opened
+        self._condition = asyncio.Condition()
+        self._pending = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def notify(self):
+        """Record one wakeup and wake up one waiter"""
+        async with self._condition:
+            self._pending = min(self._pending + 1, MAX_PENDING_WAKEUPS)
+            self._condition.notify(1)
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Wait for a new message notification.
+
+        Args:
+            timeout: Maximum time to wait in seconds
+
+        Returns:
+            bool: True if a notification was received, False on timeout
+        """
+        async with self._condition:
+            try:
+                await asyncio.wait_for(self._condition.wait_for(lambda: self._pending > 0), timeout)
+            except asyncio.TimeoutError:
+                return False
+            self._pending -= 1
+            return True
+
+    def _pipeline(self) -> list:
+        # New messages, and messages returned to the queue
+        return [{"$match": {"$or": [
+            {"operationType": "insert"},
+            {"operationType": "update", "updateDescription.updatedFields.status": "pending"}
+        ]}}]
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.collection.watch(self._pipeline()) as stream:
+                    self.supported = True
+                    logger.info(f"Watching {self.collection.name} for new messages")
+                    async for _ in stream:
+                        await self.notify()
+            except asyncio.CancelledError:
+                raise
+            except OperationFailure as e:
+                # Change streams require a replica set or sharded cluster
+                logger.info(f"Change streams not available for {self.collection.name}, falling back to polling: {e}")
+                self.supported = False
+                return
+            except Exception as e:
+                logger.warning(f"Change stream on {self.collection.name} failed, reopening: {e}")
+                # Wake up a waiter so that no message is missed while the stream is down
+                await self.notify()
+                await asyncio.sleep(WATCH_RETRY_SECS)
+
+def get_queue_watcher(analytiq_client, queue_collection) -> QueueWatcher:
+    """
+    Get the change stream watcher for a queue collection, starting it if needed.
+
+    Args:
+        analytiq_client: The AnalytiqClient instance
+        queue_collection: The queue collection
+
+    Returns:
+        QueueWatcher: The watcher shared by all consumers in this event loop
+    """
+    key = (asyncio.get_running_loop(), analytiq_client.env, queue_collection.name)
+    watcher = _watchers.get(key)
+    if watcher is None:
+        watcher = QueueWatcher(queue_collection)
+        _watchers[key] = watcher
+        watcher.start()
+    return watcher
+
+async def stop_queue_watchers():
+    """
+    Stop all queue watchers started in the current event loop.
+    """
+    loop = asyncio.get_running_loop()
+    for key in [key for key in _watchers if key[0] is loop]:
+        watcher = _watchers.pop(key)
+        await watcher.stop()
@@ -28,6 +28,7 @@ from app.routes.payments import payments_router, init_payments
 from app.routes.documents import documents_router
 from app.routes.ocr import ocr_router
 from app.routes.llm import llm_router
+from app.routes.queues import queues_router
 from app.routes.prompts import prompts_router
 from app.routes.schemas import schemas_router
 from app.routes.tags import tags_router
@@ -159,6 +160,7 @@ app.include_router(payments_router)
 app.include_router(documents_router)
 app.include_router(ocr_router)
 app.include_router(llm_router)
+app.include_router(queues_router)
 app.include_router(prompts_router)
 app.include_router(schemas_router)
 app.include_router(tags_router)
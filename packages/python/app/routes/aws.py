@@ -82,6 +82,7 @@ async def create_aws_config(
         {"$set": update_data},
         upsert=True
     )
+    await ad.aws.invalidate_aws_clients()
     
     return {"message": "AWS configuration saved successfully"}
 
@@ -106,4 +107,5 @@ async def delete_aws_config(current_user: User = Depends(get_admin_user)):
     result = await db.aws_config.delete_one({"user_id": current_user.user_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="AWS configuration not found")
+    await ad.aws.invalidate_aws_clients()
     return {"message": "AWS configuration deleted successfully"}
@@ -2,14 +2,17 @@
 
 # Standard library imports
 from datetime import datetime, UTC
+from email.utils import format_datetime, parsedate_to_datetime
 import os
 import base64
 import logging
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
+from urllib.parse import quote
 from pydantic import BaseModel, Field, ConfigDict
 
 # Third-party imports
-from fastapi import APIRouter, Depends, HTTPException, Query, Body
+from fastapi import APIRouter, Depends, HTTPException, Query, Body, Header, Response
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
 
 # Local imports
@@ -134,66 +137,74 @@ async def upload_document(
                 detail=f"Invalid tag IDs: {list(invalid_tags)}"
             )
 
-    for document in documents_upload.documents:
-        try:
-            mime_type = get_mime_type(document.name)
-            ext = os.path.splitext(document.name)[1].lower()
-        except ValueError as e:
-            raise HTTPException(status_code=400, detail=str(e))
-
-        content = decode_base64_content(document.content)
-        document_id = ad.common.create_id()
-        mongo_file_name = f"{document_id}{ext}"
-
-        metadata = {
-            "document_id": document_id,
-            "type": mime_type,
-            "size": len(content),
-            "user_file_name": document.name
-        }
-
-        # Save the document to mongodb
-        await ad.common.save_file_async(analytiq_client,
-                                        file_name=mongo_file_name,
-                                        blob=content,
-                                        metadata=metadata)
-
-        if mime_type == "application/pdf":
-            pdf_id = document_id
-            pdf_file_name = mongo_file_name
-        else:
-            # Convert to PDF and save
-            pdf_blob = ad.common.file.convert_to_pdf(content, ext)  # You will implement this function
-            pdf_id = ad.common.create_id()
-            pdf_file_name = f"{pdf_id}.pdf"
-            await ad.common.save_file_async(analytiq_client, pdf_file_name, pdf_blob, metadata)
-
-        document_metadata = {
-            "_id": ObjectId(document_id),
-            "user_file_name": document.name,
-            "mongo_file_name": mongo_file_name,
-            "document_id": document_id,
-            "pdf_id": pdf_id,
-            "pdf_file_name": pdf_file_name,
-            "upload_date": datetime.now(UTC),
-            "uploaded_by": current_user.user_name,
-            "state": ad.common.doc.DOCUMENT_STATE_UPLOADED,
-            "tag_ids": document.tag_ids,
-            "metadata": document.metadata,
-            "organization_id": organization_id
-        }
+    try:
+        for document in documents_upload.documents:
+            try:
+                mime_type = get_mime_type(document.name)
+                ext = os.path.splitext(document.name)[1].lower()
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+
+            content = decode_base64_content(document.content)
+            document_id = ad.common.create_id()
+            mongo_file_name = f"{document_id}{ext}"
+
+            metadata = {
+                "document_id": document_id,
+                "type": mime_type,
+                "size": len(content),
+                "user_file_name": document.name
+            }
+
+            # Save the document to mongodb
+            await ad.common.save_file_async(analytiq_client,
+                                            file_name=mongo_file_name,
+                                            blob=content,
+                                            metadata=metadata)
+
+            if mime_type == "application/pdf":
+                pdf_id = document_id
+                pdf_file_name = mongo_file_name
+                pdf_blob = content
+            else:
+                # Convert to PDF and save
+                pdf_blob = ad.common.file.convert_to_pdf(content, ext)  # You will implement this function
+                pdf_id = ad.common.create_id()
+                pdf_file_name = f"{pdf_id}.pdf"
+                await ad.common.save_file_async(analytiq_client, pdf_file_name, pdf_blob, metadata)
+
+            document_metadata = {
+                "_id": ObjectId(document_id),
+                "user_file_name": document.name,
+                "mongo_file_name": mongo_file_name,
+                "document_id": document_id,
+                "pdf_id": pdf_id,
+                "pdf_file_name": pdf_file_name,
+                "pdf_sha256": ad.common.get_pdf_sha256(pdf_blob) if pdf_blob is not None else None,
+                "upload_date": datetime.now(UTC),
+                "uploaded_by": current_user.user_name,
+                "state": ad.common.doc.DOCUMENT_STATE_UPLOADED,
+                "tag_ids": document.tag_ids,
+                "metadata": document.metadata,
+                "organization_id": organization_id
+            }
         
-        await ad.common.save_doc(analytiq_client, document_metadata)
-        documents.append({
-            "document_name": document.name,
-            "document_id": document_id,
-            "tag_ids": document.tag_ids,
-            "metadata": document.metadata
-        })
-
-        # Post a message to the ocr job queue
-        msg = {"document_id": document_id}
-        await ad.queue.send_msg(analytiq_client, "ocr", msg=msg)
+            await ad.common.save_doc(analytiq_client, document_metadata)
+            documents.append({
+                "document_name": document.name,
+                "document_id": document_id,
+                "tag_ids": document.tag_ids,
+                "metadata": document.metadata
+            })
+    finally:
+        # Post the messages to the ocr job queue in one batch, including for the
+        # documents saved before an error. The document ID is the idempotency
+        # key, so a document is never queued twice for OCR.
+        document_ids = [document["document_id"] for document in documents]
+        await ad.queue.send_msgs(analytiq_client, "ocr",
+                                 msgs=[{"document_id": document_id} for document_id in document_ids],
+                                 organization_id=organization_id,
+                                 idempotency_keys=document_ids)
     
     return {"documents": documents}
 
@@ -330,6 +341,79 @@ async def list_documents(
         skip=skip
     )
 
+def get_document_file_name(document: dict, file_type: str) -> str:
+    """Get the name of the stored file of a document: the original, or the associated PDF"""
+    if file_type == "pdf":
+        return document.get("pdf_file_name", document.get("mongo_file_name"))
+    return document.get("mongo_file_name")
+
+def get_returned_mime_type(document: dict, file_metadata: Optional[dict]) -> Optional[str]:
+    """
+    Determine the MIME type of a returned file.
+    Prefer the stored metadata.type; fall back to inferring it from the original name.
+    """
+    try:
+        returned_mime = file_metadata.get("type")
+    except Exception:
+        returned_mime = None
+    if not returned_mime:
+        try:
+            returned_mime = get_mime_type(document["user_file_name"])
+        except Exception:
+            returned_mime = None
+    return returned_mime
+
+def parse_range_header(range_header: str, length: int) -> Optional[Tuple[int, int]]:
+    """
+    Parse an HTTP Range header for a single byte range.
+
+    Returns:
+        (start, end) with end exclusive. None if the header is to be ignored:
+        malformed, not in bytes, or with several ranges, for which the whole file is returned.
+
+    Raises:
+        HTTPException: 416 if the range is not satisfiable
+    """
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, sep, last = ranges.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else max(length, start + 1)
+            if start < 0 or end <= start:
+                return None
+        else:
+            # Suffix range: the last bytes of the file
+            suffix = int(last)
+            if suffix < 0:
+                return None
+            start, end = max(length - suffix, 0), length
+            if suffix == 0:
+                start = length
+    except ValueError:
+        return None
+
+    if start >= length:
+        raise HTTPException(status_code=416, detail="Range not satisfiable",
+                            headers={"Content-Range": f"bytes */{length}"})
+    return start, min(end, length)
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header with an ETag"""
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or etag in tags
+
+def _parse_http_date(value: str) -> Optional[datetime]:
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    return date if date.tzinfo is not None else date.replace(tzinfo=UTC)
+
 @documents_router.get("/v0/orgs/{organization_id}/documents/{document_id}", response_model=DocumentResponse)
 async def get_document(
     organization_id: str,
@@ -339,7 +423,10 @@ async def get_document(
                            description="Which file to retrieve: 'original' or 'pdf'"),
     current_user: User = Depends(get_org_user)
 ):
-    """Get a document (original or associated PDF)"""
+    """
+    Get a document (original or associated PDF), with its content base64 encoded.
+    Large files are better downloaded with GET .../documents/{document_id}/file, which streams them.
+    """
     logger.debug(f"get_document() start: document_id: {document_id}, file_type: {file_type}")
     analytiq_client = ad.common.get_analytiq_client()
     db = ad.common.get_async_db(analytiq_client)
@@ -356,30 +443,15 @@ async def get_document(
         
     logger.debug(f"get_document() found document: {document}")
 
-    # Decide which file to return
-    if file_type == "pdf":
-        file_name = document.get("pdf_file_name", document.get("mongo_file_name"))
-    else:
-        file_name = document.get("mongo_file_name")
-
     # Get the file from mongodb
+    file_name = get_document_file_name(document, file_type)
     file = await ad.common.get_file_async(analytiq_client, file_name)
     if file is None:
         raise HTTPException(status_code=404, detail="File not found")
 
     logger.debug(f"get_document() got file: {file_name}")
 
-    # Determine MIME type for the file being returned
-    # Prefer stored metadata.type; fall back to inferring from original name
-    try:
-        returned_mime = file["metadata"].get("type")
-    except Exception:
-        returned_mime = None
-    if not returned_mime:
-        try:
-            returned_mime = get_mime_type(document["user_file_name"])
-        except Exception:
-            returned_mime = None
+    returned_mime = get_returned_mime_type(document, file["metadata"])
 
     # Return flattened response
     return DocumentResponse(
@@ -395,6 +467,91 @@ async def get_document(
         content=base64.b64encode(file["blob"]).decode('utf-8')
     )
 
+@documents_router.get("/v0/orgs/{organization_id}/documents/{document_id}/file")
+async def download_document_file(
+    organization_id: str,
+    document_id: str,
+    file_type: str = Query(default="original",
+                           enum=["original", "pdf"],
+                           description="Which file to retrieve: 'original' or 'pdf'"),
+    range_header: Optional[str] = Header(default=None, alias="Range"),
+    if_range: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
+    current_user: User = Depends(get_org_user)
+):
+    """
+    Download the file of a document (original or associated PDF) as raw bytes.
+
+    The file is streamed from MongoDB chunk by chunk. Single byte ranges
+    (Range, If-Range) and conditional requests (If-None-Match, If-Modified-Since)
+    are supported, so that viewers can fetch large files piece by piece.
+    """
+    analytiq_client = ad.common.get_analytiq_client()
+    db = ad.common.get_async_db(analytiq_client)
+
+    # Get document with organization scope
+    document = await db.docs.find_one({
+        "_id": ObjectId(document_id),
+        "organization_id": organization_id
+    })
+    if not document:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    file_name = get_document_file_name(document, file_type)
+    file_info = await ad.common.get_file_info_async(analytiq_client, file_name)
+    if file_info is None:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    length = file_info["length"]
+    etag = f'"{file_info["file_id"]}"'
+    # HTTP dates have a resolution of one second
+    last_modified = file_info["upload_date"] or document["upload_date"]
+    last_modified = last_modified.replace(tzinfo=UTC, microsecond=0)
+
+    download_name = document["user_file_name"]
+    if file_type == "pdf" and not download_name.lower().endswith(".pdf"):
+        download_name = os.path.splitext(download_name)[0] + ".pdf"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(download_name)}",
+    }
+
+    # Conditional GET: If-None-Match takes precedence over If-Modified-Since
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    else:
+        since = _parse_http_date(if_modified_since) if if_modified_since else None
+        not_modified = since is not None and last_modified <= since
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+
+    # Range request, ignored if the file changed since the client's If-Range validator
+    byte_range = None
+    if range_header is not None:
+        if if_range is None or if_range.strip() == etag or \
+                _parse_http_date(if_range) == last_modified:
+            byte_range = parse_range_header(range_header, length)
+
+    if byte_range is None:
+        start, end, status_code = 0, length, 200
+    else:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{length}"
+    headers["Content-Length"] = str(end - start)
+
+    return StreamingResponse(
+        ad.common.iter_file_async(analytiq_client, file_name, start=start, end=end,
+                                  file_id=file_info["file_id"]),
+        status_code=status_code,
+        headers=headers,
+        media_type=get_returned_mime_type(document, file_info["metadata"]) or "application/octet-stream"
+    )
+
 @documents_router.delete("/v0/orgs/{organization_id}/documents/{document_id}")
 async def delete_document(
     organization_id: str,
@@ -7,7 +7,7 @@ from pydantic import BaseModel
 
 # Third-party imports
 from fastapi import APIRouter, Depends, HTTPException, Query, Response
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 
 # Local imports
 import analytiq_data as ad
@@ -29,10 +29,11 @@ class GetOCRMetadataResponse(BaseModel):
 async def download_ocr_blocks(
     organization_id: str,
     document_id: str,
+    page_num: Optional[int] = Query(None, description="Specific page number to retrieve"),
     current_user: User = Depends(get_org_user)
 ):
     """Download OCR blocks for a document"""
-    logger.debug(f"download_ocr_blocks() start: document_id: {document_id}")
+    logger.debug(f"download_ocr_blocks() start: document_id: {document_id}, page_num: {page_num}")
     analytiq_client = ad.common.get_analytiq_client()
 
     document = await ad.common.get_doc(analytiq_client, document_id)
@@ -45,7 +46,8 @@ async def download_ocr_blocks(
         raise HTTPException(status_code=404, detail="OCR not supported for this document extension")
 
     # Get the OCR JSON data from mongodb
-    ocr_json = await ad.common.get_ocr_json(analytiq_client, document_id)
+    pages = [page_num] if page_num is not None else None
+    ocr_json = await ad.common.get_ocr_json(analytiq_client, document_id, pages)
     if ocr_json is None:
         raise HTTPException(status_code=404, detail="OCR data not found")
     
@@ -71,10 +73,21 @@ async def download_ocr_text(
     if not ad.common.doc.ocr_supported(file_name):
         raise HTTPException(status_code=404, detail="OCR not supported for this document extension")
 
+    if page_num is None:
+        # Stream the pages in order instead of assembling the whole text
+        if await ad.common.get_ocr_metadata(analytiq_client, document_id) is None:
+            raise HTTPException(status_code=404, detail="OCR text not found")
+
+        async def iter_text():
+            first = True
+            async for page_text in ad.common.iter_ocr_text_pages(analytiq_client, document_id):
+                yield page_text if first else "\n" + page_text
+                first = False
+
+        return StreamingResponse(iter_text(), media_type="text/plain")
+
     # Page number is 1-based, but the OCR text page_idx is 0-based
-    page_idx = None
-    if page_num is not None:
-        page_idx = page_num - 1
+    page_idx = page_num - 1
 
     # Get the OCR text data from mongodb
     text = await ad.common.get_ocr_text(analytiq_client, document_id, page_idx)
@@ -0,0 +1,99 @@
+# queues.py
+
+# Standard library imports
+import logging
+from datetime import datetime
+from typing import Optional, List, Dict
+
+# Third-party imports
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel
+
+# Local imports
+import analytiq_data as ad
+from app.auth import get_admin_user
+from app.models import User
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Initialize FastAPI router
+queues_router = APIRouter(tags=["queues"])
+
+# Queues reported by the stats endpoint
+QUEUE_NAMES = ["ocr", "llm"]
+
+# Queue models
+class QueueLatencyStats(BaseModel):
+    count: int
+    mean: Optional[float] = None
+    p50: Optional[float] = None
+    p90: Optional[float] = None
+    p99: Optional[float] = None
+    buckets: Dict[str, int]
+
+class QueueWorkerStats(BaseModel):
+    worker_id: str
+    completed: int
+    per_min: float
+
+class QueueConcurrencyChange(BaseModel):
+    at: datetime
+    from_concurrency: int
+    to_concurrency: int
+    reason: str
+    pending: int
+    latency_secs: Optional[float] = None
+
+class QueueConcurrencyStats(BaseModel):
+    worker_id: str
+    concurrency: int
+    min_concurrency: int
+    max_concurrency: int
+    latency_secs: Optional[float] = None
+    baseline_latency_secs: Optional[float] = None
+    last_reason: Optional[str] = None
+    history: List[QueueConcurrencyChange]
+    updated_at: datetime
+
+class QueueStats(BaseModel):
+    queue: str
+    pending: int
+    processing: int
+    oldest_pending_age_secs: Optional[float] = None
+    sent: int
+    deduplicated: int
+    claimed: int
+    completed: int
+    failed: int
+    retried: int
+    reclaimed: int
+    dead_lettered: int
+    latency_ms: QueueLatencyStats
+    workers: List[QueueWorkerStats]
+    concurrency: List[QueueConcurrencyStats]
+
+class ListQueueStatsResponse(BaseModel):
+    queues: List[QueueStats]
+
+@queues_router.get("/v0/account/queues/stats", response_model=ListQueueStatsResponse)
+async def list_queue_stats(
+    window_mins: int = Query(5, ge=1, le=1440, description="Window in minutes for the worker throughput"),
+    current_user: User = Depends(get_admin_user)
+):
+    """Get the stats of all queues (admin only)"""
+    analytiq_client = ad.common.get_analytiq_client()
+    queues = [await ad.queue.get_queue_stats(analytiq_client, queue_name, window_mins) for queue_name in QUEUE_NAMES]
+    return ListQueueStatsResponse(queues=queues)
+
+@queues_router.get("/v0/account/queues/{queue_name}/stats", response_model=QueueStats)
+async def get_queue_stats(
+    queue_name: str,
+    window_mins: int = Query(5, ge=1, le=1440, description="Window in minutes for the worker throughput"),
+    current_user: User = Depends(get_admin_user)
+):
+    """Get the stats of a queue (admin only)"""
+    if queue_name not in QUEUE_NAMES:
+        raise HTTPException(status_code=404, detail=f"Queue {queue_name} not found")
+    analytiq_client = ad.common.get_analytiq_client()
+    return await ad.queue.get_queue_stats(analytiq_client, queue_name, window_mins)
@@ -74,6 +74,13 @@ async def test_db(unique_db_name):
     collections = await db.list_collection_names()
     for collection in collections:
         await db.drop_collection(collection)
+    # And the blobs cached from the previous tests
+    ad.mongodb.blob_cache.clear()
+    # And the indexes ensured once per process, which were dropped with the collections
+    ad.queue.queue._indexed_queues.clear()
+    ad.queue.stats._indexed_envs.clear()
+    ad.common.ocr._indexed_envs.clear()
+    ad.mongodb.blob_store.CatalogBlobStore._indexed_envs.clear()
     
     # Initialize payments system for all tests
     await init_payments(db)
@@ -75,10 +75,10 @@ class MockTextractResponse:
         ]
 
 
-async def mock_run_textract(analytiq_client, blob, feature_types=[], query_list=None):
+async def mock_run_textract(analytiq_client, blob, feature_types=[], query_list=None, shard_pages=None, on_page=None):
     """Mock implementation of ad.aws.textract.run_textract that matches the real function signature"""
     # Return the blocks directly (not wrapped in MockTextractResponse)
-    return [
+    blocks = [
         {
             'Id': 'block-1',
             'BlockType': 'LINE',
@@ -101,6 +101,10 @@ async def mock_run_textract(analytiq_client, blob, feature_types=[], query_list=
             'Confidence': 97.8
         }
     ]
+    if on_page is not None:
+        await ad.ocr.pass_on_pages(blocks, on_page)
+        return None
+    return blocks
 
 
 class MockLiteLLMFileResponse:
@@ -0,0 +1,253 @@
+import pytest
+import asyncio
+import os
+import logging
+from unittest.mock import patch
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Check that ENV is set to pytest
+assert os.environ["ENV"] == "pytest"
+
+class FakeS3Body:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def read(self, n: int) -> bytes:
+        chunk, self.data = self.data[:n], self.data[n:]
+        return chunk
+
+    def close(self):
+        pass
+
+class FakeS3Client:
+    """In-memory stand-in for an S3-compatible service"""
+    def __init__(self):
+        self.objects = {}
+
+    async def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    async def get_object(self, Bucket, Key, Range=None):
+        if (Bucket, Key) not in self.objects:
+            raise FileNotFoundError(Key)
+        data = self.objects[(Bucket, Key)]
+        if Range is not None:
+            first, last = Range.removeprefix("bytes=").split("-")
+            data = data[int(first):int(last) + 1 if last else None]
+        return {"Body": FakeS3Body(data)}
+
+    async def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+@pytest.fixture
+def blob_stores(tmp_path):
+    """Local blob store in a temporary directory, and S3 blob store on an in-memory S3"""
+    s3_client = FakeS3Client()
+    async def get_s3_client():
+        return s3_client
+    with patch("analytiq_data.mongodb.blob_local.BLOB_LOCAL_PATH", str(tmp_path)), \
+         patch("analytiq_data.mongodb.blob_s3.BLOB_S3_BUCKET", "test-bucket"), \
+         patch("analytiq_data.mongodb.blob_s3._get_s3_client", new=get_s3_client):
+        yield {"local_path": tmp_path, "s3_client": s3_client}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("store_name", ["gridfs", "local", "s3"])
+async def test_blob_store(test_db, blob_stores, store_name):
+    """Test saving, overwriting, reading, listing and deleting blobs in each blob store"""
+    analytiq_client = ad.common.get_analytiq_client()
+    store = ad.mongodb.get_blob_store(analytiq_client, "files", store_name)
+    blob = os.urandom(5000)
+
+    await store.save("doc_1.pdf", b"old", {"type": "application/pdf"})
+    info_old = await store.get_info("doc_1.pdf")
+    await store.save("doc_1.pdf", blob, {"type": "application/pdf", "n": 1})
+    await store.save("doc_2_json", b"{}", {"format": "json"})
+
+    result = await store.get("doc_1.pdf")
+    assert result["blob"] == blob
+    assert result["metadata"] == {"type": "application/pdf", "n": 1}
+    assert result["upload_date"] is not None
+
+    info = await store.get_info("doc_1.pdf")
+    assert info["length"] == 5000
+    assert info["file_id"] != info_old["file_id"]
+    for start, end in [(0, None), (100, 2000), (4990, 6000), (300, 300)]:
+        chunks = [chunk async for chunk in store.iter("doc_1.pdf", start=start, end=end, file_id=info["file_id"])]
+        assert b"".join(chunks) == blob[start:end]
+
+    # The overwritten revision is deleted in the background
+    await ad.mongodb.wait_blob_revision_gc()
+    with pytest.raises(FileNotFoundError):
+        async for _ in store.iter("doc_1.pdf", file_id=info_old["file_id"]):
+            pass
+
+    assert sorted([elem["key"] async for elem in store.list()]) == ["doc_1.pdf", "doc_2_json"]
+    listed = [elem async for elem in store.list({"key": {"$regex": "_json$"}})]
+    assert [(elem["key"], elem["length"], elem["metadata"]) for elem in listed] == [("doc_2_json", 2, {"format": "json"})]
+    assert [elem["key"] async for elem in store.list({"metadata.n": 1})] == ["doc_1.pdf"]
+
+    await store.delete("doc_1.pdf")
+    await store.delete("doc_2_json")
+    await store.delete("missing")
+    assert await store.get("doc_1.pdf") is None
+    assert await store.get_info("doc_1.pdf") is None
+    with pytest.raises(FileNotFoundError):
+        async for _ in store.iter("doc_1.pdf"):
+            pass
+    assert [elem async for elem in store.list()] == []
+
+    # Nothing is left behind
+    if store_name == "local":
+        assert [name for _, _, names in os.walk(blob_stores["local_path"]) for name in names] == []
+    if store_name == "s3":
+        assert blob_stores["s3_client"].objects == {}
+
+@pytest.mark.asyncio
+async def test_blob_store_migration(test_db, blob_stores):
+    """Test that blobs are copied between stores, and read from the store configured for their bucket"""
+    analytiq_client = ad.common.get_analytiq_client()
+    for i in range(3):
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key=f"file_{i}.pdf",
+                                         blob=f"pdf {i}".encode(), metadata={"i": i})
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="doc_json", blob=b"ocr", metadata={})
+
+    assert await ad.mongodb.migrate_blobs_async(analytiq_client, "files", "gridfs", "local") == 3
+    # Blobs already copied are skipped
+    assert await ad.mongodb.migrate_blobs_async(analytiq_client, "files", "gridfs", "local") == 0
+
+    with patch("analytiq_data.mongodb.blob_store.BLOB_STORES", "files=local"):
+        assert ad.mongodb.get_blob_store(analytiq_client, "files").name == "local"
+        assert ad.mongodb.get_blob_store(analytiq_client, "ocr").name == "gridfs"
+        file = await ad.common.get_file_async(analytiq_client, "file_1.pdf")
+        assert file["blob"] == b"pdf 1"
+        assert file["metadata"] == {"i": 1}
+
+        # A blob saved in the old store after the first copy is picked up, and the old store is emptied
+        gridfs_store = ad.mongodb.get_blob_store(analytiq_client, "files", "gridfs")
+        await gridfs_store.save("file_3.pdf", b"pdf 3", {"i": 3})
+        assert await ad.mongodb.migrate_blobs_async(analytiq_client, "files", "gridfs", "local", delete_source=True) == 1
+        assert [elem async for elem in gridfs_store.list()] == []
+        assert (await ad.common.get_file_async(analytiq_client, "file_3.pdf"))["blob"] == b"pdf 3"
+
+    # And back to GridFS
+    assert await ad.mongodb.migrate_blobs_async(analytiq_client, "files", "local", "gridfs", delete_source=True) == 4
+    assert (await ad.common.get_file_async(analytiq_client, "file_2.pdf"))["blob"] == b"pdf 2"
+    assert (await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key="doc_json"))["blob"] == b"ocr"
+
+    with pytest.raises(ValueError):
+        ad.mongodb.get_blob_store(analytiq_client, "files", "floppy")
+
+@pytest.mark.asyncio
+async def test_blob_cache(test_db):
+    """Test that blobs are cached, loaded once by concurrent readers, evicted and invalidated"""
+    analytiq_client = ad.common.get_analytiq_client()
+    cache = ad.mongodb.BlobCache(max_bytes=250, max_blob_bytes=200, policies="files=immutable,ocr=validate")
+    with patch("analytiq_data.mongodb.blob.blob_cache", cache):
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="a.pdf", blob=b"a" * 100, metadata={"n": 1})
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="big.pdf", blob=b"b" * 300, metadata={})
+
+        n_loads = 0
+        get = ad.mongodb.GridFSBlobStore.get
+        async def counting_get(self, key):
+            nonlocal n_loads
+            n_loads += 1
+            await asyncio.sleep(0.01)
+            return await get(self, key)
+
+        with patch.object(ad.mongodb.GridFSBlobStore, "get", counting_get):
+            # Concurrent readers share a single load
+            results = await asyncio.gather(*[ad.mongodb.get_blob_async(analytiq_client, "files", "a.pdf") for _ in range(5)])
+            assert [result["blob"] for result in results] == [b"a" * 100] * 5
+            assert n_loads == 1
+
+            # Cached blobs are served without loading, and callers may modify the metadata
+            results[0]["metadata"]["n"] = 2
+            assert (await ad.mongodb.get_blob_async(analytiq_client, "files", "a.pdf"))["metadata"] == {"n": 1}
+            assert n_loads == 1
+
+            # Blobs larger than max_blob_bytes are not cached
+            for _ in range(2):
+                assert (await ad.mongodb.get_blob_async(analytiq_client, "files", "big.pdf"))["blob"] == b"b" * 300
+            assert n_loads == 3
+
+            # Saving a blob invalidates it
+            await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="a.pdf", blob=b"c" * 100, metadata={})
+            assert (await ad.mongodb.get_blob_async(analytiq_client, "files", "a.pdf"))["blob"] == b"c" * 100
+            assert n_loads == 4
+
+            # The least recently used blob is evicted beyond max_bytes
+            await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="d.pdf", blob=b"d" * 200, metadata={})
+            await ad.mongodb.get_blob_async(analytiq_client, "files", "d.pdf")
+            await ad.mongodb.get_blob_async(analytiq_client, "files", "a.pdf")
+            assert n_loads == 6
+            assert cache.get_stats()["entries"] == 1
+
+            # Blobs of a "validate" bucket overwritten behind the cache's back are reloaded
+            gridfs_store = ad.mongodb.get_blob_store(analytiq_client, "ocr", "gridfs")
+            await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="doc_json", blob=b"v1", metadata={})
+            assert (await ad.mongodb.get_blob_async(analytiq_client, "ocr", "doc_json"))["blob"] == b"v1"
+            assert (await ad.mongodb.get_blob_async(analytiq_client, "ocr", "doc_json"))["blob"] == b"v1"
+            assert n_loads == 7
+            await gridfs_store.save("doc_json", b"v2", {})
+            assert (await ad.mongodb.get_blob_async(analytiq_client, "ocr", "doc_json"))["blob"] == b"v2"
+            assert n_loads == 8
+
+            # Deleting a blob invalidates it
+            await ad.mongodb.delete_blob_async(analytiq_client, bucket="files", key="a.pdf")
+            assert await ad.mongodb.get_blob_async(analytiq_client, "files", "a.pdf") is None
+
+        stats = cache.get_stats()
+        assert stats["bytes"] <= 250
+        assert stats["buckets"]["files"]["hits"] == 1
+        assert stats["buckets"]["files"]["bytes_served"] == 100
+        assert stats["buckets"]["files"]["evictions"] == 2
+        assert stats["buckets"]["ocr"] == {"hits": 1, "misses": 2, "bytes_served": 2, "evictions": 0}
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+async def test_blob_compression(test_db, codec):
+    """Test that blobs of the buckets with a codec are compressed, and read back transparently"""
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    analytiq_client = ad.common.get_analytiq_client()
+    gridfs_store = ad.mongodb.get_blob_store(analytiq_client, "ocr", "gridfs")
+    text = b"".join(f"line {i} of the OCR text\n".encode() for i in range(1000))
+
+    # Saved before compression was enabled
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="old_text", blob=text, metadata={"n": 0})
+
+    with patch("analytiq_data.mongodb.blob_codec.BLOB_COMPRESSION", f"ocr={codec}"):
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="doc_text", blob=text, metadata={"n": 1})
+        # Small and incompressible blobs are stored as is
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="small_text", blob=b"small", metadata={})
+        random_blob = os.urandom(5000)
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key="random", blob=random_blob, metadata={})
+
+        stored = await gridfs_store.get_info("doc_text")
+        assert stored["length"] < len(text) / 5
+        assert stored["metadata"]["blob_codec"] == codec
+        assert (await gridfs_store.get_info("small_text"))["metadata"] == {}
+        assert (await gridfs_store.get_info("random"))["metadata"] == {}
+
+        for key, n in [("doc_text", 1), ("old_text", 0)]:
+            result = await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=key)
+            assert result["blob"] == text
+            assert result["metadata"] == {"n": n}
+        assert (await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key="random"))["blob"] == random_blob
+
+    # Compressed blobs stay readable once compression is disabled
+    info = await ad.mongodb.get_blob_info_async(analytiq_client, bucket="ocr", key="doc_text")
+    assert info["length"] == len(text)
+    assert info["metadata"] == {"n": 1}
+    assert (await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key="doc_text"))["blob"] == text
+    for start, end in [(0, None), (100, 2000), (len(text) - 10, len(text) + 10), (300, 300)]:
+        chunks = [chunk async for chunk in ad.mongodb.iter_blob_async(analytiq_client, "ocr", "doc_text",
+                                                                      start=start, end=end, file_id=info["file_id"])]
+        assert b"".join(chunks) == text[start:end]
+
+    listed = {elem["key"]: elem async for elem in ad.mongodb.list_blobs_async(analytiq_client, "ocr", {"metadata.n": 1})}
+    assert list(listed) == ["doc_text"]
+    assert (listed["doc_text"]["length"], listed["doc_text"]["metadata"]) == (len(text), {"n": 1})
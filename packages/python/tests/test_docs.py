@@ -694,6 +694,82 @@ async def test_upload_document_base64_formats(test_db, small_pdf, mock_auth):
     assert upload_response.status_code == 400
     assert "Invalid base64 content" in upload_response.json()["detail"]
 
+@pytest.mark.asyncio
+async def test_download_document_file(test_db, mock_auth):
+    """Test streaming download of a document file, with byte ranges and conditional requests"""
+    logger.info("test_download_document_file() start")
+
+    pdf_content = b"%PDF-1.4\n" + bytes(range(256)) * 40 + b"\n%%EOF\n"
+    upload_response = client.post(
+        f"/v0/orgs/{TEST_ORG_ID}/documents",
+        json={"documents": [{
+            "name": "download_test.pdf",
+            "content": f"data:application/pdf;base64,{base64.b64encode(pdf_content).decode()}",
+            "tag_ids": []
+        }]},
+        headers=get_auth_headers()
+    )
+    assert upload_response.status_code == 200
+    document_id = upload_response.json()["documents"][0]["document_id"]
+    file_url = f"/v0/orgs/{TEST_ORG_ID}/documents/{document_id}/file"
+
+    # Whole file
+    response = client.get(file_url, headers=get_auth_headers())
+    assert response.status_code == 200
+    assert response.content == pdf_content
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["content-length"] == str(len(pdf_content))
+    assert response.headers["accept-ranges"] == "bytes"
+    etag = response.headers["etag"]
+    last_modified = response.headers["last-modified"]
+
+    # Byte ranges
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.content == pdf_content[100:200]
+    assert response.headers["content-range"] == f"bytes 100-199/{len(pdf_content)}"
+
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=10000-"})
+    assert response.status_code == 206
+    assert response.content == pdf_content[10000:]
+
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=-50"})
+    assert response.status_code == 206
+    assert response.content == pdf_content[-50:]
+
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": f"bytes={len(pdf_content)}-"})
+    assert response.status_code == 416
+    assert response.headers["content-range"] == f"bytes */{len(pdf_content)}"
+
+    # Several ranges are not supported, the whole file is returned
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=0-9,20-29"})
+    assert response.status_code == 200
+    assert response.content == pdf_content
+
+    # The range is ignored if the file changed since the If-Range validator
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=0-9", "If-Range": '"stale"'})
+    assert response.status_code == 200
+    assert response.content == pdf_content
+    response = client.get(file_url, headers={**get_auth_headers(), "Range": "bytes=0-9", "If-Range": etag})
+    assert response.status_code == 206
+    assert response.content == pdf_content[:10]
+
+    # Conditional GETs
+    response = client.get(file_url, headers={**get_auth_headers(), "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    response = client.get(file_url, headers={**get_auth_headers(), "If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    response = client.get(file_url, headers={**get_auth_headers(), "If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+    # Deleted documents are not found
+    client.delete(f"/v0/orgs/{TEST_ORG_ID}/documents/{document_id}", headers=get_auth_headers())
+    response = client.get(file_url, headers=get_auth_headers())
+    assert response.status_code == 404
+
+    logger.info("test_download_document_file() end")
+
 @pytest.mark.asyncio
 async def test_document_metadata_search(test_db, small_pdf, mock_auth):
     """Test metadata search functionality including URL encoding"""
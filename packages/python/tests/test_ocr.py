@@ -0,0 +1,609 @@
+import pytest
+import asyncio
+import io
+import os
+import pickle
+import uuid
+import logging
+from unittest.mock import patch
+from bson import ObjectId
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Check that ENV is set to pytest
+assert os.environ["ENV"] == "pytest"
+
+def make_blocks(n_pages: int = 3, n_lines: int = 5) -> list:
+    """Build Textract-like blocks: a PAGE block, LINE blocks and their WORD children per page"""
+    blocks = []
+    for page in range(1, n_pages + 1):
+        page_block = {
+            "BlockType": "PAGE",
+            "Geometry": {
+                "BoundingBox": {"Width": 1.0, "Height": 1.0, "Left": 0.0, "Top": 0.0},
+                "Polygon": [{"X": 0.0, "Y": 0.0}, {"X": 1.0, "Y": 0.0}, {"X": 1.0, "Y": 1.0}, {"X": 0.0, "Y": 1.0}]
+            },
+            "Id": str(uuid.uuid4()),
+            "Relationships": [{"Type": "CHILD", "Ids": []}],
+            "Page": page
+        }
+        blocks.append(page_block)
+        for line in range(n_lines):
+            word = {
+                "BlockType": "WORD",
+                "Confidence": 99.87654321,
+                "Text": f"word{page}_{line}",
+                "TextType": "PRINTED",
+                "Geometry": {"BoundingBox": {"Width": 0.1, "Height": 0.02, "Left": 0.1 * line, "Top": 0.3333333}},
+                "Id": str(uuid.uuid4()),
+                "Page": page
+            }
+            line_block = {
+                "BlockType": "LINE",
+                "Confidence": 98.5,
+                "Text": word["Text"],
+                "Id": str(uuid.uuid4()),
+                "Relationships": [{"Type": "CHILD", "Ids": [word["Id"]]}],
+                "Page": page
+            }
+            page_block["Relationships"][0]["Ids"].append(line_block["Id"])
+            blocks.extend([line_block, word])
+    # Blocks with non-UUID ids, extra keys and no page
+    blocks.append({"BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Id": "kv-1", "Page": 2,
+                   "Geometry": {"RotationAngle": 90}})
+    blocks.append({"BlockType": "QUERY", "Id": "query-1", "Query": {"Text": "What is the total?"}})
+    return blocks
+
+def make_analysis_blocks(n_pages: int = 2, n_rows: int = 3, n_cols: int = 2) -> list:
+    """Build Textract analysis blocks: per page a table, a key-value pair, and a query with its answer"""
+    def word(text, page):
+        return {"BlockType": "WORD", "Text": text, "Id": str(uuid.uuid4()), "Page": page}
+
+    blocks = []
+    for page in range(1, n_pages + 1):
+        cells = []
+        for row in range(1, n_rows + 1):
+            for col in range(1, n_cols + 1):
+                words = [word(f"r{row}", page), word(f"c{col}", page)]
+                cells.append({"BlockType": "CELL", "RowIndex": row, "ColumnIndex": col, "Id": str(uuid.uuid4()),
+                              "Relationships": [{"Type": "CHILD", "Ids": [w["Id"] for w in words]}], "Page": page})
+                blocks.extend(words)
+        blocks.extend(cells)
+        blocks.append({"BlockType": "TABLE", "Id": str(uuid.uuid4()), "Page": page,
+                       "Relationships": [{"Type": "CHILD", "Ids": [cell["Id"] for cell in cells]}]})
+
+        key_word, value_word = word(f"Total{page}:", page), word(f"{page}00", page)
+        value = {"BlockType": "KEY_VALUE_SET", "EntityTypes": ["VALUE"], "Id": str(uuid.uuid4()), "Page": page,
+                 "Relationships": [{"Type": "CHILD", "Ids": [value_word["Id"]]}]}
+        key = {"BlockType": "KEY_VALUE_SET", "EntityTypes": ["KEY"], "Id": str(uuid.uuid4()), "Page": page,
+               "Relationships": [{"Type": "VALUE", "Ids": [value["Id"]]}, {"Type": "CHILD", "Ids": [key_word["Id"]]}]}
+        blocks.extend([key_word, value_word, key, value])
+
+        answer = {"BlockType": "QUERY_RESULT", "Text": f"answer{page}", "Id": str(uuid.uuid4()), "Page": page}
+        blocks.append({"BlockType": "QUERY", "Query": {"Text": f"question{page}"}, "Id": str(uuid.uuid4()), "Page": page,
+                       "Relationships": [{"Type": "ANSWER", "Ids": [answer["Id"]]}]})
+        blocks.append(answer)
+    return blocks
+
+def by_id(blocks: list) -> dict:
+    return {block["Id"]: block for block in blocks}
+
+def test_ocr_blocks_compact_format():
+    """Test that the compact format round-trips Textract blocks and decodes single pages"""
+    blocks = make_blocks()
+    data = ad.common.encode_ocr_blocks(blocks)
+    assert ad.common.is_compact_ocr_blocks(data)
+    assert not ad.common.is_compact_ocr_blocks(pickle.dumps(blocks))
+    assert len(data) < len(pickle.dumps(blocks))
+
+    assert by_id(ad.common.decode_ocr_blocks(data)) == by_id(blocks)
+
+    compact = ad.common.CompactOcrBlocks(data)
+    assert compact.n_blocks == len(blocks)
+    page_2 = compact.get_page_blocks(2)
+    assert by_id(page_2) == by_id([block for block in blocks if block.get("Page") == 2])
+    assert compact.get_page_blocks(10) == []
+
+def test_textract_document():
+    """Test that TextractDocument extracts the same text, tables, key-values and queries as the block map functions"""
+    blocks = make_blocks(n_pages=3, n_lines=2) + make_analysis_blocks(n_pages=2)
+    block_map = ad.aws.textract.get_block_map(blocks)
+    doc = ad.aws.TextractDocument(blocks)
+
+    assert doc.pages == [1, 2, 3]
+    assert doc.get_page_text_map() == ad.aws.textract.get_page_text_map(block_map)
+    assert doc.get_lines(2) == ["word2_0", "word2_1"]
+    assert doc.get_tables() == ad.aws.textract.get_tables(block_map)
+    assert doc.get_tables(2) == [{row: {col: f"r{row} c{col}" for col in range(1, 3)} for row in range(1, 4)}]
+    assert doc.get_query_map() == ad.aws.textract.get_query_map(block_map)
+    assert doc.get_query_map() == {"What is the total?": None, "question1": "answer1", "question2": "answer2"}
+
+    assert doc.get_key_values(1) == {"Total1: ": ["100 "]}
+    analysis_blocks = make_analysis_blocks(n_pages=2)
+    key_map, value_map = ad.aws.textract.get_kv_map(analysis_blocks)
+    analysis_block_map = ad.aws.textract.get_block_map(analysis_blocks)
+    assert ad.aws.TextractDocument(analysis_blocks).get_key_values() == \
+        ad.aws.textract.get_kv_relationship(key_map, value_map, analysis_block_map)
+
+    line = doc.get_blocks("LINE", 1)[0]
+    assert doc.get_parent(line)["BlockType"] == "PAGE"
+    assert doc.get_related(line)[0]["Text"] == "word1_0"
+    assert doc.get_parent(doc.get_blocks("PAGE", 1)[0]) is None
+
+@pytest.mark.asyncio
+async def test_ocr_json_legacy_and_migration(test_db):
+    """Test that legacy pickled OCR blocks stay readable and are migrated to the compact format"""
+    analytiq_client = ad.common.get_analytiq_client()
+    blocks = make_blocks()
+
+    # A legacy blob under the old _list key
+    document_id = ad.common.create_id()
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_list",
+                                     blob=pickle.dumps(blocks), metadata={})
+    assert by_id(await ad.common.get_ocr_json(analytiq_client, document_id)) == by_id(blocks)
+    page_1 = await ad.common.get_ocr_json(analytiq_client, document_id, pages=[1])
+    assert all(block["Page"] == 1 for block in page_1)
+
+    assert await ad.common.migrate_ocr_json(analytiq_client) == 1
+    assert await ad.common.migrate_ocr_json(analytiq_client) == 0
+
+    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_json")
+    assert ad.common.is_compact_ocr_blocks(blob["blob"])
+    assert blob["metadata"]["format"] == ad.common.OCR_BLOCKS_FORMAT
+    assert await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_list") is None
+    assert by_id(await ad.common.get_ocr_json(analytiq_client, document_id)) == by_id(blocks)
+
+@pytest.mark.asyncio
+async def test_ocr_text_pages(test_db):
+    """Test that the OCR text is stored per page and read per page, in full and as a stream"""
+    analytiq_client = ad.common.get_analytiq_client()
+    document_id = ad.common.create_id()
+    assert await ad.common.get_ocr_metadata(analytiq_client, document_id) is None
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) is None
+
+    await ad.common.save_ocr_text_from_list(analytiq_client, document_id, make_blocks(n_pages=3, n_lines=2))
+    metadata = await ad.common.get_ocr_metadata(analytiq_client, document_id)
+    assert metadata["n_pages"] == 3
+    assert metadata["ocr_date"] is not None
+    assert await ad.common.get_ocr_n_pages(analytiq_client, document_id) == 3
+
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 1) == "word2_0\nword2_1\n"
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 3) is None
+    pages = [page async for page in ad.common.iter_ocr_text_pages(analytiq_client, document_id)]
+    assert pages == [f"word{page}_0\nword{page}_1\n" for page in range(1, 4)]
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) == "\n".join(pages)
+
+    # A shorter re-OCR drops the extra pages
+    await ad.common.save_ocr_text_from_list(analytiq_client, document_id, make_blocks(n_pages=1, n_lines=2), force=True)
+    assert await ad.common.get_ocr_n_pages(analytiq_client, document_id) == 1
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 1) is None
+
+    await ad.common.delete_ocr_text(analytiq_client, document_id)
+    assert await ad.common.get_ocr_metadata(analytiq_client, document_id) is None
+
+@pytest.mark.asyncio
+async def test_ocr_text_legacy(test_db):
+    """Test that legacy GridFS OCR text stays readable until the document is OCRed again"""
+    analytiq_client = ad.common.get_analytiq_client()
+    document_id = ad.common.create_id()
+    pages = ["page one\n", "page two\n"]
+    for page_idx, page_text in enumerate(pages):
+        await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_text_page_{page_idx}",
+                                         blob=page_text.encode("utf-8"), metadata={"n_pages": 2})
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_text",
+                                     blob="\n".join(pages).encode("utf-8"), metadata={"n_pages": 2})
+
+    assert await ad.common.get_ocr_n_pages(analytiq_client, document_id) == 2
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 1) == "page two\n"
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) == "\n".join(pages)
+    assert [page async for page in ad.common.iter_ocr_text_pages(analytiq_client, document_id)] == pages
+
+    await ad.common.save_ocr_text_from_list(analytiq_client, document_id, make_blocks(n_pages=1, n_lines=1), force=True)
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) == "word1_0\n"
+    assert await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_text") is None
+    assert await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=f"{document_id}_text_page_0") is None
+
+def make_text_pdf(pages: list) -> bytes:
+    """Build a PDF with a Helvetica text layer. Each page is a list of (x, y, text) runs, or None for a page without text"""
+    from pypdf import PdfWriter
+    from pypdf.generic import NameObject, DictionaryObject, DecodedStreamObject
+
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica")
+    }))
+    for runs in pages:
+        page = writer.add_blank_page(612, 792)
+        if runs:
+            content = DecodedStreamObject()
+            content.set_data("".join(f"BT 1 0 0 1 {x} {y} Tm /F1 12 Tf ({text}) Tj ET\n" for x, y, text in runs).encode())
+            page[NameObject("/Contents")] = writer._add_object(content)
+            page[NameObject("/Resources")] = DictionaryObject({
+                NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+            })
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+@pytest.mark.asyncio
+async def test_ocr_engine_text_layer(test_db):
+    """Test that the auto OCR engine reads the text layer and sends only the scanned pages to Textract"""
+    pytest.importorskip("pypdf")
+    analytiq_client = ad.common.get_analytiq_client()
+    pdf = make_text_pdf([
+        [(72, 720, "INVOICE #12345"), (300, 720, "Date: 2025-01-31"), (72, 700, "Total: $1,234.56")],
+        None,
+        [(72, 720, "Vendor: Acme Corp, 1 Main Street")]
+    ])
+
+    textract_pages = []
+    async def mock_run_textract(analytiq_client, blob, feature_types=[], query_list=None, shard_pages=None, on_page=None):
+        n_pages = len(ad.ocr.extract_text_layer(blob) or [None])
+        textract_pages.append(n_pages)
+        blocks = [block for block in make_blocks(n_pages=n_pages, n_lines=1) if block.get("Page", 0) in range(1, n_pages + 1)]
+        if on_page is not None:
+            await ad.ocr.pass_on_pages(blocks, on_page)
+            return None
+        return blocks
+
+    with patch("analytiq_data.aws.textract.run_textract", new=mock_run_textract):
+        blocks = await ad.ocr.run_ocr(analytiq_client, pdf, engine="auto")
+
+    # Only the page without text went to Textract, and was renumbered
+    assert textract_pages == [1]
+    doc = ad.aws.TextractDocument(blocks)
+    assert doc.get_lines(1) == ["INVOICE #12345 Date: 2025-01-31", "Total: $1,234.56"]
+    assert doc.get_lines(2) == ["word1_0"]
+    assert doc.get_lines(3) == ["Vendor: Acme Corp, 1 Main Street"]
+    assert [block["Page"] for block in blocks if "Page" in block] == \
+        sorted(block["Page"] for block in blocks if "Page" in block)
+
+    line = doc.get_blocks("LINE", 1)[1]
+    box = line["Geometry"]["BoundingBox"]
+    assert box["Left"] == pytest.approx(72 / 612)
+    assert box["Top"] == pytest.approx(1 - (700 + 12) / 792)
+    assert [word["Text"] for word in doc.get_related(line)] == ["Total:", "$1,234.56"]
+
+    # The same text as Textract would produce flows into the OCR text
+    document_id = ad.common.create_id()
+    await ad.common.save_ocr_text_from_list(analytiq_client, document_id, blocks)
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 0) == "INVOICE #12345 Date: 2025-01-31\nTotal: $1,234.56\n"
+
+    # Unreadable PDFs are OCRed entirely
+    with patch("analytiq_data.aws.textract.run_textract", new=mock_run_textract):
+        blocks = await ad.ocr.run_ocr(analytiq_client, b"%PDF-1.4\n%%EOF\n", engine="auto")
+    assert textract_pages == [1, 1]
+    assert ad.aws.TextractDocument(blocks).get_lines(1) == ["word1_0"]
+
+@pytest.mark.asyncio
+async def test_textract_shards(test_db):
+    """Test that a PDF split into shards is merged back in page order, with a failed shard retried alone"""
+    pytest.importorskip("pypdf")
+    analytiq_client = ad.common.get_analytiq_client()
+    pdf = make_text_pdf([[(72, 720, f"page {page}")] for page in range(1, 6)])
+
+    calls = []
+    async def mock_run_textract_job(analytiq_client, blob, feature_types=[], query_list=None):
+        n_pages = len(ad.ocr.extract_text_layer(blob))
+        calls.append(n_pages)
+        if calls.count(1) == 1 and n_pages == 1:
+            raise Exception("ThrottlingException")
+        # Every shard reuses the same block ids
+        blocks = [block for block in make_blocks(n_pages=n_pages, n_lines=2) if block.get("Page", 0) in range(1, n_pages + 1)]
+        id_map = {block["Id"]: f"00000000-0000-0000-0000-{i:012d}" for i, block in enumerate(blocks)}
+        for block in blocks:
+            block["Id"] = id_map[block["Id"]]
+            for relationship in block.get("Relationships", []):
+                relationship["Ids"] = [id_map[block_id] for block_id in relationship["Ids"]]
+        return blocks
+
+    with patch("analytiq_data.aws.textract._run_textract_job", new=mock_run_textract_job):
+        blocks = await ad.aws.textract.run_textract(analytiq_client, pdf, shard_pages=2)
+
+    # Shards of 2, 2 and 1 pages, the last one failing once
+    assert sorted(calls) == [1, 1, 2, 2]
+    assert [block["Page"] for block in blocks] == sorted(block["Page"] for block in blocks)
+    assert len({block["Id"] for block in blocks}) == len(blocks)
+
+    doc = ad.aws.TextractDocument(blocks)
+    assert doc.pages == [1, 2, 3, 4, 5]
+    for page in doc.pages:
+        page_block = doc.get_blocks("PAGE", page)[0]
+        assert [line["Page"] for line in doc.get_related(page_block)] == [page, page]
+    # Each shard numbers its pages from 1
+    assert doc.get_lines(3) == ["word1_0", "word1_1"]
+    assert doc.get_lines(4) == ["word2_0", "word2_1"]
+
+def test_textract_transient_errors():
+    """Test that only transient Textract failures retry a shard"""
+    assert ad.aws.textract.is_transient_textract_error(ad.aws.TextractJobFailedError("FAILED"))
+    assert ad.aws.textract.is_transient_textract_error(
+        Exception("An error occurred (ThrottlingException) when calling the StartDocumentAnalysis operation"))
+    assert ad.aws.textract.is_transient_textract_error(Exception("An error occurred (InternalServerError)"))
+    assert not ad.aws.textract.is_transient_textract_error(
+        Exception("An error occurred (UnsupportedDocumentException) when calling the StartDocumentAnalysis operation"))
+    assert not ad.aws.textract.is_transient_textract_error(ValueError("bad input"))
+
+@pytest.mark.asyncio
+async def test_ocr_cache(test_db):
+    """Test that documents with the same PDF share one cached OCR result, counted by reference"""
+    analytiq_client = ad.common.get_analytiq_client()
+    db = ad.common.get_async_db(analytiq_client)
+    blocks = make_blocks()
+    pdf_sha256 = ad.common.get_pdf_sha256(b"%PDF-1.4 same content")
+
+    key = ad.common.get_ocr_cache_key(pdf_sha256, "org_1")
+    assert ad.common.get_ocr_cache_key(pdf_sha256, "org_1") == key
+    assert ad.common.get_ocr_cache_key(pdf_sha256, "org_2") != key
+    assert ad.common.get_ocr_cache_key(pdf_sha256, "org_2", scope="global") == \
+        ad.common.get_ocr_cache_key(pdf_sha256, "org_1", scope="global")
+    assert ad.common.get_ocr_cache_key(pdf_sha256, "org_1", scope="off") is None
+
+    assert await ad.common.get_cached_ocr_json(analytiq_client, key) is None
+    document_ids = [ad.common.create_id(), ad.common.create_id()]
+    # The entry is saved with the reference of its document
+    await ad.common.save_ocr_cache(analytiq_client, key, blocks, document_ids[0],
+                                   pdf_sha256=pdf_sha256, organization_id="org_1")
+    assert by_id(await ad.common.get_cached_ocr_json(analytiq_client, key)) == by_id(blocks)
+    assert (await db[ad.common.OCR_CACHE_COLLECTION].find_one({"_id": key}))["ref_count"] == 1
+    assert await ad.common.get_ocr_cache_key_of_doc(analytiq_client, document_ids[0]) == key
+
+    for document_id in document_ids:
+        assert await ad.common.link_ocr_cache(analytiq_client, document_id, key)
+        # Linking twice counts once
+        assert await ad.common.link_ocr_cache(analytiq_client, document_id, key)
+        assert by_id(await ad.common.get_ocr_json(analytiq_client, document_id)) == by_id(blocks)
+    entry = await db[ad.common.OCR_CACHE_COLLECTION].find_one({"_id": key})
+    assert entry["ref_count"] == 2
+
+    await ad.common.delete_ocr_all(analytiq_client, document_ids[0])
+    assert await ad.common.get_ocr_json(analytiq_client, document_ids[0]) is None
+    assert (await db[ad.common.OCR_CACHE_COLLECTION].find_one({"_id": key}))["ref_count"] == 1
+
+    # The last reference removes the entry and its blocks
+    await ad.common.delete_ocr_all(analytiq_client, document_ids[1])
+    assert await db[ad.common.OCR_CACHE_COLLECTION].find_one({"_id": key}) is None
+    assert await ad.mongodb.get_blob_async(analytiq_client, bucket="ocr", key=entry["blob_key"]) is None
+    assert not await ad.common.link_ocr_cache(analytiq_client, document_ids[1], key)
+
+class FakeTextractAWSClient:
+    """Stand-in for AsyncAWSClient: an S3 bucket and Textract jobs finishing after a number of status checks"""
+    def __init__(self, checks_to_finish: int = 2, failed_job_idx: int = None):
+        self.s3_bucket_name = "test-bucket"
+        self.objects = {}
+        self.checks_to_finish = checks_to_finish
+        self.failed_job_idx = failed_job_idx
+        self.job_checks = {}
+        self.n_textract_clients = 0
+        self.notification_channels = []
+        self.uploads = []
+        self.multipart_uploads = {}
+
+    def client(self, service_name: str):
+        from contextlib import asynccontextmanager
+        fake = self
+
+        class S3:
+            async def put_object(self, Bucket, Key, Body):
+                fake.objects[Key] = Body
+                fake.uploads.append([Body])
+            async def create_multipart_upload(self, Bucket, Key):
+                fake.multipart_uploads[Key] = {}
+                return {"UploadId": Key}
+            async def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+                fake.multipart_uploads[UploadId][PartNumber] = Body
+                return {"ETag": f"etag_{PartNumber}"}
+            async def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+                parts = fake.multipart_uploads.pop(UploadId)
+                assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == sorted(parts)
+                fake.objects[Key] = b"".join(parts[part_number] for part_number in sorted(parts))
+                fake.uploads.append([parts[part_number] for part_number in sorted(parts)])
+            async def abort_multipart_upload(self, Bucket, Key, UploadId):
+                fake.multipart_uploads.pop(UploadId, None)
+            async def delete_object(self, Bucket, Key):
+                fake.objects.pop(Key, None)
+
+        class Textract:
+            async def start_document_text_detection(self, DocumentLocation, NotificationChannel=None):
+                job_id = f"job_{len(fake.job_checks)}"
+                fake.job_checks[job_id] = 0
+                fake.notification_channels.append(NotificationChannel)
+                return {"JobId": job_id}
+            async def get_document_text_detection(self, JobId, MaxResults=None, NextToken=None):
+                if MaxResults is not None:
+                    fake.job_checks[JobId] += 1
+                if fake.job_checks[JobId] < fake.checks_to_finish:
+                    return {"JobStatus": "IN_PROGRESS"}
+                if JobId == f"job_{fake.failed_job_idx}":
+                    return {"JobStatus": "FAILED"}
+                # Two pages of results
+                if NextToken is None:
+                    return {"JobStatus": "SUCCEEDED", "Blocks": [{"Id": f"{JobId}_1"}], "NextToken": "2"}
+                return {"JobStatus": "SUCCEEDED", "Blocks": [{"Id": f"{JobId}_2"}]}
+
+        @asynccontextmanager
+        async def make_client():
+            if service_name == "textract":
+                fake.n_textract_clients += 1
+                yield Textract()
+            else:
+                yield S3()
+        return make_client()
+
+@pytest.mark.asyncio
+async def test_textract_job_manager(test_db):
+    """Test that one poller tracks many concurrent Textract jobs, and that jobs complete from notifications"""
+    import asyncio
+    analytiq_client = ad.common.get_analytiq_client()
+
+    with patch("analytiq_data.aws.textract_jobs.TEXTRACT_POLL_INITIAL_SECS", 0.01), \
+         patch("analytiq_data.aws.textract_jobs.TEXTRACT_POLL_MAX_SECS", 0.02):
+        aws_client = FakeTextractAWSClient(checks_to_finish=3, failed_job_idx=7)
+        manager = ad.aws.TextractJobManager(analytiq_client, aws_client)
+        results = await asyncio.gather(*[manager.run(f"pdf {i}".encode()) for i in range(20)],
+                                       return_exceptions=True)
+
+        for i, result in enumerate(results):
+            if i == 7:
+                assert isinstance(result, Exception)
+            else:
+                assert result == [{"Id": f"job_{i}_1"}, {"Id": f"job_{i}_2"}]
+        assert manager.n_jobs == 0
+        assert aws_client.objects == {}
+        assert all(n_checks == 3 for n_checks in aws_client.job_checks.values())
+        # Status checks of the jobs due at the same time share a client
+        assert aws_client.n_textract_clients < 20 * 3
+
+    # With notifications, jobs complete without status checks
+    aws_client = FakeTextractAWSClient(checks_to_finish=0)
+    notifications = ad.aws.LocalTextractNotifications()
+    manager = ad.aws.TextractJobManager(analytiq_client, aws_client, notifications)
+    futures = [await manager.submit(f"pdf {i}".encode()) for i in range(3)]
+    assert manager.n_jobs == 3
+    for job_id in aws_client.job_checks:
+        notifications.publish(job_id, "SUCCEEDED")
+    jobs = await asyncio.wait_for(asyncio.gather(*futures), 5)
+    assert await manager.get_blocks(jobs[2]) == [{"Id": "job_2_1"}, {"Id": "job_2_2"}]
+
+    # Result pages are streamed to a callback
+    result_pages = []
+    async def on_blocks(blocks):
+        result_pages.append(blocks)
+    assert await manager.get_blocks(jobs[0], on_blocks) is None
+    assert result_pages == [[{"Id": "job_0_1"}], [{"Id": "job_0_2"}]]
+    assert all(n_checks == 0 for n_checks in aws_client.job_checks.values())
+    assert manager.n_jobs == 0
+    await manager.stop()
+
+@pytest.mark.asyncio
+async def test_blob_chunks(test_db):
+    """Test that a blob is read chunk by chunk, and streamed to S3 in parts"""
+    analytiq_client = ad.common.get_analytiq_client()
+    blob = os.urandom(5000)
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="chunked.pdf", blob=blob,
+                                     metadata={"type": "application/pdf"}, chunk_size_bytes=1024)
+
+    info = await ad.common.get_file_info_async(analytiq_client, "chunked.pdf")
+    assert info["length"] == 5000
+    assert info["metadata"] == {"type": "application/pdf"}
+    chunks = [chunk async for chunk in ad.common.iter_file_async(analytiq_client, "chunked.pdf")]
+    assert [len(chunk) for chunk in chunks] == [1024, 1024, 1024, 1024, 904]
+    assert b"".join(chunks) == blob
+
+    # Byte ranges, across chunk boundaries
+    for start, end in [(0, 10), (1000, 3000), (4096, None), (4999, 6000), (3000, 3000)]:
+        chunks = [chunk async for chunk in ad.common.iter_file_async(analytiq_client, "chunked.pdf", start=start, end=end)]
+        assert b"".join(chunks) == blob[start:end]
+    chunks = [chunk async for chunk in ad.common.iter_file_async(analytiq_client, "chunked.pdf", file_id=info["file_id"])]
+    assert b"".join(chunks) == blob
+
+    assert await ad.common.get_file_info_async(analytiq_client, "missing.pdf") is None
+    with pytest.raises(FileNotFoundError):
+        async for _ in ad.common.iter_file_async(analytiq_client, "missing.pdf"):
+            pass
+
+    with patch("analytiq_data.aws.textract_jobs.TEXTRACT_S3_PART_SIZE", 2000), \
+         patch("analytiq_data.aws.textract_jobs.S3_MIN_PART_SIZE", 0), \
+         patch("analytiq_data.aws.textract_jobs.TEXTRACT_POLL_INITIAL_SECS", 0.01):
+        aws_client = FakeTextractAWSClient(checks_to_finish=1)
+        manager = ad.aws.TextractJobManager(analytiq_client, aws_client)
+
+        # GridFS chunks are regrouped into S3 parts
+        await manager.run(ad.common.iter_file_async(analytiq_client, "chunked.pdf"))
+        assert [len(part) for part in aws_client.uploads[-1]] == [2000, 2000, 1000]
+        assert b"".join(aws_client.uploads[-1]) == blob
+
+        # A file is read part by part
+        with io.BytesIO(blob) as file:
+            await manager.run(file)
+        assert b"".join(aws_client.uploads[-1]) == blob
+        assert len(aws_client.uploads[-1]) == 3
+
+        # An input of one part is uploaded in one request
+        async def iter_small():
+            yield blob[:1000]
+            yield blob[1000:1500]
+        await manager.run(iter_small())
+        assert aws_client.uploads[-1] == [blob[:1500]]
+        assert aws_client.multipart_uploads == {}
+
+@pytest.mark.asyncio
+async def test_blob_overwrite(test_db):
+    """Test that an overwritten blob switches to its new revision, and the old revisions are deleted"""
+    analytiq_client = ad.common.get_analytiq_client()
+    db = ad.common.get_async_db(analytiq_client)
+
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="overwrite.pdf", blob=b"v1", metadata={"v": 1})
+    info_1 = await ad.common.get_file_info_async(analytiq_client, "overwrite.pdf")
+    await ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="overwrite.pdf", blob=b"v2", metadata={"v": 2})
+
+    # The new revision is read, even before the old one is deleted
+    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket="files", key="overwrite.pdf")
+    assert blob["blob"] == b"v2"
+    assert blob["metadata"] == {"v": 2}
+    chunks = [chunk async for chunk in ad.common.iter_file_async(analytiq_client, "overwrite.pdf")]
+    assert b"".join(chunks) == b"v2"
+    info_2 = await ad.common.get_file_info_async(analytiq_client, "overwrite.pdf")
+    assert info_2["file_id"] != info_1["file_id"]
+
+    await ad.mongodb.wait_blob_revision_gc()
+    assert await db["files.files"].count_documents({"filename": "overwrite.pdf"}) == 1
+    with pytest.raises(FileNotFoundError):
+        async for _ in ad.common.iter_file_async(analytiq_client, "overwrite.pdf", file_id=info_1["file_id"]):
+            pass
+
+    # Concurrent overwrites leave one revision
+    await asyncio.gather(*[
+        ad.mongodb.save_blob_async(analytiq_client, bucket="files", key="overwrite.pdf", blob=f"v{i}".encode(), metadata={})
+        for i in range(3, 8)
+    ])
+    await ad.mongodb.wait_blob_revision_gc()
+    assert await db["files.files"].count_documents({"filename": "overwrite.pdf"}) == 1
+    blob = await ad.mongodb.get_blob_async(analytiq_client, bucket="files", key="overwrite.pdf")
+    assert blob["blob"] in [f"v{i}".encode() for i in range(3, 8)]
+
+    await ad.mongodb.delete_blob_async(analytiq_client, bucket="files", key="overwrite.pdf")
+    assert await ad.mongodb.get_blob_async(analytiq_client, bucket="files", key="overwrite.pdf") is None
+    assert await db["files.chunks"].count_documents({"files_id": ObjectId(info_2["file_id"])}) == 0
+
+@pytest.mark.asyncio
+async def test_ocr_page_writer(test_db):
+    """Test that OCR pages are persisted as Textract result pages arrive"""
+    analytiq_client = ad.common.get_analytiq_client()
+    document_id = ad.common.create_id()
+    blocks = make_blocks(n_pages=3, n_lines=2)
+    writer = ad.common.OcrPageWriter(analytiq_client, document_id)
+    collector = ad.aws.textract.TextractPageCollector(writer.add_page)
+
+    # Page 1 is complete once a block of page 2 arrives
+    first_page2_idx = next(i for i, block in enumerate(blocks) if block.get("Page") == 2)
+    await collector.add(blocks[:first_page2_idx + 1])
+    assert await ad.common.get_ocr_progress(analytiq_client, document_id) == {"complete": False, "n_pages_ready": 1}
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 0) == "word1_0\nword1_1\n"
+    assert await ad.common.get_ocr_text(analytiq_client, document_id, 1) is None
+    # The OCR of the document is not available until complete
+    assert await ad.common.get_ocr_metadata(analytiq_client, document_id) is None
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) is None
+
+    # Result pages of 4 blocks. make_blocks() ends with a late block of page 2 and a block without page.
+    for i in range(first_page2_idx + 1, len(blocks), 4):
+        await collector.add(blocks[i:i + 4])
+    await collector.flush()
+    ocr_bytes = await writer.finish()
+
+    assert await ad.common.get_ocr_progress(analytiq_client, document_id) == {"complete": True, "n_pages_ready": 3}
+    assert (await ad.common.get_ocr_metadata(analytiq_client, document_id))["n_pages"] == 3
+    assert await ad.common.get_ocr_text(analytiq_client, document_id) == \
+        "word1_0\nword1_1\n\nword2_0\nword2_1\n\nword3_0\nword3_1\n"
+    decoded = ad.common.decode_ocr_blocks(ocr_bytes)
+    assert by_id(decoded) == by_id(blocks)
+    assert [block.get("Page", 0) for block in decoded] == sorted(block.get("Page", 0) for block in blocks if "Page" in block) + [0]
+
+    # The blocks are saved like any OCR
+    await ad.common.save_ocr_json(analytiq_client, document_id, ocr_bytes)
+    assert by_id(await ad.common.get_ocr_json(analytiq_client, document_id, pages=[2])) == \
+        by_id([block for block in blocks if block.get("Page") == 2])
@@ -0,0 +1,381 @@
+import pytest
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, UTC
+
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Check that ENV is set to pytest
+assert os.environ["ENV"] == "pytest"
+
+@pytest.mark.asyncio
+async def test_queue_send_recv_delete(test_db):
+    """Test that messages are claimed in FIFO order and completed"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_id1 = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"})
+    msg_id2 = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc2"})
+
+    msg = await ad.queue.recv_msg(analytiq_client, "test")
+    assert str(msg["_id"]) == msg_id1
+    assert msg["status"] == "processing"
+    await ad.queue.delete_msg(analytiq_client, "test", msg_id1)
+
+    msg = await ad.queue.recv_msg(analytiq_client, "test")
+    assert str(msg["_id"]) == msg_id2
+    await ad.queue.delete_msg(analytiq_client, "test", msg_id2)
+
+    # The queue is now empty
+    assert await ad.queue.recv_msg(analytiq_client, "test") is None
+
+    completed = await test_db["queues.test"].count_documents({"status": "completed"})
+    assert completed == 2
+
+@pytest.mark.asyncio
+async def test_queue_recv_msg_wait(test_db):
+    """Test that a blocking recv_msg() wakes up when a message is sent"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    try:
+        # Nothing to receive, returns after the timeout
+        assert await ad.queue.recv_msg(analytiq_client, "test", timeout=0.5) is None
+
+        async def send_later():
+            await asyncio.sleep(0.5)
+            return await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"})
+
+        recv_task = asyncio.create_task(ad.queue.recv_msg(analytiq_client, "test", timeout=10))
+        msg_id = await send_later()
+        msg = await recv_task
+
+        assert msg is not None
+        assert str(msg["_id"]) == msg_id
+    finally:
+        await ad.queue.stop_queue_watchers()
+
+@pytest.mark.asyncio
+async def test_queue_recv_msgs_batch(test_db):
+    """Test claiming and completing messages in batches"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_ids = []
+    for i in range(5):
+        msg_ids.append(await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": f"doc{i}"}))
+
+    # Claim a first batch of 3
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test", 3, worker_id="worker_a")
+    assert len(msgs) == 3
+    assert all(msg["status"] == "processing" for msg in msgs)
+    assert all(msg["worker_id"] == "worker_a" for msg in msgs)
+
+    # Only 2 messages are left for the second batch
+    msgs2 = await ad.queue.recv_msgs(analytiq_client, "test", 3, worker_id="worker_b")
+    assert len(msgs2) == 2
+    assert {str(msg["_id"]) for msg in msgs + msgs2} == set(msg_ids)
+
+    assert await ad.queue.recv_msgs(analytiq_client, "test", 3) == []
+
+    await ad.queue.delete_msgs(analytiq_client, "test", [str(msg["_id"]) for msg in msgs + msgs2])
+    completed = await test_db["queues.test"].count_documents({"status": "completed"})
+    assert completed == 5
+
+@pytest.mark.asyncio
+async def test_queue_lease_reclaim(test_db):
+    """Test that expired leases are returned to the queue and live leases are not"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_id1 = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"})
+    msg_id2 = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc2"})
+
+    # Claim both messages with a lease that expires immediately
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test", 2, worker_id="worker_a", lease_secs=0)
+    assert len(msgs) == 2
+    assert all(msg["attempts"] == 1 for msg in msgs)
+
+    # Worker a extends the lease on the first message only
+    msg1 = next(msg for msg in msgs if str(msg["_id"]) == msg_id1)
+    assert await ad.queue.extend_lease(analytiq_client, "test", msg1, lease_secs=60)
+    assert not await ad.queue.extend_lease(analytiq_client, "test", {**msg1, "worker_id": "worker_b"}, lease_secs=60)
+    assert not await ad.queue.extend_lease(analytiq_client, "test", {**msg1, "claim_id": None}, lease_secs=60)
+
+    assert await ad.queue.reclaim_expired_msgs(analytiq_client, "test") == 1
+
+    # The second message is claimed again, with its attempt counter incremented
+    msg = await ad.queue.recv_msg(analytiq_client, "test", worker_id="worker_b")
+    assert str(msg["_id"]) == msg_id2
+    assert msg["attempts"] == 2
+    assert msg["worker_id"] == "worker_b"
+
+@pytest.mark.asyncio
+async def test_queue_lost_claim(test_db):
+    """Test that a worker whose lease was reclaimed cannot retry or complete the message"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_id = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"})
+    stale_msg = await ad.queue.recv_msg(analytiq_client, "test", worker_id="worker_a", lease_secs=0)
+    assert await ad.queue.reclaim_expired_msgs(analytiq_client, "test") == 1
+    msg = await ad.queue.recv_msg(analytiq_client, "test", worker_id="worker_b")
+    assert msg["claim_id"] != stale_msg["claim_id"]
+
+    # Worker a neither resets nor completes the claim of worker b
+    assert await ad.queue.retry_msg(analytiq_client, "test", stale_msg, error="boom")
+    assert not await ad.queue.delete_msg(analytiq_client, "test", msg_id, claim_id=stale_msg["claim_id"])
+    msg_data = await test_db["queues.test"].find_one({"_id": msg["_id"]})
+    assert msg_data["status"] == "processing"
+    assert msg_data["worker_id"] == "worker_b"
+    assert await ad.queue.list_dead_msgs(analytiq_client, "test") == []
+
+    assert await ad.queue.delete_msg(analytiq_client, "test", msg_id, claim_id=msg["claim_id"])
+
+@pytest.fixture
+def short_retry_policy():
+    """Give the test queue a retry policy of 2 attempts, and restore the previous one afterwards"""
+    prev_policy = ad.queue.RETRY_POLICIES.get("test")
+    ad.queue.set_retry_policy("test", ad.queue.RetryPolicy(max_attempts=2, base_delay_secs=60, max_delay_secs=60))
+    yield
+    if prev_policy is None:
+        ad.queue.RETRY_POLICIES.pop("test", None)
+    else:
+        ad.queue.set_retry_policy("test", prev_policy)
+
+@pytest.mark.asyncio
+async def test_queue_retry_and_dead_letter(test_db, short_retry_policy):
+    """Test that failed messages are retried with backoff and then dead-lettered"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_id = await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"})
+
+    # First attempt fails, the message is delayed by the backoff
+    msg = await ad.queue.recv_msg(analytiq_client, "test")
+    assert await ad.queue.retry_msg(analytiq_client, "test", msg, error="throttled")
+    assert await ad.queue.recv_msg(analytiq_client, "test") is None
+
+    # Make the message due now
+    await test_db["queues.test"].update_one({"_id": msg["_id"]},
+                                            {"$unset": {"not_before": ""}, "$set": {"ready_at": datetime.now(UTC)}})
+
+    # Second attempt fails, the message is dead-lettered
+    msg = await ad.queue.recv_msg(analytiq_client, "test")
+    assert msg["attempts"] == 2
+    assert not await ad.queue.retry_msg(analytiq_client, "test", msg, error="throttled")
+    assert await ad.queue.recv_msg(analytiq_client, "test") is None
+
+    dead_msgs = await ad.queue.list_dead_msgs(analytiq_client, "test")
+    assert len(dead_msgs) == 1
+    assert str(dead_msgs[0]["_id"]) == msg_id
+    assert dead_msgs[0]["error"] == "throttled"
+
+    # Requeue the message
+    assert await ad.queue.requeue_dead_msgs(analytiq_client, "test") == 1
+    assert await ad.queue.list_dead_msgs(analytiq_client, "test") == []
+    msg = await ad.queue.recv_msg(analytiq_client, "test")
+    assert msg["msg"] == {"document_id": "doc1"}
+    assert msg["attempts"] == 1
+
+@pytest.mark.asyncio
+async def test_queue_send_msg_not_before(test_db):
+    """Test that a message is not delivered before its not_before time"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    await ad.queue.send_msg(analytiq_client, "test", msg={"document_id": "doc1"},
+                            not_before=datetime.now(UTC) + timedelta(hours=1))
+    assert await ad.queue.recv_msg(analytiq_client, "test") is None
+
+@pytest.mark.asyncio
+async def test_queue_fair_scheduling(test_db):
+    """Test that fair scheduling shares the queue between organizations"""
+    analytiq_client = ad.common.get_analytiq_client()
+    ad.queue.set_scheduling_mode("test_fair", ad.queue.SCHEDULING_FAIR)
+
+    # A large backlog from org_a, then a few messages from org_b and org_c
+    for i in range(20):
+        await ad.queue.send_msg(analytiq_client, "test_fair", msg={"document_id": f"a{i}"}, organization_id="org_a")
+    for i in range(2):
+        await ad.queue.send_msg(analytiq_client, "test_fair", msg={"document_id": f"b{i}"}, organization_id="org_b")
+        await ad.queue.send_msg(analytiq_client, "test_fair", msg={"document_id": f"c{i}"}, organization_id="org_c")
+
+    # The first 6 claims are shared equally instead of going to org_a
+    msgs = []
+    for _ in range(6):
+        msgs.append(await ad.queue.recv_msg(analytiq_client, "test_fair"))
+    orgs = [msg["organization_id"] for msg in msgs]
+    assert orgs.count("org_a") == 2
+    assert orgs.count("org_b") == 2
+    assert orgs.count("org_c") == 2
+
+    # Only org_a is left
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_fair", 4)
+    assert [msg["organization_id"] for msg in msgs] == ["org_a"] * 4
+
+    # Cap org_a to the 6 messages it already has in flight
+    await ad.queue.set_org_schedule(analytiq_client, "test_fair", "org_a", max_processing=6)
+    assert await ad.queue.recv_msgs(analytiq_client, "test_fair", 4) == []
+
+    # Weight org_d twice as much as org_e, with org_a still capped
+    await ad.queue.set_org_schedule(analytiq_client, "test_fair", "org_d", weight=2)
+    for i in range(10):
+        await ad.queue.send_msg(analytiq_client, "test_fair", msg={"document_id": f"d{i}"}, organization_id="org_d")
+        await ad.queue.send_msg(analytiq_client, "test_fair", msg={"document_id": f"e{i}"}, organization_id="org_e")
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_fair", 6)
+    orgs = [msg["organization_id"] for msg in msgs]
+    assert orgs.count("org_d") == 4
+    assert orgs.count("org_e") == 2
+
+@pytest.mark.asyncio
+async def test_queue_fair_scheduling_backoff(test_db):
+    """Test that organizations waiting out a backoff, or short of messages, do not hold back the others"""
+    analytiq_client = ad.common.get_analytiq_client()
+    ad.queue.set_scheduling_mode("test_fair_backoff", ad.queue.SCHEDULING_FAIR)
+
+    # org_a is not served yet, but its only message is delayed
+    await ad.queue.send_msg(analytiq_client, "test_fair_backoff", msg={"document_id": "a0"}, organization_id="org_a",
+                            not_before=datetime.now(UTC) + timedelta(hours=1))
+    await ad.queue.set_org_schedule(analytiq_client, "test_fair_backoff", "org_b")
+    await test_db["queues.test_fair_backoff_orgs"].update_one({"_id": "org_b"}, {"$set": {"vtime": 10.0}})
+    for i in range(5):
+        await ad.queue.send_msg(analytiq_client, "test_fair_backoff", msg={"document_id": f"b{i}"}, organization_id="org_b")
+    for i in range(2):
+        await ad.queue.send_msg(analytiq_client, "test_fair_backoff", msg={"document_id": f"c{i}"}, organization_id="org_c")
+
+    # org_c has the lowest virtual time but only 2 messages, the rest of the batch goes to org_b
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_fair_backoff", 4)
+    assert sorted(msg["organization_id"] for msg in msgs) == ["org_b", "org_b", "org_c", "org_c"]
+
+    # Cap org_b to the 2 messages it has in flight
+    await ad.queue.set_org_schedule(analytiq_client, "test_fair_backoff", "org_b", max_processing=2)
+    await ad.queue.sync_org_slots(analytiq_client, "test_fair_backoff")
+    assert await ad.queue.recv_msgs(analytiq_client, "test_fair_backoff", 2) == []
+
+    # Completing a message of org_b frees one of its slots
+    msg_b = next(msg for msg in msgs if msg["organization_id"] == "org_b")
+    await ad.queue.delete_msg(analytiq_client, "test_fair_backoff", str(msg_b["_id"]), claim_id=msg_b["claim_id"])
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_fair_backoff", 2)
+    assert [msg["organization_id"] for msg in msgs] == ["org_b"]
+    state = await test_db["queues.test_fair_backoff_orgs"].find_one({"_id": "org_b"})
+    assert state["processing"] == 2
+
+@pytest.mark.asyncio
+async def test_queue_stats(test_db):
+    """Test that the queue stats counters follow the messages"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    for i in range(3):
+        await ad.queue.send_msg(analytiq_client, "test_stats", msg={"document_id": f"doc{i}"})
+
+    stats = await ad.queue.get_queue_stats(analytiq_client, "test_stats")
+    assert stats["pending"] == 3
+    assert stats["processing"] == 0
+    assert stats["oldest_pending_age_secs"] >= 0
+
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_stats", 2, worker_id="worker_a")
+    assert len(msgs) == 2
+    await ad.queue.delete_msg(analytiq_client, "test_stats", str(msgs[0]["_id"]))
+    await ad.queue.delete_msgs(analytiq_client, "test_stats", [str(msgs[1]["_id"])], status="failed")
+
+    stats = await ad.queue.get_queue_stats(analytiq_client, "test_stats")
+    assert stats["pending"] == 1
+    assert stats["processing"] == 0
+    assert stats["sent"] == 3
+    assert stats["claimed"] == 2
+    assert stats["completed"] == 1
+    assert stats["failed"] == 1
+
+    # Only completed messages count towards latency and throughput
+    assert stats["latency_ms"]["count"] == 1
+    assert stats["latency_ms"]["p50"] is not None
+    assert stats["workers"] == [{"worker_id": "worker_a", "completed": 1, "per_min": 1 / 5}]
+
+    # Drifted counters are corrected by a sync
+    await test_db["queue_stats"].update_one({"_id": "test_stats"}, {"$set": {"pending": 10}})
+    await ad.queue.sync_queue_stats(analytiq_client, "test_stats")
+    stats = await ad.queue.get_queue_stats(analytiq_client, "test_stats")
+    assert stats["pending"] == 1
+
+@pytest.mark.asyncio
+async def test_queue_retention(test_db):
+    """Test that finished messages are stamped for expiry by the TTL index"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_id = await ad.queue.send_msg(analytiq_client, "test_retention", msg={"document_id": "doc1"})
+    msg = await ad.queue.recv_msg(analytiq_client, "test_retention")
+    assert "finished_at" not in msg
+    await ad.queue.delete_msg(analytiq_client, "test_retention", msg_id)
+
+    msg = await test_db["queues.test_retention"].find_one({})
+    assert msg["status"] == "completed"
+    assert msg["finished_at"] is not None
+
+    indexes = await test_db["queues.test_retention"].index_information()
+    assert indexes["finished_at_ttl_idx"]["expireAfterSeconds"] == ad.queue.QUEUE_RETENTION_SECS
+    assert "status_created_at_idx" in indexes
+    assert "status_ready_at_idx" in indexes
+
+@pytest.mark.asyncio
+async def test_queue_send_msgs_idempotency(test_db):
+    """Test bulk sends, and that pending messages with the same idempotency key collapse"""
+    analytiq_client = ad.common.get_analytiq_client()
+
+    msg_ids = await ad.queue.send_msgs(analytiq_client, "test_dedup",
+                                       msgs=[{"document_id": f"doc{i}"} for i in range(3)] + [{"document_id": "doc0"}],
+                                       idempotency_keys=["doc0", "doc1", "doc2", "doc0"])
+    assert len(msg_ids) == 4
+    assert msg_ids[3] == msg_ids[0]
+    assert await test_db["queues.test_dedup"].count_documents({}) == 3
+
+    # Sending the same job again returns the pending message
+    msg_id = await ad.queue.send_msg(analytiq_client, "test_dedup", msg={"document_id": "doc1"}, idempotency_key="doc1")
+    assert msg_id == msg_ids[1]
+
+    # Once the job is claimed, the key can be sent again
+    msgs = await ad.queue.recv_msgs(analytiq_client, "test_dedup", 3)
+    assert len(msgs) == 3
+    msg_id = await ad.queue.send_msg(analytiq_client, "test_dedup", msg={"document_id": "doc1"}, idempotency_key="doc1")
+    assert msg_id not in msg_ids
+
+    # Retrying the claimed message would duplicate the new pending one, so it is superseded
+    msg = next(msg for msg in msgs if msg["idempotency_key"] == "doc1")
+    assert await ad.queue.retry_msg(analytiq_client, "test_dedup", msg, error="boom")
+    msg = await test_db["queues.test_dedup"].find_one({"_id": msg["_id"]})
+    assert msg["status"] == ad.queue.SUPERSEDED_STATUS
+    assert await test_db["queues.test_dedup"].count_documents({"status": "pending"}) == 1
+
+    stats = await ad.queue.get_queue_stats(analytiq_client, "test_dedup")
+    assert stats["sent"] == 4
+    assert stats["deduplicated"] == 2
+
+def test_queue_concurrency_controller():
+    """Test that the concurrency grows additively with the backlog and backs off multiplicatively"""
+    controller = ad.queue.ConcurrencyController("test", initial_concurrency=4, max_concurrency=8)
+
+    # Backlog growing and latency steady: grow by one
+    for pending in [10, 20, 30]:
+        controller.record_latency(1.0)
+        controller.adjust(pending)
+    assert controller.concurrency == 7
+
+    # Throttled: halve
+    controller.record_latency(1.0)
+    assert controller.adjust(40, n_throttled=1) == 3
+    assert controller.last_reason == ad.queue.CONCURRENCY_REASON_THROTTLED
+
+    # Latency well above its baseline: halve
+    controller.record_latency(5.0)
+    assert controller.adjust(50) == 1
+    assert controller.last_reason == ad.queue.CONCURRENCY_REASON_LATENCY
+
+    # Never beyond the bounds
+    for pending in range(100, 200, 10):
+        controller.record_latency(1.0)
+        controller.adjust(pending)
+    assert controller.concurrency == 8
+
+    assert ad.queue.is_throttling_error("RateLimitError: Error code: 429")
+    assert ad.queue.is_throttling_error("An error occurred (ThrottlingException) when calling the StartDocumentAnalysis operation")
+    assert not ad.queue.is_throttling_error("Document not found")
+
+    metrics = controller.get_metrics()
+    assert metrics["concurrency"] == 8
+    assert metrics["history"][-1]["reason"] == ad.queue.CONCURRENCY_REASON_BACKLOG
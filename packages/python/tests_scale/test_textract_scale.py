@@ -0,0 +1,49 @@
+import os
+import time
+import logging
+from tests.test_ocr import make_blocks, make_analysis_blocks
+import analytiq_data as ad
+
+logger = logging.getLogger(__name__)
+
+# Check that ENV is set to pytest
+assert os.environ["ENV"] == "pytest"
+
+def extract_all(blocks: list) -> float:
+    """Index the blocks and extract everything from them, returning the elapsed seconds"""
+    start = time.perf_counter()
+    doc = ad.aws.TextractDocument(blocks)
+    doc.get_page_text_map()
+    doc.get_tables()
+    doc.get_key_values()
+    doc.get_query_map()
+    for page in doc.pages:
+        doc.get_words(page)
+    return time.perf_counter() - start
+
+def test_textract_document_scale(n_pages: int = 1000, n_lines: int = 50):
+    """Benchmark TextractDocument on a synthetic 1000-page block set, and check that it scales linearly"""
+    blocks = make_blocks(n_pages=n_pages, n_lines=n_lines) + make_analysis_blocks(n_pages=n_pages, n_rows=10, n_cols=5)
+    small_blocks = make_blocks(n_pages=n_pages // 10, n_lines=n_lines) + \
+        make_analysis_blocks(n_pages=n_pages // 10, n_rows=10, n_cols=5)
+
+    elapsed = extract_all(blocks)
+    small_elapsed = extract_all(small_blocks)
+    logger.info(f"TextractDocument: {len(blocks)} blocks in {elapsed:.3f}s, "
+                f"{len(small_blocks)} blocks in {small_elapsed:.3f}s")
+
+    # The block map functions, for comparison
+    start = time.perf_counter()
+    block_map = ad.aws.textract.get_block_map(blocks)
+    ad.aws.textract.get_page_text_map(block_map)
+    ad.aws.textract.get_tables(block_map)
+    ad.aws.textract.get_query_map(block_map)
+    logger.info(f"Block map functions: {len(blocks)} blocks in {time.perf_counter() - start:.3f}s")
+
+    doc = ad.aws.TextractDocument(blocks)
+    assert len(doc.get_page_text_map()) == n_pages
+    assert len(doc.get_tables()) == n_pages
+    assert len(doc.get_query_map()) == n_pages + 1
+
+    # 10x the blocks must take well under 100x the time
+    assert elapsed < 50 * max(small_elapsed, 0.001)
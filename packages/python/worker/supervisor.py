@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import signal
+import asyncio
+import multiprocessing
+import logging
+# Add the parent directory to the sys path
+sys.path.append("..")
+import analytiq_data as ad
+import worker
+
+logger = logging.getLogger(__name__)
+
+STAGES = ["ocr", "llm"]
+POLL_INTERVAL_SECS = 1  # seconds between checks of the child processes
+RESTART_BACKOFF_MIN_SECS = 1  # delay before restarting a crashed child, doubled on each crash
+RESTART_BACKOFF_MAX_SECS = 60
+STABLE_RUN_SECS = 60  # a child running this long resets its restart backoff
+
+# Time for a child to stop after SIGTERM: finish its current claim, then drain
+STOP_TIMEOUT_SECS = worker.RECV_TIMEOUT_SECS + worker.DRAIN_TIMEOUT_SECS + 10
+
+def get_stage_processes(stage: str) -> int:
+    """
+    Get the number of processes running a stage, from OCR_PROCESSES or LLM_PROCESSES
+
+    Args:
+        stage: "ocr" or "llm"
+
+    Returns:
+        int: The number of processes
+    """
+    return int(os.getenv(f"{stage.upper()}_PROCESSES", "1"))
+
+async def run_stage(stage: str, index: int, concurrency: int) -> None:
+    """
+    Run the worker of a stage until SIGTERM or SIGINT, then drain it
+
+    Args:
+        stage: "ocr" or "llm"
+        index: Index of the process in the stage
+        concurrency: Maximum number of messages in flight
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    worker_id = worker.get_worker_id(stage, index)
+    try:
+        if stage == "ocr":
+            # Only the first OCR process migrates the legacy OCR blobs
+            await worker.worker_ocr(worker_id, concurrency, stop_event=stop_event, migrate=index == 0)
+        else:
+            await worker.worker_llm(worker_id, concurrency, stop_event=stop_event)
+    finally:
+        await ad.queue.stop_queue_watchers()
+        await ad.mongodb.close_s3_clients()
+        await ad.aws.stop_textract_job_managers()
+        await ad.aws.invalidate_aws_clients()
+
+def child_main(stage: str, index: int, concurrency: int) -> None:
+    """
+    Entry point of a child process
+    """
+    asyncio.run(run_stage(stage, index, concurrency))
+
+class Child:
+    """
+    A supervised child process running one worker pool
+    """
+    def __init__(self, stage: str, index: int, concurrency: int):
+        self.stage = stage
+        self.index = index
+        self.worker_id = f"{stage}_{index}"
+        self.concurrency = concurrency
+        self.process = None
+        self.started_at = None
+        self.restart_at = 0.0
+        self.backoff_secs = RESTART_BACKOFF_MIN_SECS
+
+    def start(self, ctx) -> None:
+        self.process = ctx.Process(target=child_main,
+                                   args=(self.stage, self.index, self.concurrency),
+                                   name=self.worker_id)
+        self.process.start()
+        self.started_at = time.monotonic()
+        logger.info(f"Started worker {self.worker_id} (pid {self.process.pid}) with concurrency {self.concurrency}")
+
+    def check(self, ctx) -> None:
+        """
+        Restart the child if it exited, with exponential backoff if it keeps crashing
+        """
+        now = time.monotonic()
+        if self.process is not None:
+            if self.process.is_alive():
+                if now - self.started_at >= STABLE_RUN_SECS:
+                    self.backoff_secs = RESTART_BACKOFF_MIN_SECS
+                return
+            logger.error(f"Worker {self.worker_id} (pid {self.process.pid}) exited with code "
+                         f"{self.process.exitcode}, restarting in {self.backoff_secs}s")
+            self.process = None
+            self.restart_at = now + self.backoff_secs
+            self.backoff_secs = min(self.backoff_secs * 2, RESTART_BACKOFF_MAX_SECS)
+
+        if now >= self.restart_at:
+            self.start(ctx)
+
+def supervise() -> None:
+    """
+    Run OCR_PROCESSES OCR worker processes and LLM_PROCESSES LLM worker
+    processes, each processing up to OCR_WORKERS or LLM_WORKERS messages at a
+    time. Crashed children are restarted. On SIGTERM or SIGINT, the children
+    stop claiming messages and drain the ones in flight before exiting.
+    """
+    # Children are spawned, so that they do not inherit the state of the parent
+    ctx = multiprocessing.get_context("spawn")
+
+    children = []
+    for stage in STAGES:
+        concurrency = worker.get_stage_concurrency(stage)
+        for i in range(get_stage_processes(stage)):
+            children.append(Child(stage, i, concurrency))
+
+    stopping = False
+    def request_stop(signum, frame):
+        nonlocal stopping
+        logger.info(f"Received signal {signum}, stopping workers")
+        stopping = True
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stopping:
+        for child in children:
+            child.check(ctx)
+        time.sleep(POLL_INTERVAL_SECS)
+
+    # Let the children drain, then kill the ones that did not exit
+    running = [child.process for child in children if child.process is not None and child.process.is_alive()]
+    for process in running:
+        process.terminate()
+    deadline = time.monotonic() + STOP_TIMEOUT_SECS
+    for process in running:
+        process.join(max(deadline - time.monotonic(), 0))
+        if process.is_alive():
+            logger.warning(f"Worker {process.name} (pid {process.pid}) did not stop in time, killing it")
+            process.kill()
+            process.join()
+    logger.info("All workers stopped")
+
+if __name__ == "__main__":
+    supervise()
@@ -1,10 +1,12 @@
 #!/usr/bin/env python3
 import os
 import sys
+import socket
 from dotenv import load_dotenv
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, UTC
+from typing import Optional
 import logging
 # Add the parent directory to the sys path
 sys.path.append("..")
@@ -16,91 +18,255 @@ ad.common.setup()
 logger = logging.getLogger(__name__)
 
 HEARTBEAT_INTERVAL_SECS = 600  # seconds
+RECV_TIMEOUT_SECS = 10  # seconds to block waiting for a message before re-checking the heartbeat
+REAP_INTERVAL_SECS = 60  # seconds between passes returning expired leases to the queue
+DRAIN_TIMEOUT_SECS = 120  # seconds to let in-flight messages finish on shutdown before cancelling them
+CONCURRENCY_ADJUST_INTERVAL_SECS = 10  # seconds between adjustments of the adaptive concurrency
+OCR_MIGRATION_BATCH_SIZE = 10  # legacy OCR blobs rewritten in the compact format per batch
+OCR_MIGRATION_INTERVAL_SECS = 5  # seconds between batches
 
-async def worker_ocr(worker_id: str) -> None:
+async def process_ocr(analytiq_client, msg) -> None:
     """
-    Worker for OCR jobs
+    Process one OCR message, retrying it on unhandled errors
 
     Args:
-        worker_id: The worker ID
+        analytiq_client: The AnalytiqClient
+        msg: The OCR message
+    """
+    try:
+        async with ad.queue.lease_heartbeat(analytiq_client, "ocr", msg):
+            await ad.msg_handlers.process_ocr_msg(analytiq_client, msg)
+    except Exception as e:
+        logger.error(f"Error processing OCR message {msg.get('_id')}: {str(e)}")
+        await ad.queue.retry_msg(analytiq_client, "ocr", msg, error=str(e))
+
+async def process_llm(analytiq_client, msg) -> None:
+    """
+    Process one LLM message, retrying it on unhandled errors
+
+    Args:
+        analytiq_client: The AnalytiqClient
+        msg: The LLM message
+    """
+    try:
+        async with ad.queue.lease_heartbeat(analytiq_client, "llm", msg):
+            await ad.msg_handlers.process_llm_msg(analytiq_client, msg)
+    except Exception as e:
+        logger.error(f"Error processing LLM message {msg.get('_id')}: {str(e)}")
+        await ad.queue.retry_msg(analytiq_client, "llm", msg, error=str(e))
+
+async def worker_pool(worker_id: str,
+                      queue_name: str,
+                      process_func,
+                      concurrency: int,
+                      stop_event: Optional[asyncio.Event] = None) -> None:
+    """
+    Claim messages from a queue in batches and process up to `concurrency` of them at a time
+
+    Once stop_event is set, no more messages are claimed, and the messages in
+    flight get DRAIN_TIMEOUT_SECS to finish. Messages still running after that
+    are cancelled, and return to the queue when their lease expires.
+
+    Args:
+        worker_id: The worker ID, recorded on the claimed messages
+        queue_name: The queue to consume
+        process_func: Coroutine function called with (analytiq_client, msg)
+        concurrency: Maximum number of messages in flight. With ADAPTIVE_CONCURRENCY,
+            the initial number, adjusted between 1 and {STAGE}_MAX_WORKERS (default: 4x)
+        stop_event: Optional event stopping the pool gracefully
     """
     # Re-read the environment variables, in case they were changed by unit tests
     ENV = os.getenv("ENV", "dev")
 
-    # Create a separate client instance for each worker
+    # Create a separate client instance for each worker pool
     analytiq_client = ad.common.get_analytiq_client(env=ENV, name=worker_id)
-    logger.info(f"Starting worker {worker_id}")
+    logger.info(f"Starting worker {worker_id} with concurrency {concurrency}")
+
+    controller = None
+    if os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true":
+        max_concurrency = os.getenv(f"{queue_name.upper()}_MAX_WORKERS")
+        controller = ad.queue.ConcurrencyController(
+            queue_name,
+            initial_concurrency=concurrency,
+            max_concurrency=int(max_concurrency) if max_concurrency else None,
+            adjust_interval_secs=CONCURRENCY_ADJUST_INTERVAL_SECS
+        )
+        logger.info(f"Worker {worker_id} adapts its concurrency between "
+                    f"{controller.min_concurrency} and {controller.max_concurrency}")
+
+    async def process(msg):
+        start = asyncio.get_running_loop().time()
+        await process_func(analytiq_client, msg)
+        if controller is not None:
+            controller.record_latency(asyncio.get_running_loop().time() - start)
+
+    housekeeping_secs = REAP_INTERVAL_SECS
+    if controller is not None:
+        housekeeping_secs = min(housekeeping_secs, CONCURRENCY_ADJUST_INTERVAL_SECS)
 
     last_heartbeat = datetime.now(UTC)
+    last_reap = None
+    in_flight = set()
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            try:
+                # Log heartbeat every 10 minutes
+                now = datetime.now(UTC)
+                if (now - last_heartbeat).total_seconds() >= HEARTBEAT_INTERVAL_SECS:
+                    logger.info(f"Worker {worker_id} heartbeat: {len(in_flight)} in flight")
+                    logger.info(f"Worker {worker_id} blob cache: {ad.mongodb.get_blob_cache_stats()}")
+                    last_heartbeat = now
+
+                # Return messages of crashed workers to the queue, and correct
+                # any drift of the queue stats and organization counters
+                if last_reap is None or (now - last_reap).total_seconds() >= REAP_INTERVAL_SECS:
+                    last_reap = now
+                    n_reclaimed = await ad.queue.reclaim_expired_msgs(analytiq_client, queue_name)
+                    if n_reclaimed > 0:
+                        logger.info(f"Worker {worker_id} reclaimed {n_reclaimed} expired {queue_name} msgs")
+                    await ad.queue.sync_queue_stats(analytiq_client, queue_name)
+                    await ad.queue.sync_org_slots(analytiq_client, queue_name)
+
+                # Grow or shrink the concurrency from the backlog, latency and throttling
+                if controller is not None and controller.is_due():
+                    pending = await ad.queue.get_queue_depth(analytiq_client, queue_name)
+                    concurrency = controller.adjust(pending, ad.queue.pop_throttle_count(queue_name))
+                    await ad.queue.set_concurrency_metrics(analytiq_client, queue_name, worker_id,
+                                                           controller.get_metrics())
+
+                free = concurrency - len(in_flight)
+                if free <= 0:
+                    # All slots are busy, wait for one to free up. Wake up for
+                    # the housekeeping above even if none does, so that the
+                    # leases of crashed peers are reaped while the pool is saturated.
+                    _, in_flight = await asyncio.wait(in_flight, timeout=housekeeping_secs,
+                                                      return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                msgs = await ad.queue.recv_msgs(analytiq_client, queue_name, free,
+                                                worker_id=worker_id, timeout=RECV_TIMEOUT_SECS)
+                for msg in msgs:
+                    logger.info(f"Worker {worker_id} processing {queue_name} msg: {msg}")
+                    in_flight.add(asyncio.create_task(process(msg)))
+
+                # Drop the tasks that completed while we were waiting for messages
+                in_flight = {task for task in in_flight if not task.done()}
+
+            except Exception as e:
+                logger.error(f"Worker {worker_id} encountered error: {str(e)}")
+                await asyncio.sleep(1)  # Sleep longer on errors to prevent tight loop
+
+        # Drain the messages in flight
+        if in_flight:
+            logger.info(f"Worker {worker_id} draining {len(in_flight)} in-flight {queue_name} msgs")
+            _, in_flight = await asyncio.wait(in_flight, timeout=DRAIN_TIMEOUT_SECS)
+            if in_flight:
+                logger.warning(f"Worker {worker_id} cancelling {len(in_flight)} {queue_name} msgs still in flight")
+        logger.info(f"Worker {worker_id} stopped")
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def migrate_ocr(worker_id: str) -> None:
+    """
+    Rewrite the legacy pickled OCR blocks in the compact format, a batch at a
+    time, until none are left
+
+    Args:
+        worker_id: The worker ID
+    """
+    ENV = os.getenv("ENV", "dev")
+    analytiq_client = ad.common.get_analytiq_client(env=ENV, name=f"{worker_id}_migrate")
 
+    n_migrated = 0
     while True:
         try:
-            # Log heartbeat every 10 minutes
-            now = datetime.now(UTC)
-            if (now - last_heartbeat).total_seconds() >= HEARTBEAT_INTERVAL_SECS: 
-                logger.info(f"Worker {worker_id} heartbeat")
-                last_heartbeat = now
-
-            msg = await ad.queue.recv_msg(analytiq_client, "ocr")
-            if msg:
-                logger.info(f"Worker {worker_id} processing OCR msg: {msg}")
-                try:
-                    await ad.msg_handlers.process_ocr_msg(analytiq_client, msg)
-                except Exception as e:
-                    logger.error(f"Error processing OCR message {msg.get('_id')}: {str(e)}")
-                    # Mark message as failed
-                    await ad.queue.delete_msg(analytiq_client, "ocr", str(msg["_id"]), status="failed")
-            else:
-                await asyncio.sleep(0.2)  # Avoid tight loop when no messages
-                
+            n = await ad.common.migrate_ocr_json(analytiq_client, OCR_MIGRATION_BATCH_SIZE)
+            if n == 0:
+                if n_migrated > 0:
+                    logger.info(f"Worker {worker_id} migrated {n_migrated} OCR blobs to the compact format")
+                return
+            n_migrated += n
         except Exception as e:
-            logger.error(f"Worker {worker_id} encountered error: {str(e)}")
-            await asyncio.sleep(1)  # Sleep longer on errors to prevent tight loop
+            logger.error(f"Worker {worker_id} failed to migrate OCR blobs: {str(e)}")
+        await asyncio.sleep(OCR_MIGRATION_INTERVAL_SECS)
+
+async def worker_ocr(worker_id: str,
+                     concurrency: int = 1,
+                     stop_event: Optional[asyncio.Event] = None,
+                     migrate: bool = True) -> None:
+    """
+    Worker for OCR jobs
+
+    Args:
+        worker_id: The worker ID
+        concurrency: Maximum number of OCR jobs in flight
+        stop_event: Optional event stopping the worker gracefully
+        migrate: Whether to migrate the legacy OCR blobs in the background
+    """
+    migrate_task = asyncio.create_task(migrate_ocr(worker_id)) if migrate else None
+    try:
+        await worker_pool(worker_id, "ocr", process_ocr, concurrency, stop_event=stop_event)
+    finally:
+        if migrate_task is not None:
+            migrate_task.cancel()
 
-async def worker_llm(worker_id: str) -> None:
+async def worker_llm(worker_id: str,
+                     concurrency: int = 1,
+                     stop_event: Optional[asyncio.Event] = None) -> None:
     """
     Worker for LLM jobs
 
     Args:
         worker_id: The worker ID
+        concurrency: Maximum number of LLM jobs in flight
+        stop_event: Optional event stopping the worker gracefully
     """
-    # Re-read the environment variables, in case they were changed by unit tests
-    ENV = os.getenv("ENV", "dev")
+    await worker_pool(worker_id, "llm", process_llm, concurrency, stop_event=stop_event)
 
-    # Create a separate client instance for each worker
-    analytiq_client = ad.common.get_analytiq_client(env=ENV, name=worker_id)
-    logger.info(f"Starting worker {worker_id}")
+def get_worker_id(stage: str, index: int) -> str:
+    """
+    Get the ID of a worker, unique across hosts and processes. It owns the
+    leases of the messages the worker claims, and keys its stats and metrics.
 
-    last_heartbeat = datetime.now(UTC)
+    Args:
+        stage: "ocr" or "llm"
+        index: Index of the worker in the stage on this host
 
-    while True:
-        try:
-            # Log heartbeat every 10 minutes
-            now = datetime.now(UTC)
-            if (now - last_heartbeat).total_seconds() >= HEARTBEAT_INTERVAL_SECS: 
-                logger.info(f"Worker {worker_id} heartbeat")
-                last_heartbeat = now
-
-            msg = await ad.queue.recv_msg(analytiq_client, "llm")
-            if msg:
-                logger.info(f"Worker {worker_id} processing LLM msg: {msg}")
-                await ad.msg_handlers.process_llm_msg(analytiq_client, msg)
-            else:
-                await asyncio.sleep(0.2)  # Avoid tight loop
-        except Exception as e:
-            logger.error(f"Worker {worker_id} encountered error: {str(e)}")
-            await asyncio.sleep(1)  # Sleep longer on errors to prevent tight loop
+    Returns:
+        str: The worker ID, e.g. "host1_1234_ocr_0"
+    """
+    # Dots would split the ID into nested fields of the concurrency metrics
+    hostname = socket.gethostname().replace(".", "-")
+    return f"{hostname}_{os.getpid()}_{stage}_{index}"
 
-async def main():
-    # Re-read the environment variables, in case they were changed by unit tests
-    N_WORKERS = int(os.getenv("N_WORKERS", "1"))
+def get_stage_concurrency(stage: str) -> int:
+    """
+    Get the number of messages of a stage processed at a time by one process.
+    OCR_WORKERS and LLM_WORKERS default to N_WORKERS.
 
-    # Create N_WORKERS workers of worker_ocr and worker_llm
-    ocr_workers = [worker_ocr(f"ocr_{i}") for i in range(N_WORKERS)]
-    llm_workers = [worker_llm(f"llm_{i}") for i in range(N_WORKERS)]
+    Args:
+        stage: "ocr" or "llm"
 
-    # Run all workers concurrently
-    await asyncio.gather(*ocr_workers, *llm_workers)
+    Returns:
+        int: The concurrency
+    """
+    # Re-read the environment variables, in case they were changed by unit tests
+    N_WORKERS = os.getenv("N_WORKERS", "1")
+    return int(os.getenv(f"{stage.upper()}_WORKERS", N_WORKERS))
+
+async def main():
+    # Run the OCR and LLM jobs concurrently in this process. Use supervisor.py
+    # to spread them over several processes.
+    try:
+        await asyncio.gather(worker_ocr(get_worker_id("ocr", 0), get_stage_concurrency("ocr")),
+                             worker_llm(get_worker_id("llm", 0), get_stage_concurrency("llm")))
+    finally:
+        await ad.queue.stop_queue_watchers()
+        await ad.mongodb.close_s3_clients()
+        await ad.aws.stop_textract_job_managers()
+        await ad.aws.invalidate_aws_clients()
 
 if __name__ == "__main__":
     try:    